@@ -1,20 +1,34 @@
 import math
-import os
+import time
 
 import numpy as np
 import torch
 import torch.nn.functional as F
-from torch.distributions import Categorical
+
+from .inference_backends import TORCHSCRIPT_BACKEND, load_backend
+from .nexto_obs import ROSTER_BUCKETS, entity_count
+from .thread_tuner import apply_threads, cached_threads
+
+# Entities of the 1v1, 2v2 and 3v3 observations on the standard field
+WARMUP_ENTITY_COUNTS = tuple(entity_count(n_cars) for n_cars in ROSTER_BUCKETS)
 
 
 class Agent:
-    def __init__(self):
-        cur_dir = os.path.dirname(os.path.realpath(__file__))
-        with open(os.path.join(cur_dir, "nexto-model.pt"), 'rb') as f:
-            self.actor = torch.jit.load(f)
-        torch.set_num_threads(1)
+    def __init__(self, backend: str = TORCHSCRIPT_BACKEND, seed=None, threads=None, warmup: bool = True,
+                 attention_weights: bool = True, entity_counts=None):
+        # (intra_op, inter_op) thread counts, see thread_tuner.py, a single thread unless calibrated
+        apply_threads(*(threads or (1,)))
+        # With entity_counts (the padded roster sizes, see NextoObsBuilder.roster_buckets) each of them
+        # gets its own model instance, see SpecializedBackend, and those are the shapes warmed up
+        self.entity_counts = tuple(entity_counts) if entity_counts else None
+        # Without attention weights the model skips computing them and weights come back as None
+        self.actor = load_backend(backend, attention_weights=attention_weights, entity_counts=self.entity_counts)
+        self._variants = {attention_weights: self.actor}
         self._lookup_table = self.make_lookup_table()
+        self._lookup_table.setflags(write=False)  # act hands out views of its rows
+        self.selector = ActionSelector(len(self._lookup_table), seed)
         self.state = None
+        self.warmup_stats = self.warm_up() if warmup else None
 
     @staticmethod
     def make_lookup_table():
@@ -43,16 +57,111 @@ class Agent:
         actions = np.array(actions)
         return actions
 
+    def warm_up(self, entity_counts=None, batch_sizes=(1,), window: int = 5,
+                tolerance: float = 1.5, max_calls: int = 50, budget: float = 2.0):
+        """
+        Runs dummy observations of every entity count and batch size through the model, so TorchScript
+        profiles and optimizes them here rather than on the first ticks of a match. Each shape runs
+        until its last window calls are within tolerance of their median or max_calls is reached,
+        all of it within budget seconds so the bot is ready before the kickoff countdown ends.
+        entity_counts defaults to the agent's specializations, or the standard 1v1, 2v2 and 3v3 ones.
+        """
+        entity_counts = entity_counts or self.entity_counts or WARMUP_ENTITY_COUNTS
+        rng = np.random.default_rng(0)
+        start = time.perf_counter()
+        shapes = {}
+        for batch_size in batch_sizes:
+            for n_entities in entity_counts:
+                obs = (rng.normal(size=(batch_size, 1, 32)).astype(np.float32),
+                       rng.normal(size=(batch_size, n_entities, 24)).astype(np.float32),
+                       np.zeros((batch_size, n_entities), dtype=np.float32))
+                ms = []
+                settled = False
+                while not settled and len(ms) < max_calls and time.perf_counter() - start < budget:
+                    call_start = time.perf_counter()
+                    self.select_actions(obs, 1)  # Argmax, leaves the sampling noise untouched
+                    ms.append((time.perf_counter() - call_start) * 1000)
+                    recent = ms[-window:]
+                    settled = len(recent) == window and max(recent) <= tolerance * float(np.median(recent))
+                shapes[f"{batch_size}x{n_entities}"] = {
+                    "calls": len(ms),
+                    "settled": settled,
+                    "first_ms": ms[0] if ms else None,
+                    "settled_ms": float(np.median(ms[-window:])) if ms else None,
+                }
+        self.state = None
+        return {
+            "seconds": time.perf_counter() - start,
+            "calls": sum(s["calls"] for s in shapes.values()),
+            "settled": all(s["settled"] for s in shapes.values()),
+            "shapes": shapes,
+        }
+
+    def set_attention_weights(self, enabled: bool):
+        """Switches to the model variant with or without attention weights, loading it the first time"""
+        if enabled not in self._variants:
+            self._variants[enabled] = load_backend(self.actor.name, attention_weights=enabled,
+                                                   entity_counts=self.entity_counts)
+        self.actor = self._variants[enabled]
+
     def act(self, state, beta):
-        state = tuple(torch.from_numpy(s).float() for s in state)
+        _, action, weights = self.select_action(state, beta)
+        return action, weights
+
+    def act_batch(self, state, beta, log_probs: bool = False, chunk_size: int = 256):
+        """
+        Actions for a stack of single-car observations, for offline evaluation.
+        beta is one value for all observations or one per observation. Returns (action indices,
+        lookup table rows, log-probabilities of the chosen actions under the policy or None).
+        The model runs on chunk_size observations at a time and the result is what calling act on
+        each observation in order would give, stochastic actions included.
+        """
+        n = len(state[0])
+        betas = np.broadcast_to(np.asarray(beta, dtype=float), (n,))
+        actions = np.empty(n, dtype=np.int64)
+        chosen_log_probs = np.empty(n, dtype=np.float32) if log_probs else None
+        for start in range(0, n, chunk_size):
+            end = min(start + chunk_size, n)
+            chunk = tuple(as_tensor(s[start:end]) for s in state)
+            with torch.no_grad():
+                out, _ = self.actor(chunk)
+            if isinstance(out, tuple):
+                out = self._stack_heads(out)
+            out = out.reshape(end - start, -1)
+            if log_probs:
+                all_log_probs = torch.log_softmax(out, dim=-1)  # Before select scales out in place
+            chunk_actions = self.selector.select_each(out, betas[start:end])
+            actions[start:end] = chunk_actions.numpy()
+            if log_probs:
+                chosen_log_probs[start:end] = all_log_probs.gather(-1, chunk_actions[:, None])[:, 0].numpy()
+        return actions, self._lookup_table[actions], chosen_log_probs
+
+    def select_action(self, state, beta):
+        # Single observation: action index and its (read-only) lookup table row, no copies
+        actions, weights = self.select_actions(state, beta)
+        index = int(actions[0])
+        return index, self._lookup_table[index], weights
+
+    def select_actions(self, state, beta):
+        # state is a (q, kv, m) tuple stacked along the first axis, one row per car
+        # The tensors share memory with the observation arrays, which the obs builder reuses
+        state = tuple(as_tensor(s) for s in state)
 
         with torch.no_grad():
             out, weights = self.actor(state)
         self.state = state
 
-        out = (out,)
+        if isinstance(out, tuple):
+            out = self._stack_heads(out)
+        actions = self.selector.select(out, beta)
+
+        return actions.numpy().ravel(), weights
+
+    @staticmethod
+    def _stack_heads(out):
+        # Multiple action heads, padded to the widest one
         max_shape = max(o.shape[-1] for o in out)
-        logits = torch.stack(
+        return torch.stack(
             [
                 l
                 if l.shape[-1] == max_shape
@@ -62,20 +171,148 @@ class Agent:
             dim=1
         )
 
-        # beta = 0.5
+
+def as_tensor(array) -> torch.Tensor:
+    """
+    Float32 tensor on the array's memory, no copy for the C-contiguous float32 arrays NextoObsBuilder
+    builds or the tensors TorchObsBuilder builds. Anything else is converted first.
+    """
+    if isinstance(array, torch.Tensor):
+        return array.float()
+    return torch.from_numpy(np.ascontiguousarray(array, dtype=np.float32))
+
+
+class ActionSelector:
+    """
+    Picks actions from logits according to beta.
+    Sampling uses the Gumbel-max trick, argmax(logits + g) with g ~ Gumbel(0, 1) is distributed as
+    Categorical(logits), on noise drawn ahead of time in blocks from a seedable generator.
+    """
+
+    def __init__(self, n_actions: int, seed=None, buffer_size: int = 1024):
+        self.rng = np.random.default_rng(seed)
+        self._noise = np.empty((buffer_size, n_actions), dtype=np.float32)
+        self._noise_t = torch.from_numpy(self._noise)
+        self._pos = buffer_size  # Drawn on first use
+
+    def _refill(self):
+        u = self._noise
+        self.rng.random(out=u, dtype=np.float32)
+        np.log(u, out=u)
+        np.negative(u, out=u)
+        np.log(u, out=u)
+        np.negative(u, out=u)  # -log(-log(u))
+        self._pos = 0
+
+    def gumbel(self, n: int):
+        """
+        (n, n_actions) Gumbel noise, valid until the next call.
+        Rows come from one stream, so the noise does not depend on how draws are split into calls.
+        """
+        if self._pos + n <= len(self._noise):
+            noise = self._noise_t[self._pos: self._pos + n]
+            self._pos += n
+            return noise
+
+        # Crosses into the next block(s)
+        noise = torch.empty((n, self._noise.shape[1]))
+        filled = 0
+        while filled < n:
+            if self._pos == len(self._noise):
+                self._refill()
+            take = min(n - filled, len(self._noise) - self._pos)
+            noise[filled: filled + take] = self._noise_t[self._pos: self._pos + take]
+            self._pos += take
+            filled += take
+        return noise
+
+    def select(self, logits: torch.Tensor, beta):
+        """Action indices over the last axis of logits, which may be modified in place"""
         if beta == 1:
-            actions = np.argmax(logits, axis=-1)
+            return torch.argmax(logits, dim=-1)
         elif beta == -1:
-            actions = np.argmin(logits, axis=-1)
+            return torch.argmin(logits, dim=-1)
+
+        lead_shape = logits.shape[:-1]
+        logits = logits.reshape(-1, logits.shape[-1])
+        noise = self.gumbel(logits.shape[0])
+        if beta == 0:
+            # Uniform over the valid actions
+            scores = noise.masked_fill(~torch.isfinite(logits), float("-inf"))
         else:
-            if beta == 0:
-                logits[torch.isfinite(logits)] = 0
-            else:
-                logits *= math.log((beta + 1) / (1 - beta), 3)
-            dist = Categorical(logits=logits)
-            actions = dist.sample()
+            logits *= math.log((beta + 1) / (1 - beta), 3)
+            scores = logits.add_(noise)
+        return torch.argmax(scores, dim=-1).reshape(lead_shape)
+
+    def select_each(self, logits: torch.Tensor, betas: np.ndarray):
+        """
+        Action index for every row of (n, n_actions) logits with that row's beta, the same as calling
+        select on the rows one by one. logits may be modified in place.
+        """
+        best = betas == 1
+        worst = betas == -1
+        actions = torch.argmax(logits, dim=-1)
+        if worst.any():
+            worst_rows = torch.from_numpy(np.flatnonzero(worst))
+            actions[worst_rows] = torch.argmin(logits[worst_rows], dim=-1)
+
+        rows = torch.from_numpy(np.flatnonzero(~(best | worst)))
+        if len(rows) == 0:
+            return actions
+        # Only the sampled rows draw noise, in row order, like they would one call at a time
+        noise = self.gumbel(len(rows))
+        row_betas = betas[rows.numpy()]
+        sampled = logits[rows]
+        uniform = torch.from_numpy(row_betas == 0)
+        scale = torch.tensor([0.0 if b == 0 else math.log((b + 1) / (1 - b), 3) for b in row_betas],
+                             dtype=logits.dtype)
+        scores = (sampled * scale[:, None]).add_(noise)
+        if uniform.any():
+            scores[uniform] = noise[uniform].masked_fill(~torch.isfinite(sampled[uniform]), float("-inf"))
+        actions[rows] = torch.argmax(scores, dim=-1)
+        return actions
+
+
+def make_agent(backend: str = TORCHSCRIPT_BACKEND, logger=None, seed=None, instances: int = None,
+               attention_weights: bool = True, entity_counts=None, threads=None) -> Agent:
+    """
+    Agent on the requested backend, falling back to TorchScript if that backend cannot be loaded.
+    With instances set, uses the thread counts calibrated for that many instances if there are any,
+    explicit (intra_op, inter_op) threads take precedence.
+    """
+    agent = None
+    if backend != TORCHSCRIPT_BACKEND:
+        try:
+            agent = Agent(backend, seed, threads or _tuned_threads(backend, instances, logger),
+                          attention_weights=attention_weights, entity_counts=entity_counts)
+        except (ImportError, FileNotFoundError, ValueError) as e:
+            if logger is not None:
+                logger.warning(f"Inference backend '{backend}' unavailable ({e}), using {TORCHSCRIPT_BACKEND}")
+    if agent is None:
+        agent = Agent(seed=seed, threads=threads or _tuned_threads(TORCHSCRIPT_BACKEND, instances, logger),
+                      attention_weights=attention_weights, entity_counts=entity_counts)
+    if logger is not None:
+        log_warmup(agent.warmup_stats, logger)
+    return agent
 
-        # print(Categorical(logits=logits).sample())
-        parsed = self._lookup_table[actions.numpy().item()]
 
-        return parsed, weights
+def log_warmup(stats, logger):
+    settled = ", ".join(f"{shape} {s['first_ms']:.1f} -> {s['settled_ms']:.2f} ms"
+                        for shape, s in stats["shapes"].items() if s["calls"])
+    message = f"Model warmed up in {stats['seconds'] * 1000:.0f} ms over {stats['calls']} calls ({settled})"
+    if stats["settled"]:
+        logger.info(message)
+    else:
+        logger.warning(message + ", latency had not settled for every shape")
+
+
+def _tuned_threads(backend: str, instances: int, logger):
+    if instances is None:
+        return None
+    threads = cached_threads(backend, instances)
+    if logger is not None:
+        if threads is None:
+            logger.info(f"No calibrated thread counts for {backend} x {instances}, using 1 thread")
+        else:
+            logger.info(f"Using {threads[0]} intra-op and {threads[1]} inter-op threads for {backend} x {instances}")
+    return threads
@@ -0,0 +1,124 @@
+"""
+Asynchronous inference for Nexto.
+get_output hands a snapshot of the encoded state to a worker thread and keeps applying the last
+action it has, the worker's action is picked up on the first tick after it is done.
+"""
+
+import threading
+import time
+from collections import Counter
+
+
+class InferenceJob:
+    """Everything the worker needs to pick an action, copied off the tick thread"""
+
+    def __init__(self, tick, encoded_state, prev_action, beta, ticks_elapsed, positions=None, record=None):
+        self.tick = tick  # Tick count of the snapshot, for staleness
+        self.encoded_state = encoded_state
+        self.prev_action = prev_action
+        self.beta = beta
+        self.ticks_elapsed = ticks_elapsed
+        self.positions = positions  # For rendering the attention weights
+        self.record = record  # Tick record to complete with the action, see TickRecorder.make_record
+
+
+class InferenceResult:
+    def __init__(self, job, action_index, raw_action, weights, obs_seconds, forward_seconds):
+        self.job = job
+        self.action_index = action_index
+        self.raw_action = raw_action
+        self.weights = weights
+        # Time the worker spent building the observation and in the model
+        self.obs_seconds = obs_seconds
+        self.forward_seconds = forward_seconds
+        self.seconds = obs_seconds + forward_seconds
+
+
+class AsyncInferenceWorker:
+    """
+    Runs build_obs and the model on its own thread.
+    Holds at most one pending job: a job submitted while the previous one is still waiting
+    replaces it, so the worker always starts on the newest state.
+    """
+
+    def __init__(self, agent, obs_builder, recorder=None):
+        self.agent = agent
+        self.obs_builder = obs_builder  # Only used from the worker thread once this is running
+        self.recorder = recorder
+        self.n_dropped = 0  # Jobs replaced before the worker got to them
+
+        self._cond = threading.Condition()
+        self._job = None
+        self._result = None
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="nexto-inference", daemon=True)
+        self._thread.start()
+
+    def submit(self, job: InferenceJob):
+        with self._cond:
+            if self._job is not None:
+                self.n_dropped += 1
+            self._job = job
+            self._cond.notify()
+
+    def poll(self):
+        """Latest finished result, or None if nothing finished since the last poll"""
+        with self._cond:
+            result, self._result = self._result, None
+        return result
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._job is None and not self._stop:
+                    self._cond.wait()
+                if self._stop:
+                    return
+                job, self._job = self._job, None
+
+            start = time.perf_counter()
+            obs = self.obs_builder.single_build_obs(job.encoded_state, 0)
+            self.obs_builder.add_actions((obs,), job.prev_action, 0)
+            obs_done = time.perf_counter()
+            action_index, raw_action, weights = self.agent.select_action(obs, job.beta)
+            forward_done = time.perf_counter()
+
+            if job.record is not None and self.recorder is not None:
+                job.record["action"] = action_index
+                self.recorder.write(job.record)
+            with self._cond:
+                self._result = InferenceResult(job, action_index, raw_action, weights,
+                                               obs_done - start, forward_done - obs_done)
+
+    def close(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        self._thread.join()
+
+
+class StalenessTracker:
+    """Ticks between the state an action was computed from and the tick it is applied"""
+
+    def __init__(self):
+        self.last = 0
+        self.max = 0
+        self.count = 0
+        self.total = 0
+        self.histogram = Counter()
+
+    def add(self, ticks: int):
+        self.last = ticks
+        self.max = max(self.max, ticks)
+        self.count += 1
+        self.total += ticks
+        self.histogram[ticks] += 1
+
+    def summary(self):
+        return {
+            "last": self.last,
+            "max": self.max,
+            "mean": self.total / self.count if self.count else 0.0,
+            "count": self.count,
+            "histogram": dict(sorted(self.histogram.items())),
+        }
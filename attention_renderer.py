@@ -0,0 +1,82 @@
+"""
+Rendering of Nexto's attention weights, off the tick thread.
+get_output only hands over the latest weights and car/ball positions; averaging the layers, picking
+the most attended entities and the renderer calls happen on a separate thread at a fixed rate.
+"""
+
+import threading
+
+import numpy as np
+
+from .nexto_obs import BOOST_LOCATIONS
+
+
+class AttentionRenderer:
+    """
+    Draws a numbered line from the car to each of the n entities it attends to most, at most
+    refresh_rate times per second. Only the newest submitted decision is drawn, older ones that
+    were not drawn yet are skipped.
+    """
+
+    def __init__(self, renderer, team: int, refresh_rate: float = 10.0, n: int = 3,
+                 boost_locations=BOOST_LOCATIONS):
+        self.renderer = renderer
+        self.n = n
+        self.interval = 1 / refresh_rate
+        self._invert = np.array([-1, -1, 1]) if team == 1 else np.ones(3)
+        self._boost_positions = np.asarray(boost_locations, dtype=float) * self._invert
+        self._positions = {}  # Entity positions per number of cars, boost pad rows filled in once
+
+        self._latest = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="nexto-attention-renderer", daemon=True)
+        self._thread.start()
+
+    def submit(self, weights, positions: np.ndarray):
+        """weights as returned by the model, positions of the cars in observation order then the ball"""
+        # Replaced as one tuple, so the render thread never pairs weights with another decision's positions
+        self._latest = weights, positions
+
+    def _entity_positions(self, positions: np.ndarray):
+        n_cars = len(positions) - 1
+        entities = self._positions.get(n_cars)
+        if entities is None:
+            entities = np.empty((len(positions) + len(self._boost_positions), 3))
+            entities[len(positions):] = self._boost_positions
+            self._positions[n_cars] = entities
+        np.multiply(positions, self._invert, out=entities[:len(positions)])
+        return entities
+
+    def top_entities(self, mean_weights: np.ndarray):
+        """Indices of the n most attended entities other than the car itself, most attended first"""
+        others = mean_weights[1:]
+        k = min(self.n, len(others))
+        top = np.argpartition(-others, k - 1)[:k]
+        return top[np.argsort(-others[top])] + 1
+
+    def draw(self, weights, positions: np.ndarray):
+        mean_weights = np.mean([w[0, 0].numpy() for w in weights], axis=0)
+        entities = self._entity_positions(positions)
+        # Colors are scaled by the largest weight not counting entity 1's
+        mx = max(mean_weights[0], mean_weights[2:].max())
+
+        self.renderer.begin_rendering('attention_weights')
+        loc = entities[0]
+        for c, i in enumerate(self.top_entities(mean_weights), start=1):
+            weight = mean_weights[i] / mx
+            dest = entities[i]
+            color = self.renderer.create_color(255, round(255 * (1 - weight)), round(255),
+                                               round(255 * (1 - weight)))
+            self.renderer.draw_string_3d(dest, 2, 2, str(c), color)
+            self.renderer.draw_line_3d(loc, dest, color)
+        self.renderer.end_rendering()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            latest, self._latest = self._latest, None
+            if latest is not None:
+                self.draw(*latest)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
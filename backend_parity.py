@@ -0,0 +1,107 @@
+"""
+Parity and speed checks for the inference backends.
+Runs every backend over the same observation set, checks that each picks the same argmax
+action as the TorchScript module and reports the time per forward pass.
+A backend that cannot be loaded (missing runtime or model file) fails the check, unless --allow-missing.
+
+Run with: python -m <bot package>.backend_parity
+"""
+
+import argparse
+import sys
+import timeit
+
+import numpy as np
+import torch
+
+from .agent import Agent
+from .inference_backends import BACKENDS, INT8_BACKEND, TORCHSCRIPT_BACKEND
+from .nexto_obs import NextoObsBuilder
+from .synthetic_packets import ROSTERS, make_states
+
+
+def build_observations(n_states: int):
+    """One (q, kv, m) batch per roster, every player's observation of every synthetic state"""
+    observations = {}
+    for roster, n_cars in ROSTERS.items():
+        builder = NextoObsBuilder()
+        batches = []
+        for state in make_states(n_states, n_cars, seed=n_cars):
+            obs = builder.batched_build_obs(builder.encoder.encode(state))
+            batches.append(tuple(np.concatenate([o[k] for o in obs]) for k in range(3)))
+        observations[roster] = tuple(np.concatenate([b[k] for b in batches]) for k in range(3))
+    return observations
+
+
+def save_observations(path: str, observations):
+    np.savez_compressed(path, **{f"{roster}_{name}": array
+                                 for roster, obs in observations.items()
+                                 for name, array in zip("q kv m".split(), obs)})
+
+
+def load_observations(path: str):
+    with np.load(path) as data:
+        rosters = sorted({key.rsplit("_", 1)[0] for key in data.files})
+        return {roster: tuple(data[f"{roster}_{name}"] for name in "q kv m".split()) for roster in rosters}
+
+
+def check_backend(agent: Agent, reference: Agent, obs, batch_size: int, number: int):
+    actions, _ = agent.select_actions(obs, 1)
+    expected, _ = reference.select_actions(obs, 1)
+    with torch.no_grad():
+        tensors = tuple(torch.from_numpy(o) for o in obs)
+        logits_diff = float((agent.actor(tensors)[0] - reference.actor(tensors)[0]).abs().max())
+
+    single = tuple(o[:batch_size] for o in obs)
+    seconds = min(timeit.repeat(lambda: agent.select_actions(single, 1), number=number, repeat=5)) / number
+    return {
+        "action_agreement": float(np.mean(actions == expected)),
+        "max_logits_diff": logits_diff,
+        "us_per_call": seconds * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inference backend parity checks")
+    # int8 is lossy by design and has its own agreement gate in quantize_actor.py
+    parser.add_argument("--backends", nargs="+", default=[b for b in BACKENDS if b != INT8_BACKEND],
+                        choices=list(BACKENDS))
+    parser.add_argument("--min-agreement", type=float, default=1.0,
+                        help="Share of actions that must match the torchscript backend")
+    parser.add_argument("--states", type=int, default=200, help="Number of synthetic states per roster")
+    parser.add_argument("--obs-file", type=str, default=None,
+                        help="Observation set (.npz) to check against instead of synthetic states")
+    parser.add_argument("--save-obs", type=str, default=None, help="Write the observation set used to this .npz")
+    parser.add_argument("--batch-size", type=int, default=1, help="Batch size of the timed forward passes")
+    parser.add_argument("--number", type=int, default=200, help="Forward passes per timing")
+    parser.add_argument("--allow-missing", action="store_true",
+                        help="Skip backends that cannot be loaded (missing runtime or model file) instead of failing")
+    args = parser.parse_args()
+
+    observations = load_observations(args.obs_file) if args.obs_file else build_observations(args.states)
+    if args.save_obs:
+        save_observations(args.save_obs, observations)
+
+    reference = Agent(TORCHSCRIPT_BACKEND)
+    ok = True
+    for name in args.backends:
+        try:
+            agent = Agent(name)
+        except (ImportError, FileNotFoundError) as e:
+            passed = args.allow_missing
+            ok &= passed
+            print(f"{name:<12} unavailable: {e} {'SKIPPED' if passed else 'FAIL'}")
+            continue
+        for roster, obs in observations.items():
+            result = check_backend(agent, reference, obs, args.batch_size, args.number)
+            passed = result["action_agreement"] >= args.min_agreement
+            ok &= passed
+            print(f"{name:<12} {roster} action_agreement={result['action_agreement']:.2%} "
+                  f"max_logits_diff={result['max_logits_diff']:.3g} "
+                  f"{result['us_per_call']:.0f} us/call {'OK' if passed else 'FAIL'}")
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Microbenchmark: the baseline encode_gamestate (tests/obs_reference.py) against GameStateEncoder.
+The encoder is timed in both layouts, the quaternion one encodes the same values as the baseline
+and the rotation one stores the forward and up vectors instead, each reported on its own row.
+
+Run with: python -m <bot package>.bench_encoder
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+
+from .nexto_obs import GameStateEncoder, QUATERNION_LAYOUT, ROTATION_LAYOUT
+from .tests.obs_reference import encode_gamestate
+from .synthetic_packets import ROSTERS, make_states
+
+
+def _per_state_us(fn, n_states, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / (number * n_states) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the game state encoders")
+    parser.add_argument("--states", type=int, default=256, help="Number of synthetic states per roster")
+    parser.add_argument("--number", type=int, default=10, help="Passes over the states per timing")
+    args = parser.parse_args()
+
+    print(f"{'roster':<8}{'layout':<12}{'encode_gamestate':>18}{'encode':>10}{'speedup':>10}  (us/state)")
+    for roster, n_cars in ROSTERS.items():
+        states = make_states(args.states, n_cars)
+
+        def run_baseline():
+            for state in states:
+                np.expand_dims(encode_gamestate(state), axis=0)
+
+        t_baseline = _per_state_us(run_baseline, len(states), args.number)
+        for layout in (QUATERNION_LAYOUT, ROTATION_LAYOUT):
+            encoder = GameStateEncoder(layout=layout)
+
+            def run_encode():
+                for state in states:
+                    encoder.encode(state)
+
+            t_encode = _per_state_us(run_encode, len(states), args.number)
+            print(f"{roster:<8}{layout:<12}{t_baseline:>18.1f}{t_encode:>10.1f}{t_baseline / t_encode:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
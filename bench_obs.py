@@ -0,0 +1,100 @@
+"""
+Microbenchmark: the numpy NextoObsBuilder against the torch TorchObsBuilder.
+Both builders get the same encoded states, from a tick recording or from synthetic states of every
+roster, and are timed up to the tensors the model takes: one player's observation as in
+get_output, and every player's at once as in the hivemind.
+
+Run with: python -m <bot package>.bench_obs [--recording path/to/recording.ticks]
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+import torch
+
+from .agent import as_tensor
+from .nexto_obs import NUMPY_OBS_BUILDER, OBS_BUILDERS, ROSTER_BUCKETS, make_obs_builder
+from .synthetic_packets import ROSTERS, make_field_info, make_states
+from .tick_recorder import read_recording
+
+
+def recorded_states(path: str):
+    """(builder kwargs, encoded states) of a recording's action ticks"""
+    header, records = read_recording(path)
+    kwargs = {"field_info": make_field_info(header["boost_locations"]), "layout": header["layout"],
+              "roster_buckets": header.get("roster_buckets")}
+    return kwargs, [record["state"] for record in records if record["action"] is not None]
+
+
+def synthetic_states(n_states: int, n_cars: int):
+    builder = make_obs_builder(NUMPY_OBS_BUILDER)
+    return {"roster_buckets": ROSTER_BUCKETS}, [builder.encoder.encode(state).copy()
+                                                for state in make_states(n_states, n_cars, seed=n_cars)]
+
+
+def _per_state_us(fn, n_states, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / (number * n_states) * 1e6
+
+
+def time_builder(name: str, kwargs, states, number: int):
+    """us per state to build one player's observation and to build every player's"""
+    builder = make_obs_builder(name, **kwargs)
+    action = np.zeros(8)
+
+    def run_single():
+        for encoded in states:
+            obs = builder.single_build_obs(encoded, 0)
+            builder.add_actions((obs,), action, 0)
+            tuple(as_tensor(o) for o in obs)
+
+    def run_batched():
+        for encoded in states:
+            obs = builder.batched_build_obs(encoded)
+            builder.add_actions(obs, [action] * len(obs))
+            [tuple(as_tensor(o) for o in player_obs) for player_obs in obs]
+
+    single = _per_state_us(run_single, len(states), number)
+    batched = _per_state_us(run_batched, len(states), number)
+    return single, batched
+
+
+def max_diff(kwargs, states):
+    """Largest difference between the builders' observations of every player of every state"""
+    builders = [make_obs_builder(name, **kwargs) for name in OBS_BUILDERS]
+    diff = 0.0
+    for encoded in states:
+        numpy_obs, torch_obs = (builder.batched_build_obs(encoded) for builder in builders)
+        for expected, actual in zip(numpy_obs, torch_obs):
+            for e, a in zip(expected, actual):
+                a = np.asarray(a)
+                finite = np.isfinite(e)  # -inf in the mask of padded cars
+                diff = max(diff, float(np.abs(e[finite] - a[finite]).max()))
+    return diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the numpy and torch observation builders")
+    parser.add_argument("--recording", type=str, default=None,
+                        help="Tick recording to take the states from, synthetic states of every roster if not set")
+    parser.add_argument("--states", type=int, default=256, help="Number of synthetic states per roster")
+    parser.add_argument("--number", type=int, default=5, help="Passes over the states per timing")
+    args = parser.parse_args()
+    torch.set_num_threads(1)  # Like the bot without a thread calibration
+
+    if args.recording:
+        kwargs, states = recorded_states(args.recording)
+        by_roster = {"recorded": (kwargs, states)} if states else {}
+    else:
+        by_roster = {roster: synthetic_states(args.states, n_cars) for roster, n_cars in ROSTERS.items()}
+
+    print(f"{'states':<10}{'builder':<8}{'single':>9}{'all players':>13}{'max diff':>11}  (us/state)")
+    for roster, (kwargs, states) in by_roster.items():
+        diff = max_diff(kwargs, states)
+        for name in OBS_BUILDERS:
+            single, batched = time_builder(name, kwargs, states, args.number)
+            print(f"{roster:<10}{name:<8}{single:>9.1f}{batched:>13.1f}{diff:>11.2g}")
+
+
+if __name__ == "__main__":
+    main()
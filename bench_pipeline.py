@@ -0,0 +1,142 @@
+"""
+Per-stage latency benchmark of the Nexto tick pipeline, without Rocket League.
+Feeds synthetic packets, or the packets of a tick recording's action ticks, through a real Nexto
+instance, one action per tick, timing each stage of get_output separately, and reports
+p50/p95/p99/max per stage and roster.
+
+Run with: python -m <bot package>.bench_pipeline [--recording path/to/recording.ticks] --output bench.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from .bot import Nexto
+from .inference_backends import BACKENDS, TORCHSCRIPT_BACKEND
+from .synthetic_packets import ROSTERS, make_field_info, make_packet, recorded_packet
+from .tick_recorder import read_recording
+
+# Stages of Nexto.get_output's action ticks in order, build_obs includes encoding the state (see
+# bench_encoder for the encoder alone); batched_build_obs is the hivemind's path and not part of total
+STAGES = ("decode", "build_obs", "act", "smoothing", "update_controls", "total", "batched_build_obs")
+
+
+def make_bot(backend: str, index: int = 0, team: int = 0, field_info=None) -> Nexto:
+    with contextlib.redirect_stdout(io.StringIO()):  # Skip the greeting
+        bot = Nexto("Nexto", team, index)
+    bot.inference_backend = backend
+    bot.metrics_interval = 0  # No metrics publisher, the benchmark times the stages itself
+    bot.initialize_agent(field_info or make_field_info())
+    return bot
+
+
+def recorded_packets(path: str):
+    """(recording header, packets of the recording's action ticks)"""
+    header, records = read_recording(path)
+    return header, [recorded_packet(record, header) for record in records if record["action"] is not None]
+
+
+def time_ticks(bot: Nexto, packets, n_warmup: int):
+    """Nanoseconds per stage for every packet after the first n_warmup"""
+    timings = {stage: [] for stage in STAGES}
+    for i, packet in enumerate(packets):
+        # Same steps as an action tick of get_output, without its metrics, rendering and recording
+        t0 = time.perf_counter_ns()
+        ticks_elapsed = round((packet.game_info.seconds_elapsed - bot.prev_time) * 120)
+        bot.prev_time = packet.game_info.seconds_elapsed
+        bot.game_state.decode(packet, ticks_elapsed)
+        bot.order_players()
+        t1 = time.perf_counter_ns()
+        obs = bot.obs_builder.build_obs(bot.game_state.players[0], bot.game_state, bot.action)
+        t2 = time.perf_counter_ns()
+        _, raw_action, _ = bot.agent.select_action(obs, bot.get_beta(packet))
+        t3 = time.perf_counter_ns()
+        bot.action = bot.smooth_action(raw_action, ticks_elapsed)
+        t4 = time.perf_counter_ns()
+        bot.update_controls(bot.action)
+        t5 = time.perf_counter_ns()
+        bot.obs_builder.batched_build_obs(bot.obs_builder.current_encoded)
+        t6 = time.perf_counter_ns()
+
+        if i >= n_warmup:
+            for stage, t in zip(STAGES, (t1 - t0, t2 - t1, t3 - t2, t4 - t3, t5 - t4, t5 - t0, t6 - t5)):
+                timings[stage].append(t)
+    return timings
+
+
+def summarize(ns):
+    us = np.asarray(ns) / 1000
+    p50, p95, p99 = np.percentile(us, [50, 95, 99])
+    return {"p50_us": p50, "p95_us": p95, "p99_us": p99, "max_us": us.max(), "mean_us": us.mean()}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-stage latency of the Nexto tick pipeline")
+    parser.add_argument("--recording", type=str, default=None,
+                        help="Tick recording to take the packets from, synthetic packets of every roster if not set")
+    parser.add_argument("--ticks", type=int, default=2000, help="Timed action ticks per roster, synthetic only")
+    parser.add_argument("--warmup", type=int, default=100, help="Untimed ticks before measuring")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backend", type=str, default=TORCHSCRIPT_BACKEND, choices=list(BACKENDS))
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "machine": platform.platform(),
+        "processor": platform.processor(),
+        "backend": args.backend,
+        "recording": args.recording,
+        "ticks": args.ticks,
+        "rosters": {},
+    }
+
+    runs = {}
+    if args.recording:
+        header, packets = recorded_packets(args.recording)
+        if len(packets) <= args.warmup:
+            parser.error(f"{args.recording} has {len(packets)} action ticks, not more than --warmup")
+        results["ticks"] = len(packets) - args.warmup
+        field_info = make_field_info(header["boost_locations"])
+        runs["recording"] = (make_bot(args.backend, header["index"], header["team"], field_info), packets)
+    else:
+        for roster, n_cars in ROSTERS.items():
+            bot = make_bot(args.backend)
+            rng = np.random.default_rng(args.seed)
+            runs[roster] = (bot, [make_packet(rng, n_cars, (i + 1) * bot.tick_skip / 120)
+                                  for i in range(args.warmup + args.ticks)])
+
+    print(f"{'roster':<10}{'stage':<20}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>10}  (us)")
+    for roster, (bot, packets) in runs.items():
+        stats = {stage: summarize(ns) for stage, ns in time_ticks(bot, packets, args.warmup).items()}
+        results["rosters"][roster] = stats
+        for stage, s in stats.items():
+            print(f"{roster:<10}{stage:<20}{s['p50_us']:>9.1f}{s['p95_us']:>9.1f}{s['p99_us']:>9.1f}{s['max_us']:>10.1f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,21 @@
 import numpy as np
 import torch
-from rlbot.agents.base_agent import BaseAgent, SimpleControllerState
+from rlbot.agents.base_agent import BaseAgent, SimpleControllerState, BOT_CONFIG_AGENT_HEADER
+from rlbot.parsing.custom_config import ConfigHeader, ConfigObject
 from rlbot.utils.structures.game_data_struct import GameTickPacket
 from rlbot.utils.structures.quick_chats import QuickChats
 from rlgym_compat import GameState
-import math, random
-
-from .agent import Agent
-from .nexto_obs import NextoObsBuilder, BOOST_LOCATIONS
+import math, os, random, time
+
+from .agent import Agent, make_agent
+from .attention_renderer import AttentionRenderer
+from .async_inference import AsyncInferenceWorker, InferenceJob, StalenessTracker
+from .inference_backends import BACKENDS, TORCHSCRIPT_BACKEND
+from .inference_broker import BrokerClient, DEFAULT_BROKER_NAME
+from .metrics import BotMetrics, MetricsPublisher, DEFAULT_METRICS_DIRECTORY, METRICS_SUFFIX
+from .nexto_obs import NUMPY_OBS_BUILDER, OBS_BUILDERS, ROSTER_BUCKETS, make_obs_builder
+from .tick_recorder import TickRecorder, RECORDING_SUFFIX
+from .tick_scheduler import TickScheduler
 
 KICKOFF_CONTROLS = (
         11 * 4 * [SimpleControllerState(throttle=1, boost=True)]
@@ -31,25 +39,58 @@ class Nexto(BaseAgent):
         super().__init__(name, team, index)
 
         self.obs_builder = None
-        self.agent = Agent()
+        self.agent = None
         self.tick_skip = max(1, int(tick_skip))
+        # Decides when to act, tick_skip stays fixed unless min/max_tick_skip are configured around it
+        self.scheduler = TickScheduler(self.tick_skip)
 
         # Beta controls randomness:
         # 1=best action, 0.5=sampling from probability, 0=random, -1=worst action, or anywhere inbetween
         self.beta = beta
         self.render = render
+        # Attention weights are drawn on their own thread at most render_refresh_rate times per second
+        self.render_refresh_rate = 10.0
+        self.attention_renderer = None
         self.hardcoded_kickoffs = hardcoded_kickoffs
         self.stochastic_kickoffs = stochastic_kickoffs
 
+        # Shared inference daemon started by the loader, see inference_broker.py
+        self.use_inference_broker = False
+        self.inference_broker_name = DEFAULT_BROKER_NAME
+        self.inference_backend = TORCHSCRIPT_BACKEND
+        # Nexto processes running the model on this machine, picks the calibrated torch thread counts
+        self.model_instances = 1
+        # numpy or torch observation builder, see make_obs_builder
+        self.obs_builder_name = NUMPY_OBS_BUILDER
+        # Compiled rotation kernels for the numpy builder, see obs_kernels
+        self.use_numba = False
+
+        # Run build_obs and the model on a worker thread instead of inside get_output
+        self.async_inference = False
+        self.inference_worker = None
+
+        # Hot-path counters and latencies, published to metrics_directory for the loader
+        self.metrics = BotMetrics()
+        self.metrics_interval = 5.0
+        self.metrics_directory = ''
+        self.metrics_publisher = None
+
+        # Tick recording for replay.py, off unless record_directory is set
+        self.record_directory = ''
+        self.recorder = None
+
         self.game_state: GameState = None
         self.controls = None
         self.action = None
-        self.update_action = True
-        self.ticks = 0
         self.prev_time = 0
         self.kickoff_index = -1
         self.field_info = None
 
+        # Ticks between the state each applied action was computed from and the tick it is applied
+        self.tick_count = 0
+        self.action_tick = 0
+        self.staleness = StalenessTracker()
+
         # Anti-oscillation smoothing
         self.prev_action = np.zeros(8)
         self.steer_flip_cooldown = 0   # ticks remaining before allowing next sign flip
@@ -74,126 +115,321 @@ class Nexto(BaseAgent):
               "Stable 240/360 is second best if that's better for your eyes")
         print("Also check out the RLGym Twitch stream to watch live bot training and occasional showmatches!")
 
+    @staticmethod
+    def create_agent_configurations(config: ConfigObject):
+        params = config.get_header(BOT_CONFIG_AGENT_HEADER)
+        params.add_value('use_inference_broker', bool, default=False,
+                         description='Send observations to the shared inference broker instead of '
+                                     'loading the model in this process')
+        params.add_value('inference_broker_name', str, default=DEFAULT_BROKER_NAME,
+                         description='Shared memory name of the inference broker')
+        params.add_value('inference_broker_window_ms', float, default=0.5,
+                         description='Batching window of the inference broker, read by the loader')
+        params.add_value('inference_backend', str, default=TORCHSCRIPT_BACKEND,
+                         description=f'Model runtime, one of: {", ".join(BACKENDS)}')
+        params.add_value('auto_tune_threads', bool, default=False,
+                         description='Calibrate the torch thread counts before injecting when there is no '
+                                     'calibration yet, read by the loader')
+        params.add_value('model_instances', int, default=1,
+                         description='Nexto processes running the model on this machine, for the '
+                                     'thread counts calibrated by thread_tuner.py')
+        params.add_value('obs_builder', str, default=NUMPY_OBS_BUILDER,
+                         description=f'Observation builder, one of: {", ".join(OBS_BUILDERS)}')
+        params.add_value('use_numba', bool, default=False,
+                         description='Run the numpy builder\'s rotation math as numba-compiled loops, needs numba')
+        params.add_value('async_inference', bool, default=False,
+                         description='Pick actions on a worker thread so get_output never waits on the model')
+        params.add_value('min_tick_skip', int, default=6,
+                         description='Fewest ticks between actions the scheduler may go down to')
+        params.add_value('max_tick_skip', int, default=6,
+                         description='Most ticks between actions the scheduler may go up to')
+        params.add_value('max_inference_load', float, default=0.5,
+                         description='Share of frame time deciding may take on average before acting less often')
+        params.add_value('render_refresh_rate', float, default=10.0,
+                         description='Times per second the attention weights are redrawn when rendering')
+        params.add_value('metrics_interval', float, default=5.0,
+                         description='Seconds between metrics snapshots, 0 to disable publishing')
+        params.add_value('metrics_directory', str, default='',
+                         description='Directory to publish metrics to, empty for nexto-metrics in the temp directory')
+        params.add_value('record_directory', str, default='',
+                         description='Directory to write tick recordings to, empty to disable recording')
+
+    def load_config(self, config_header: ConfigHeader):
+        self.use_inference_broker = config_header.getboolean('use_inference_broker')
+        self.inference_broker_name = config_header.get('inference_broker_name')
+        self.inference_backend = config_header.get('inference_backend')
+        self.model_instances = config_header.getint('model_instances')
+        self.obs_builder_name = config_header.get('obs_builder')
+        self.use_numba = config_header.getboolean('use_numba')
+        self.async_inference = config_header.getboolean('async_inference')
+        self.record_directory = config_header.get('record_directory')
+        self.render_refresh_rate = config_header.getfloat('render_refresh_rate')
+        self.metrics_interval = config_header.getfloat('metrics_interval')
+        self.metrics_directory = config_header.get('metrics_directory')
+        self.scheduler = TickScheduler(self.tick_skip,
+                                       min_tick_skip=config_header.getint('min_tick_skip'),
+                                       max_tick_skip=config_header.getint('max_tick_skip'),
+                                       max_load=config_header.getfloat('max_inference_load'))
+
     def initialize_agent(self, field_info):
+        # Recorded bots sample with a known seed so stochastic actions replay identically
+        seed = random.getrandbits(63) if self.record_directory else None
+        if self.use_inference_broker:
+            try:
+                self.agent = BrokerClient(self.index, name=self.inference_broker_name)
+            except (FileNotFoundError, TimeoutError, ValueError) as e:
+                self.logger.warning(f"Inference broker unavailable ({e}), running the model in-process")
+
         # Initialize the rlgym GameState object now that the game is active and the info is available
         self.field_info = field_info
-        self.obs_builder = NextoObsBuilder(field_info=self.field_info)
+        # Padded to fixed roster sizes, so cars joining or leaving never show the model a new shape
+        self.obs_builder = make_obs_builder(self.obs_builder_name, self.logger, self.use_numba,
+                                            field_info=self.field_info, roster_buckets=ROSTER_BUCKETS)
+        self.obs_builder.prepare()
+        if self.agent is None:
+            # The attention weights are only computed for rendering
+            self.agent = make_agent(self.inference_backend, self.logger, seed, self.model_instances,
+                                    attention_weights=self.render,
+                                    entity_counts=self.obs_builder.bucket_entity_counts())
         self.game_state = GameState(self.field_info)
-        self.ticks = self.tick_skip  # So we take an action the first tick
+        self.scheduler.reset()
         self.prev_time = 0
         self.controls = SimpleControllerState()
         self.action = np.zeros(8)
         self.prev_action = np.zeros(8)
-        self.update_action = True
         self.kickoff_index = -1
         self.steer_flip_cooldown = 0
-
-    def render_attention_weights(self, weights, positions, n=3):
+        self.tick_count = 0
+        self.action_tick = 0
+
+        if self.record_directory:
+            self.start_recording(seed)
+        if self.async_inference:
+            self.inference_worker = AsyncInferenceWorker(self.agent, self.obs_builder, self.recorder)
+        if self.metrics_interval > 0:
+            self.start_metrics()
+
+    def start_recording(self, seed):
+        os.makedirs(self.record_directory, exist_ok=True)
+        path = os.path.join(self.record_directory,
+                            f"nexto-{self.index}-{time.strftime('%Y%m%d-%H%M%S')}{RECORDING_SUFFIX}")
+        header = {
+            "index": self.index,
+            "team": self.team,
+            "tick_skip": self.tick_skip,
+            "seed": seed,
+            # Stochastic actions through the broker come from its own generator and will not replay
+            "backend": self.agent.actor.name if isinstance(self.agent, Agent) else None,
+            "layout": self.obs_builder.encoder.layout,
+            "boost_locations": self.obs_builder._boost_locations.tolist(),
+            "roster_buckets": list(self.obs_builder.roster_buckets),
+            "obs_builder": self.obs_builder_name,
+        }
+        if header["backend"] is None:
+            self.logger.warning("Recording with the inference broker, stochastic actions will not replay")
+            header["backend"] = self.inference_backend
+        self.recorder = TickRecorder(path, header)
+        self.logger.info(f"Recording ticks to {path}")
+
+    def start_metrics(self):
+        directory = self.metrics_directory or DEFAULT_METRICS_DIRECTORY
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"nexto-{self.index}{METRICS_SUFFIX}")
+        self.metrics_publisher = MetricsPublisher(path, self.metrics_snapshot, self.metrics_interval)
+
+    def metrics_snapshot(self):
+        snapshot = self.metrics.snapshot()
+        snapshot.update({
+            "name": self.name,
+            "index": self.index,
+            "team": self.team,
+            "tick_skip": self.scheduler.tick_skip,
+            "missed_deadlines": self.scheduler.n_missed_deadlines,
+            "recent_missed_deadlines": list(self.scheduler.missed_deadlines)[-10:],
+            "staleness": self.staleness.summary(),
+            "async_jobs_dropped": self.inference_worker.n_dropped if self.inference_worker is not None else 0,
+            "warmup": self.agent.warmup_stats if isinstance(self.agent, Agent) else None,
+        })
+        return snapshot
+
+    def retire(self):
+        if self.attention_renderer is not None:
+            self.attention_renderer.close()
+            self.attention_renderer = None
+        if self.metrics_publisher is not None:
+            self.metrics_publisher.close()
+            self.metrics_publisher = None
+        if self.inference_worker is not None:
+            self.inference_worker.close()
+            self.inference_worker = None
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def entity_positions(self):
+        # Cars in observation order, padded like the observation, then the ball; the renderer adds the boost pads
+        players = self.game_state.players
+        positions = np.zeros((self.obs_builder.lim_players(len(players)) + 1, 3))
+        for i, p in enumerate(players):
+            positions[i] = p.car_data.position
+        positions[-1] = self.game_state.ball.position
+        return positions
+
+    def render_attention_weights(self, weights, positions):
         if weights is None:
+            if isinstance(self.agent, Agent):
+                # Rendering was turned on after the agent was made, the next decisions will have weights
+                self.agent.set_attention_weights(True)
             return
-        mean_weights = torch.mean(torch.stack(weights), dim=0).numpy()[0][0]
-
-        top = sorted(range(len(mean_weights)), key=lambda i: mean_weights[i], reverse=True)
-        top.remove(0)  # Self
-
-        self.renderer.begin_rendering('attention_weights')
-
-        invert = np.array([-1, -1, 1]) if self.team == 1 else np.ones(3)
-        loc = positions[0] * invert
-        mx = mean_weights[~(np.arange(len(mean_weights)) == 1)].max()
-        c = 1
-        for i in top[:n]:
-            weight = mean_weights[i] / mx
-            # print(i, weight)
-            dest = positions[i] * invert
-            color = self.renderer.create_color(255, round(255 * (1 - weight)), round(255),
-                                               round(255 * (1 - weight)))
-            self.renderer.draw_string_3d(dest, 2, 2, str(c), color)
-            c += 1
-            self.renderer.draw_line_3d(loc, dest, color)
-        self.renderer.end_rendering()
+        if self.attention_renderer is None:
+            self.attention_renderer = AttentionRenderer(self.renderer, self.team, self.render_refresh_rate)
+        self.attention_renderer.submit(weights, positions)
 
     def get_output(self, packet: GameTickPacket) -> SimpleControllerState:
+        tick_start = time.perf_counter()
         cur_time = packet.game_info.seconds_elapsed
         delta = cur_time - self.prev_time
         self.prev_time = cur_time
 
         ticks_elapsed = round(delta * 120)
-        self.ticks += ticks_elapsed
+        self.scheduler.advance(ticks_elapsed)
+        self.tick_count += ticks_elapsed
+        self.metrics.add_tick(ticks_elapsed)
         self.game_state.decode(packet, ticks_elapsed)
 
         if self.isToxic:
             self.toxicity(packet)
 
-        if self.update_action and len(self.game_state.players) > self.index:
-            self.update_action = False
-
-            player = self.game_state.players[self.index]
-            teammates = [p for p in self.game_state.players if p.team_num == self.team and p != player]
-            opponents = [p for p in self.game_state.players if p.team_num != self.team]
+        if self.inference_worker is not None:
+            self.collect_async_action()
 
-            self.game_state.players = [player] + teammates + opponents
+        has_player = len(self.game_state.players) > self.index
+        if has_player:
+            self.order_players()
 
-            
-            obs = self.obs_builder.build_obs(player, self.game_state, self.action)
+        if self.scheduler.update_action and has_player:
+            self.scheduler.update_action = False
+            player = self.game_state.players[0]
 
-            beta = self.beta
-            if packet.game_info.is_match_ended:
-                # or not (packet.game_info.is_kickoff_pause or packet.game_info.is_round_active): Removed due to kickoff
-                beta = 0  # Celebrate with random actions
-            if self.stochastic_kickoffs and packet.game_info.is_kickoff_pause:
-                beta = 0.5
-            raw_action, weights = self.agent.act(obs, beta)
-
-            # Anti-oscillation steering smoothing and flip dwell time
-            new_action = np.array(raw_action, dtype=float)
-            steer = float(new_action[1])
-            prev_steer = float(self.prev_action[1])
+            if self.inference_worker is not None:
+                self.submit_async_action(packet, ticks_elapsed)
+            else:
+                decide_start = time.perf_counter()
+                prev_action = self.action
+                obs = self.obs_builder.build_obs(player, self.game_state, self.action)
+                obs_done = time.perf_counter()
+
+                beta = self.get_beta(packet)
+                action_index, raw_action, weights = self.agent.select_action(obs, beta)
+                forward_done = time.perf_counter()
+                self.scheduler.record_latency(forward_done - decide_start)
+
+                self.action = self.smooth_action(raw_action, ticks_elapsed)
+                self.action_tick = self.tick_count
+
+                self.metrics.decisions += 1
+                self.metrics.obs_build.observe(obs_done - decide_start)
+                self.metrics.forward.observe(forward_done - obs_done)
+                self.metrics.post_processing.observe(time.perf_counter() - forward_done)
+
+                if self.render:
+                    self.render_attention_weights(weights, self.entity_positions())
+
+                if self.recorder is not None:
+                    self.recorder.record(packet.game_info, ticks_elapsed, self.obs_builder.current_encoded,
+                                         beta, prev_action, action_index)
+        elif self.recorder is not None:
+            self.recorder.record(packet.game_info, ticks_elapsed, self.obs_builder.encoder.encode(self.game_state))
+
+        if self.scheduler.should_update_controls():
+            self.update_controls(self.action)
+            self.staleness.add(self.tick_count - self.action_tick)
 
-            # Cooldown countdown
-            if self.steer_flip_cooldown > 0:
-                self.steer_flip_cooldown = max(0, self.steer_flip_cooldown - ticks_elapsed)
+        if self.hardcoded_kickoffs and self.maybe_do_kickoff(packet, ticks_elapsed):
+            self.metrics.kickoff_overrides += 1
 
-            sign = 1 if steer > 0.1 else (-1 if steer < -0.1 else 0)
-            prev_sign = 1 if prev_steer > 0.1 else (-1 if prev_steer < -0.1 else 0)
+        tick_seconds = time.perf_counter() - tick_start
+        self.metrics.tick.observe(tick_seconds)
+        self.scheduler.end_tick(tick_seconds, self.tick_count, cur_time)
+        return self.controls
 
-            # Smooth toward previous to damp jitter
-            smooth_steer = (1.0 - self.steer_smooth) * steer + self.steer_smooth * prev_steer
+    def order_players(self):
+        # Nexto sees itself first, then its teammates, then its opponents. Every tick is put in this order,
+        # not only action ticks, so all recorded states share it
+        player = self.game_state.players[self.index]
+        teammates = [p for p in self.game_state.players if p.team_num == self.team and p != player]
+        opponents = [p for p in self.game_state.players if p.team_num != self.team]
+        self.game_state.players = [player] + teammates + opponents
+
+    def get_beta(self, packet: GameTickPacket):
+        beta = self.beta
+        if packet.game_info.is_match_ended:
+            # or not (packet.game_info.is_kickoff_pause or packet.game_info.is_round_active): Removed due to kickoff
+            beta = 0  # Celebrate with random actions
+        if self.stochastic_kickoffs and packet.game_info.is_kickoff_pause:
+            beta = 0.5
+        return beta
+
+    def submit_async_action(self, packet: GameTickPacket, ticks_elapsed):
+        # Snapshot for the worker, which does the rest of what the inline path does after encoding
+        encoded = self.obs_builder.encoder.encode(self.game_state).copy()
+        beta = self.get_beta(packet)
+        positions = self.entity_positions() if self.render else None
+        record = None
+        if self.recorder is not None:
+            record = self.recorder.make_record(packet.game_info, ticks_elapsed, encoded, beta, self.action)
+        self.inference_worker.submit(InferenceJob(self.tick_count, encoded, self.action, beta, ticks_elapsed,
+                                                  positions, record))
+
+    def collect_async_action(self):
+        result = self.inference_worker.poll()
+        if result is None:
+            return
+        smooth_start = time.perf_counter()
+        self.action = self.smooth_action(result.raw_action, result.job.ticks_elapsed)
+        self.action_tick = result.job.tick
+        self.scheduler.record_latency(result.seconds)
 
-            # Prevent rapid sign flips within dwell time
-            if sign != 0 and prev_sign != 0 and sign != prev_sign and self.steer_flip_cooldown > 0:
-                smooth_steer = prev_steer  # hold direction
-            elif sign != 0 and sign != prev_sign:
-                self.steer_flip_cooldown = self.min_flip_ticks
+        self.metrics.decisions += 1
+        self.metrics.obs_build.observe(result.obs_seconds)
+        self.metrics.forward.observe(result.forward_seconds)
+        self.metrics.post_processing.observe(time.perf_counter() - smooth_start)
+        if self.render:
+            self.render_attention_weights(result.weights, result.job.positions)
 
-            # Deadzone small values to zero
-            if abs(smooth_steer) < 0.05:
-                smooth_steer = 0.0
+    def smooth_action(self, raw_action, ticks_elapsed):
+        # Anti-oscillation steering smoothing and flip dwell time
+        new_action = np.array(raw_action, dtype=float)
+        steer = float(new_action[1])
+        prev_steer = float(self.prev_action[1])
 
-            new_action[1] = smooth_steer
+        # Cooldown countdown
+        if self.steer_flip_cooldown > 0:
+            self.steer_flip_cooldown = max(0, self.steer_flip_cooldown - ticks_elapsed)
 
-            self.prev_action = new_action.copy()
-            self.action = new_action
+        sign = 1 if steer > 0.1 else (-1 if steer < -0.1 else 0)
+        prev_sign = 1 if prev_steer > 0.1 else (-1 if prev_steer < -0.1 else 0)
 
-            if self.render:
-                positions = np.asarray([p.car_data.position for p in self.game_state.players] +
-                                       [self.game_state.ball.position] +
-                                       list(BOOST_LOCATIONS))
-                self.render_attention_weights(weights, positions)
+        # Smooth toward previous to damp jitter
+        smooth_steer = (1.0 - self.steer_smooth) * steer + self.steer_smooth * prev_steer
 
-        if self.ticks >= self.tick_skip - 1:
-            self.update_controls(self.action)
+        # Prevent rapid sign flips within dwell time
+        if sign != 0 and prev_sign != 0 and sign != prev_sign and self.steer_flip_cooldown > 0:
+            smooth_steer = prev_steer  # hold direction
+        elif sign != 0 and sign != prev_sign:
+            self.steer_flip_cooldown = self.min_flip_ticks
 
-        if self.ticks >= self.tick_skip:
-            self.ticks = 0
-            self.update_action = True
+        # Deadzone small values to zero
+        if abs(smooth_steer) < 0.05:
+            smooth_steer = 0.0
 
-        if self.hardcoded_kickoffs:
-            self.maybe_do_kickoff(packet, ticks_elapsed)
+        new_action[1] = smooth_steer
 
-        return self.controls
+        self.prev_action = new_action.copy()
+        return new_action
 
     def maybe_do_kickoff(self, packet, ticks_elapsed):
+        # Returns whether the hardcoded kickoff replaced the model's action this tick
         if packet.game_info.is_kickoff_pause:
             if self.kickoff_index >= 0:
                 self.kickoff_index += round(ticks_elapsed)
@@ -224,8 +460,10 @@ class Nexto(BaseAgent):
                 action = KICKOFF_NUMPY[self.kickoff_index]
                 self.action = action
                 self.update_controls(self.action)
+                return True
         else:
             self.kickoff_index = -1
+        return False
 
     def update_controls(self, action):
         self.controls.throttle = action[0]
@@ -0,0 +1,70 @@
+import os
+
+from rlbot.agents.base_agent import BOT_CONFIG_AGENT_HEADER
+from rlbot.agents.hivemind.drone_agent import DroneAgent
+from rlbot.parsing.custom_config import ConfigHeader, ConfigObject
+
+from .inference_backends import BACKENDS, TORCHSCRIPT_BACKEND
+from .nexto_obs import NUMPY_OBS_BUILDER, OBS_BUILDERS
+
+
+class NextoDrone(DroneAgent):
+    # Every Nexto drone on a team joins the same hivemind process, see hivemind.py
+    hive_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'hivemind.py')
+    hive_key = 'NextoHivemind'
+    hive_name = 'Nexto Hivemind'
+
+    def __init__(self, name, team, index):
+        super().__init__(name, team, index)
+        self.inference_backend = TORCHSCRIPT_BACKEND
+        self.obs_builder = NUMPY_OBS_BUILDER
+        self.model_instances = 1
+        self.use_numba = False
+        self.beta = 1
+        self.min_tick_skip = 6
+        self.max_tick_skip = 6
+        self.max_inference_load = 0.5
+
+    @staticmethod
+    def create_agent_configurations(config: ConfigObject):
+        params = config.get_header(BOT_CONFIG_AGENT_HEADER)
+        params.add_value('inference_backend', str, default=TORCHSCRIPT_BACKEND,
+                         description=f'Model runtime, one of: {", ".join(BACKENDS)}')
+        params.add_value('obs_builder', str, default=NUMPY_OBS_BUILDER,
+                         description=f'Observation builder, one of: {", ".join(OBS_BUILDERS)}')
+        params.add_value('use_numba', bool, default=False,
+                         description='Run the numpy builder\'s rotation math as numba-compiled loops, needs numba')
+        params.add_value('model_instances', int, default=1,
+                         description='Processes running the model on this machine (each hivemind counts once), '
+                                     'for the thread counts calibrated by thread_tuner.py')
+        params.add_value('beta', float, default=1.0,
+                         description='Action selection, 1 picks the likeliest action, 0.5 samples from the policy, 0 picks at random')
+        params.add_value('min_tick_skip', int, default=6,
+                         description='Fewest ticks between actions the scheduler may go down to')
+        params.add_value('max_tick_skip', int, default=6,
+                         description='Most ticks between actions the scheduler may go up to')
+        params.add_value('max_inference_load', float, default=0.5,
+                         description='Share of frame time deciding may take on average before acting less often')
+
+    def load_config(self, config_header: ConfigHeader):
+        self.inference_backend = config_header.get('inference_backend')
+        self.obs_builder = config_header.get('obs_builder')
+        self.model_instances = config_header.getint('model_instances')
+        self.use_numba = config_header.getboolean('use_numba')
+        self.beta = config_header.getfloat('beta')
+        self.min_tick_skip = config_header.getint('min_tick_skip')
+        self.max_tick_skip = config_header.getint('max_tick_skip')
+        self.max_inference_load = config_header.getfloat('max_inference_load')
+
+    def get_helper_process_request(self):
+        # The hivemind only sees the options of the request, so pass the settings it needs along
+        request = super().get_helper_process_request()
+        request.options['inference_backend'] = self.inference_backend
+        request.options['obs_builder'] = self.obs_builder
+        request.options['model_instances'] = self.model_instances
+        request.options['use_numba'] = self.use_numba
+        request.options['beta'] = self.beta
+        request.options['min_tick_skip'] = self.min_tick_skip
+        request.options['max_tick_skip'] = self.max_tick_skip
+        request.options['max_inference_load'] = self.max_inference_load
+        return request
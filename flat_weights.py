@@ -0,0 +1,203 @@
+"""
+Flat, page-aligned weight file for the Nexto actor, memory-mapped read-only so every bot process on
+the machine shares the same physical pages for the weights instead of holding a private copy.
+The module code goes into a weightless TorchScript skeleton, the weights into a file of a JSON index
+followed by every tensor's raw data, each starting on a page boundary.
+
+Convert with: python -m <bot package>.flat_weights --export
+Compare loading against the TorchScript file with: python -m <bot package>.flat_weights --report
+"""
+
+import argparse
+import json
+import os
+import struct
+import subprocess
+import sys
+import time
+import warnings
+
+import numpy as np
+import torch
+
+from .inference_backends import (FLAT_WEIGHTS_FILE, MODEL_DIR, MMAP_BACKEND, SKELETON_MODEL_FILE,
+                                 TORCHSCRIPT_BACKEND, load_backend, load_torchscript)
+from .nexto_obs import entity_count
+
+WEIGHTS_MAGIC = b"NEXTOWTS"
+WEIGHTS_VERSION = 1
+PAGE_SIZE = 4096
+
+_PREAMBLE = struct.Struct("<8sIQ")  # Magic, version, index length
+
+
+def _align(offset: int):
+    return -(-offset // PAGE_SIZE) * PAGE_SIZE
+
+
+def _tensors(actor):
+    return [(name, "parameter", t) for name, t in actor.named_parameters()] + \
+           [(name, "buffer", t) for name, t in actor.named_buffers()]
+
+
+def _replace(actor, name: str, kind: str, tensor: torch.Tensor):
+    *path, leaf = name.split(".")
+    module = actor
+    for attr in path:
+        module = getattr(module, attr)
+    setattr(module, leaf, torch.nn.Parameter(tensor, requires_grad=False) if kind == "parameter" else tensor)
+
+
+def export_flat_weights(model_dir: str = MODEL_DIR, weights_path: str = None, skeleton_path: str = None):
+    """Splits the TorchScript actor into the flat weight file and a skeleton holding only the code"""
+    weights_path = weights_path or os.path.join(model_dir, FLAT_WEIGHTS_FILE)
+    skeleton_path = skeleton_path or os.path.join(model_dir, SKELETON_MODEL_FILE)
+    actor = load_torchscript(model_dir)
+
+    index = []
+    arrays = []
+    offset = 0
+    for name, kind, tensor in _tensors(actor):
+        array = tensor.detach().contiguous().numpy()
+        index.append({"name": name, "kind": kind, "dtype": array.dtype.str, "shape": list(array.shape),
+                      "offset": offset, "nbytes": array.nbytes})
+        arrays.append(array)
+        offset = _align(offset + array.nbytes)
+
+    header = json.dumps({"tensors": index}).encode()
+    data_start = _align(_PREAMBLE.size + len(header))
+    with open(weights_path, 'wb') as f:
+        f.write(_PREAMBLE.pack(WEIGHTS_MAGIC, WEIGHTS_VERSION, len(header)))
+        f.write(header)
+        for entry, array in zip(index, arrays):
+            f.seek(data_start + entry["offset"])
+            f.write(array.tobytes())
+        f.truncate(data_start + _align(offset))
+
+    # The code stays TorchScript, with empty tensors where the weights were
+    for name, kind, tensor in _tensors(actor):
+        _replace(actor, name, kind, torch.empty(0, dtype=tensor.dtype))
+    torch.jit.save(actor, skeleton_path)
+    return weights_path, skeleton_path
+
+
+def map_weights(path: str):
+    """{name: (kind, tensor)} of read-only tensors backed by a shared mapping of the weight file"""
+    with open(path, 'rb') as f:
+        magic, version, header_length = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+        if magic != WEIGHTS_MAGIC or version != WEIGHTS_VERSION:
+            raise ValueError(f"{path} is not a version {WEIGHTS_VERSION} Nexto weight file")
+        index = json.loads(f.read(header_length))["tensors"]
+
+    mapping = np.memmap(path, dtype=np.uint8, mode='r')
+    data_start = _align(_PREAMBLE.size + header_length)
+    weights = {}
+    with warnings.catch_warnings():
+        # torch warns that the array is not writable, the model never writes to its weights
+        warnings.simplefilter("ignore", UserWarning)
+        for entry in index:
+            start = data_start + entry["offset"]
+            array = mapping[start: start + entry["nbytes"]].view(np.dtype(entry["dtype"])).reshape(entry["shape"])
+            weights[entry["name"]] = entry["kind"], torch.from_numpy(array)
+    return weights
+
+
+def load_mapped(model_dir: str = MODEL_DIR):
+    """The TorchScript actor with its weights memory-mapped from the flat weight file"""
+    weights_path = os.path.join(model_dir, FLAT_WEIGHTS_FILE)
+    skeleton_path = os.path.join(model_dir, SKELETON_MODEL_FILE)
+    for path in (weights_path, skeleton_path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} does not exist, create it with flat_weights.py --export")
+
+    actor = load_torchscript(model_dir, SKELETON_MODEL_FILE)
+    weights = map_weights(weights_path)
+    names = {name for name, _, _ in _tensors(actor)}
+    if names != set(weights):
+        raise ValueError(f"{FLAT_WEIGHTS_FILE} does not match {SKELETON_MODEL_FILE}, export them again")
+    for name, (kind, tensor) in weights.items():
+        _replace(actor, name, kind, tensor)
+    return actor.eval()
+
+
+def _memory():
+    import psutil
+
+    info = psutil.Process().memory_full_info()
+    return {"rss": info.rss, "uss": info.uss}
+
+
+def _measure(backend: str):
+    """Worker side: loads the backend, then reports its memory once every worker has loaded"""
+    before = _memory()
+    start = time.perf_counter()
+    actor = load_backend(backend)
+    with torch.no_grad():
+        actor((torch.zeros(1, 1, 32), torch.zeros(1, entity_count(2), 24), torch.zeros(1, entity_count(2))))
+    load_ms = (time.perf_counter() - start) * 1000
+    print("loaded", flush=True)
+    sys.stdin.readline()  # Every worker holds its model while the others are measured
+    after = _memory()
+    print(json.dumps({"load_ms": load_ms, "rss_before": before["rss"], "rss_after": after["rss"],
+                      "uss_after": after["uss"]}), flush=True)
+    sys.stdin.readline()
+
+
+def measure_processes(backend: str, processes: int):
+    """Load time and memory of processes bot-like processes holding the backend at the same time"""
+    command = [sys.executable, "-m", f"{__package__}.flat_weights", "--measure", backend]
+    cwd = os.path.dirname(MODEL_DIR)  # Parent of the bot package, so the relative imports resolve
+    workers = [subprocess.Popen(command, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+               for _ in range(processes)]
+    try:
+        for worker in workers:
+            if worker.stdout.readline().strip() != "loaded":
+                raise RuntimeError(f"Measuring {backend} failed (exit code {worker.wait()})")
+        results = []
+        for worker in workers:
+            worker.stdin.write("measure\n")
+            worker.stdin.flush()
+            results.append(json.loads(worker.stdout.readline()))
+    finally:
+        for worker in workers:
+            worker.stdin.close()
+            worker.stdout.close()
+            worker.wait()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory-mapped flat weight file for the Nexto actor")
+    parser.add_argument("--export", action="store_true",
+                        help=f"Write {FLAT_WEIGHTS_FILE} and {SKELETON_MODEL_FILE} next to the model")
+    parser.add_argument("--report", action="store_true",
+                        help="Compare load time and per-process memory of the torchscript and mmap backends")
+    parser.add_argument("--processes", type=int, default=3, help="Processes holding the model at once for --report")
+    parser.add_argument("--measure", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        _measure(args.measure)
+        return
+    if not (args.export or args.report):
+        parser.print_help()
+        return
+
+    if args.export:
+        weights_path, skeleton_path = export_flat_weights()
+        print(f"Exported {weights_path} ({os.path.getsize(weights_path) / 2 ** 20:.2f} MiB) "
+              f"and {skeleton_path} ({os.path.getsize(skeleton_path) / 2 ** 10:.0f} KiB)")
+
+    if args.report:
+        mib = 2 ** 20
+        print(f"{'backend':<13}{'load ms':>9}{'RSS before':>12}{'RSS after':>11}{'USS after':>11}  "
+              f"(MiB, mean of {args.processes} processes)")
+        for backend in (TORCHSCRIPT_BACKEND, MMAP_BACKEND):
+            results = measure_processes(backend, args.processes)
+            mean = {key: float(np.mean([r[key] for r in results])) for key in results[0]}
+            print(f"{backend:<13}{mean['load_ms']:>9.1f}{mean['rss_before'] / mib:>12.1f}"
+                  f"{mean['rss_after'] / mib:>11.1f}{mean['uss_after'] / mib:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
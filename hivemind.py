@@ -0,0 +1,125 @@
+import time
+from typing import Dict
+
+import numpy as np
+from rlbot.agents.hivemind.python_hivemind import PythonHivemind
+from rlbot.utils.structures.bot_input_struct import PlayerInput
+from rlbot.utils.structures.game_data_struct import GameTickPacket
+from rlgym_compat import GameState
+
+from .agent import log_warmup, make_agent
+from .bot import Nexto
+from .inference_backends import TORCHSCRIPT_BACKEND
+from .nexto_obs import NUMPY_OBS_BUILDER, ROSTER_BUCKETS, make_obs_builder
+from .tick_scheduler import TickScheduler
+
+
+class NextoDroneState:
+    """Per-car control state for a drone, mirroring the fields Nexto keeps for itself"""
+
+    # The smoothing and kickoff logic only touches the attributes set up in __init__
+    smooth_action = Nexto.smooth_action
+    maybe_do_kickoff = Nexto.maybe_do_kickoff
+    update_controls = Nexto.update_controls
+
+    def __init__(self, index, team):
+        self.index = index
+        self.team = team
+        self.controls = PlayerInput()
+        self.action = np.zeros(8)
+        self.prev_action = np.zeros(8)
+        self.kickoff_index = -1
+
+        # Anti-oscillation smoothing, same settings as Nexto
+        self.steer_flip_cooldown = 0
+        self.min_flip_ticks = 6
+        self.steer_smooth = 0.4
+
+
+class NextoHivemind(PythonHivemind):
+    """
+    Controls every Nexto drone on a team from one process.
+    Observations are built once per tick and all drones share a single forward pass.
+    """
+
+    # Same kickoff and celebration betas as Nexto
+    get_beta = Nexto.get_beta
+
+    def __init__(self, agent_metadata_queue, quit_event, options):
+        super().__init__(agent_metadata_queue, quit_event, options)
+        self.agent = None
+        self.inference_backend = options.get('inference_backend', TORCHSCRIPT_BACKEND)
+        self.obs_builder_name = options.get('obs_builder', NUMPY_OBS_BUILDER)
+        self.model_instances = int(options.get('model_instances', 1))
+        self.use_numba = bool(options.get('use_numba', False))
+        self.tick_skip = 6
+        self.beta = float(options.get('beta', 1))
+        # Decides when the drones act, like Nexto's scheduler but timing the batched decision
+        self.scheduler = TickScheduler(self.tick_skip,
+                                       min_tick_skip=int(options.get('min_tick_skip', self.tick_skip)),
+                                       max_tick_skip=int(options.get('max_tick_skip', self.tick_skip)),
+                                       max_load=float(options.get('max_inference_load', 0.5)))
+        self.hardcoded_kickoffs = True
+        self.stochastic_kickoffs = True
+
+        self.obs_builder = None
+        self.game_state: GameState = None
+        self.drones: Dict[int, NextoDroneState] = {}
+        self.tick_count = 0
+        self.prev_time = 0
+
+    def initialize_hive(self, packet: GameTickPacket) -> None:
+        field_info = self.get_field_info()
+        # One process for all drones, and nothing renders the attention weights
+        self.obs_builder = make_obs_builder(self.obs_builder_name, self.logger, self.use_numba,
+                                            field_info=field_info, roster_buckets=ROSTER_BUCKETS)
+        self.obs_builder.prepare()
+        self.agent = make_agent(self.inference_backend, self.logger, instances=self.model_instances,
+                                attention_weights=False, entity_counts=self.obs_builder.bucket_entity_counts())
+        self.game_state = GameState(field_info)
+        self.drones = {index: NextoDroneState(index, packet.game_cars[index].team)
+                       for index in sorted(self.drone_indices)}
+        if len(self.drones) > 1:
+            # Every tick runs one batch with a row per drone
+            log_warmup(self.agent.warm_up(batch_sizes=(len(self.drones),)), self.logger)
+        self.scheduler.reset()
+        self.prev_time = 0
+        self.logger.info(f"Nexto hivemind controlling drones {sorted(self.drones)}")
+
+    def get_outputs(self, packet: GameTickPacket) -> Dict[int, PlayerInput]:
+        tick_start = time.perf_counter()
+        cur_time = packet.game_info.seconds_elapsed
+        delta = cur_time - self.prev_time
+        self.prev_time = cur_time
+
+        ticks_elapsed = round(delta * 120)
+        self.scheduler.advance(ticks_elapsed)
+        self.tick_count += ticks_elapsed
+        self.game_state.decode(packet, ticks_elapsed)
+
+        drones = [d for d in self.drones.values() if d.index < len(self.game_state.players)]
+        if self.scheduler.update_action and drones:
+            self.scheduler.update_action = False
+            decide_start = time.perf_counter()
+
+            # Player order is kept as in the packet, so drone index == row in the batched obs
+            obs = self.obs_builder.batched_build_obs(self.obs_builder.encoder.encode(self.game_state))
+            for drone in drones:
+                self.obs_builder.add_actions(obs, drone.action, drone.index)
+            state = tuple(np.concatenate([obs[drone.index][k] for drone in drones]) for k in range(3))
+
+            _, raw_actions, _ = self.agent.act_batch(state, self.get_beta(packet))
+            self.scheduler.record_latency(time.perf_counter() - decide_start)
+
+            for drone, raw_action in zip(drones, raw_actions):
+                drone.action = drone.smooth_action(raw_action, ticks_elapsed)
+
+        for drone in drones:
+            if self.scheduler.should_update_controls():
+                drone.update_controls(drone.action)
+
+            if self.hardcoded_kickoffs:
+                drone.maybe_do_kickoff(packet, ticks_elapsed)
+
+        self.scheduler.end_tick(time.perf_counter() - tick_start, self.tick_count, cur_time)
+        return {drone.index: drone.controls for drone in self.drones.values()}
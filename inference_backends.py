@@ -0,0 +1,219 @@
+"""
+Inference backends for the Nexto actor.
+Every backend takes the (q, kv, m) float32 tensor tuple and returns (logits, weights) like the
+TorchScript module does, so Agent can use any of them interchangeably.
+
+Export the ONNX model with: python -m <bot package>.inference_backends --export-onnx
+"""
+
+import argparse
+import os
+from typing import Tuple
+
+import torch
+
+from .nexto_obs import entity_count
+
+TORCHSCRIPT_BACKEND = "torchscript"
+FROZEN_BACKEND = "frozen"
+INT8_BACKEND = "int8"
+ONNX_BACKEND = "onnx"
+MMAP_BACKEND = "mmap"
+
+MODEL_DIR = os.path.dirname(os.path.realpath(__file__))
+TORCHSCRIPT_MODEL_FILE = "nexto-model.pt"
+INT8_MODEL_FILE = "nexto-model-int8.pt"
+ONNX_MODEL_FILE = "nexto-model.onnx"
+FLAT_WEIGHTS_FILE = "nexto-model.weights"
+SKELETON_MODEL_FILE = "nexto-model-skeleton.pt"
+
+_ONNX_INPUTS = ("q", "kv", "m")
+_ONNX_OUTPUTS = ("logits", "weights_0", "weights_1")
+
+
+def load_torchscript(model_dir: str = MODEL_DIR, file_name: str = TORCHSCRIPT_MODEL_FILE):
+    with open(os.path.join(model_dir, file_name), 'rb') as f:
+        return torch.jit.load(f)
+
+
+class LogitsOnly(torch.nn.Module):
+    """Calls the actor and keeps only the logits"""
+
+    def __init__(self, actor):
+        super().__init__()
+        self.actor = actor
+
+    def forward(self, obs: Tuple[torch.Tensor, torch.Tensor, torch.Tensor]) -> torch.Tensor:
+        return self.actor(obs)[0]
+
+
+def without_attention_weights(actor):
+    """
+    Frozen variant of a TorchScript actor that returns only the logits. Freezing inlines the whole
+    model, so the per-head averages of the attention weights that nothing reads are dead code and
+    are removed along with the tuples they were returned in.
+    """
+    return torch.jit.freeze(torch.jit.script(LogitsOnly(actor)).eval())
+
+
+class TorchScriptBackend:
+    """The TorchScript module as shipped"""
+    name = TORCHSCRIPT_BACKEND
+    model_file = TORCHSCRIPT_MODEL_FILE
+
+    def __init__(self, model_dir: str = MODEL_DIR, attention_weights: bool = True):
+        # Without attention weights the backend returns (logits, None), see without_attention_weights
+        self.attention_weights = attention_weights
+        self.actor = self._load(model_dir)
+        if not attention_weights:
+            self.actor = without_attention_weights(self.actor)
+
+    def _load(self, model_dir: str):
+        return load_torchscript(model_dir, self.model_file)
+
+    def __call__(self, state):
+        if self.attention_weights:
+            return self.actor(state)
+        return self.actor(state), None
+
+
+class FrozenBackend(TorchScriptBackend):
+    """TorchScript module with weights frozen into constants and run through optimize_for_inference"""
+    name = FROZEN_BACKEND
+
+    def __init__(self, model_dir: str = MODEL_DIR, attention_weights: bool = True):
+        super().__init__(model_dir)
+        self.attention_weights = attention_weights
+        actor = self.actor if attention_weights else torch.jit.script(LogitsOnly(self.actor))
+        self.actor = torch.jit.optimize_for_inference(torch.jit.freeze(actor.eval()))
+
+
+class Int8Backend(TorchScriptBackend):
+    """Dynamically quantized TorchScript module written by quantize_actor.py"""
+    name = INT8_BACKEND
+    model_file = INT8_MODEL_FILE
+
+    def __init__(self, model_dir: str = MODEL_DIR, attention_weights: bool = True):
+        path = os.path.join(model_dir, self.model_file)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} does not exist, create it with quantize_actor.py")
+        super().__init__(model_dir, attention_weights)
+
+
+class MmapBackend(TorchScriptBackend):
+    """TorchScript module with its weights memory-mapped from the flat weight file, see flat_weights.py"""
+    name = MMAP_BACKEND
+    model_file = FLAT_WEIGHTS_FILE
+
+    def _load(self, model_dir: str):
+        from .flat_weights import load_mapped
+
+        # Freezing keeps referencing the mapped tensors, so the variant without weights shares them too
+        return load_mapped(model_dir)
+
+
+class OnnxBackend:
+    """ONNX Runtime session on the exported model, see export_onnx"""
+    name = ONNX_BACKEND
+    model_file = ONNX_MODEL_FILE
+
+    def __init__(self, model_dir: str = MODEL_DIR, attention_weights: bool = True):
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError("The onnx inference backend needs onnxruntime (pip install onnxruntime)") from e
+
+        path = os.path.join(model_dir, self.model_file)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} does not exist, export it with --export-onnx")
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.attention_weights = attention_weights
+        # Only fetching the logits lets ONNX Runtime skip copying out the weights
+        self._outputs = None if attention_weights else [_ONNX_OUTPUTS[0]]
+
+    def __call__(self, state):
+        feed = {name: s.numpy() for name, s in zip(_ONNX_INPUTS, state)}
+        logits, *weights = self.session.run(self._outputs, feed)
+        if not self.attention_weights:
+            return torch.from_numpy(logits), None
+        return torch.from_numpy(logits), tuple(torch.from_numpy(w) for w in weights)
+
+
+BACKENDS = {
+    TORCHSCRIPT_BACKEND: TorchScriptBackend,
+    FROZEN_BACKEND: FrozenBackend,
+    INT8_BACKEND: Int8Backend,
+    ONNX_BACKEND: OnnxBackend,
+    MMAP_BACKEND: MmapBackend,
+}
+
+
+class SpecializedBackend:
+    """
+    A separate instance of a backend per entity count, so the graph each one profiles and optimizes
+    only ever sees its own shape and switching between them never makes one specialize again.
+    Other entity counts share one more instance, loaded the first time one comes up.
+    """
+
+    def __init__(self, backend, model_dir: str, attention_weights: bool, entity_counts):
+        self.name = backend.name
+        self.model_file = backend.model_file
+        self.attention_weights = attention_weights
+        self._load = lambda: backend(model_dir, attention_weights)
+        self.specializations = {n: self._load() for n in entity_counts}
+        self._general = None
+
+    def __call__(self, state):
+        specialization = self.specializations.get(state[1].shape[-2])
+        if specialization is None:
+            if self._general is None:
+                self._general = self._load()
+            specialization = self._general
+        return specialization(state)
+
+
+def load_backend(name: str = TORCHSCRIPT_BACKEND, model_dir: str = MODEL_DIR, attention_weights: bool = True,
+                 entity_counts=None):
+    """With entity_counts, returns a SpecializedBackend with an instance for each of them"""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{name}', expected one of {', '.join(BACKENDS)}")
+    if entity_counts:
+        return SpecializedBackend(BACKENDS[name], model_dir, attention_weights, entity_counts)
+    return BACKENDS[name](model_dir, attention_weights)
+
+
+def export_onnx(model_dir: str = MODEL_DIR, path: str = None):
+    """Exports the TorchScript actor to ONNX with dynamic batch and entity axes"""
+    path = path or os.path.join(model_dir, ONNX_MODEL_FILE)
+    actor = load_torchscript(model_dir).eval()
+    example = (torch.zeros(1, 1, 32), torch.zeros(1, entity_count(2), 24), torch.zeros(1, entity_count(2)))
+    dynamic_axes = {
+        "q": {0: "batch"},
+        "kv": {0: "batch", 1: "entities"},
+        "m": {0: "batch", 1: "entities"},
+        "logits": {0: "batch"},
+        "weights_0": {0: "batch", 2: "entities"},
+        "weights_1": {0: "batch", 2: "entities"},
+    }
+    torch.onnx.export(actor, (example,), path, input_names=list(_ONNX_INPUTS), output_names=list(_ONNX_OUTPUTS),
+                      dynamic_axes=dynamic_axes, dynamo=False)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Nexto inference backends")
+    parser.add_argument("--export-onnx", action="store_true", help=f"Write {ONNX_MODEL_FILE} next to the model")
+    args = parser.parse_args()
+
+    if args.export_onnx:
+        print(f"Exported {export_onnx()}")
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+Shared-memory inference broker for Nexto bots.
+RLBot runs every bot in its own process; with the broker, bots post their observations into
+shared memory and a single daemon batches them through one Agent.
+
+Run with: python -m <bot package>.inference_broker --name nexto_inference
+"""
+
+import argparse
+import logging
+import os
+import signal
+import threading
+import time
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import psutil
+
+from .inference_backends import BACKENDS, TORCHSCRIPT_BACKEND
+from .nexto_obs import ROSTER_BUCKETS, entity_count
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BROKER_NAME = "nexto_inference"
+DEFAULT_SLOTS = 8
+DEFAULT_WINDOW_MS = 0.5
+
+# ready is set once the model is loaded and warmed up, pid tells clients and later brokers whether the owner lives
+_HEADER = np.dtype([('n_slots', np.int64), ('max_entities', np.int64), ('pid', np.int64), ('ready', np.int64)])
+
+
+def _slot_dtype(max_entities):
+    # Each bot owns one slot (its index) and is its only writer, so no locking is needed:
+    # the bot writes its observation then bumps `request`, the broker answers then sets `response`.
+    return np.dtype([
+        ('request', np.int64),
+        ('response', np.int64),
+        ('n_entities', np.int32),
+        ('action', np.int32),
+        ('beta', np.float32),
+        ('q', np.float32, (1, 32)),
+        ('kv', np.float32, (max_entities, 24)),
+        ('m', np.float32, (max_entities,)),
+    ], align=True)
+
+
+def _map_slots(shm):
+    header = np.ndarray((), dtype=_HEADER, buffer=shm.buf)
+    dtype = _slot_dtype(int(header['max_entities']))
+    slots = np.ndarray((int(header['n_slots']),), dtype=dtype, buffer=shm.buf, offset=_HEADER.itemsize)
+    return header, slots
+
+
+class InferenceBroker:
+    """Daemon side: owns the shared memory and the only Agent instance"""
+
+    def __init__(self, name: str = DEFAULT_BROKER_NAME, n_slots: int = DEFAULT_SLOTS,
+                 window_ms: float = DEFAULT_WINDOW_MS, poll_interval: float = 0.0002,
+                 backend: str = TORCHSCRIPT_BACKEND):
+        from .agent import WARMUP_ENTITY_COUNTS, make_agent
+
+        self.window = window_ms / 1000
+        self.poll_interval = poll_interval
+
+        # The segment comes first, so bots starting while the model loads find it and wait for ready
+        max_entities = entity_count(max(n_slots, *ROSTER_BUCKETS))
+        size = _HEADER.itemsize + n_slots * _slot_dtype(max_entities).itemsize
+        try:
+            self.shm = SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            self._unlink_stale(name)
+            self.shm = SharedMemory(name=name, create=True, size=size)
+
+        header = np.ndarray((), dtype=_HEADER, buffer=self.shm.buf)
+        header['n_slots'] = n_slots
+        header['max_entities'] = max_entities
+        header['pid'] = os.getpid()
+        self.header, self.slots = _map_slots(self.shm)
+        del header
+        self.slots[:] = np.zeros((), dtype=self.slots.dtype)
+
+        # Bots pad their observations to the roster buckets, one model instance each
+        try:
+            self.agent = make_agent(backend, logger, instances=1, attention_weights=False,
+                                    entity_counts=WARMUP_ENTITY_COUNTS)
+        except BaseException:
+            self.close()
+            raise
+        self.header['ready'] = 1
+
+        self.stop_event = threading.Event()
+        logger.info(f"Inference broker '{name}' ready with {n_slots} slots, {window_ms} ms batching window")
+
+    @staticmethod
+    def _unlink_stale(name: str):
+        # A segment left behind by a broker that did not shut down cleanly, unless its broker still runs
+        existing = SharedMemory(name=name)
+        try:
+            header = np.ndarray((), dtype=_HEADER, buffer=existing.buf)
+            pid = int(header['pid'])
+            del header
+        finally:
+            existing.close()
+        if pid and pid != os.getpid() and psutil.pid_exists(pid):
+            if os.name == "posix":
+                # Attaching registered the live segment with our resource tracker, which would unlink it at exit
+                resource_tracker.unregister(existing._name, "shared_memory")
+            raise RuntimeError(f"Inference broker '{name}' is already running (PID {pid})")
+        existing.unlink()
+
+    def _pending(self):
+        return self.slots['request'] != self.slots['response']
+
+    def serve(self):
+        try:
+            while not self.stop_event.is_set():
+                pending = self._pending()
+                if not pending.any():
+                    time.sleep(self.poll_interval)
+                    continue
+
+                # Give the other bots a moment to post their requests for this tick
+                deadline = time.perf_counter() + self.window
+                while time.perf_counter() < deadline and not pending.all():
+                    pending = self._pending()
+
+                self.process(np.flatnonzero(pending))
+        finally:
+            self.close()
+
+    def process(self, indices):
+        requests = self.slots['request'][indices]
+        n_entities = self.slots['n_entities'][indices]
+        betas = self.slots['beta'][indices]
+
+        # Only observations of the same shape and beta can share a forward pass
+        for n, beta in set(zip(n_entities.tolist(), betas.tolist())):
+            sel = (n_entities == n) & (betas == beta)
+            batch = indices[sel]
+            state = (self.slots['q'][batch],
+                     self.slots['kv'][batch, :n],
+                     self.slots['m'][batch, :n])
+            actions, _ = self.agent.select_actions(state, beta)
+            self.slots['action'][batch] = actions
+            self.slots['response'][batch] = requests[sel]
+
+    def close(self):
+        self.header = self.slots = None
+        self.shm.close()
+        self.shm.unlink()
+        logger.info("Inference broker stopped")
+
+
+class BrokerClient:
+    """Bot side: drop-in replacement for Agent.act that forwards to the broker"""
+
+    def __init__(self, index: int, name: str = DEFAULT_BROKER_NAME, timeout: float = 0.05,
+                 connect_timeout: float = 10.0, ready_timeout: float = 60.0):
+        from .agent import Agent
+
+        self.shm = self._connect(name, connect_timeout, ready_timeout)
+        _, self.slots = _map_slots(self.shm)
+        if index >= len(self.slots):
+            self.shm.close()
+            raise ValueError(f"Inference broker has {len(self.slots)} slots, bot index {index} does not fit")
+
+        self.index = index
+        self.timeout = timeout
+        self.seq = int(self.slots['response'][index])
+        self._lookup_table = Agent.make_lookup_table()
+        self._last_action = 0
+
+    @staticmethod
+    def _connect(name: str, connect_timeout: float, ready_timeout: float):
+        """
+        Attaches to the broker's segment once its model is ready. The loader starts the broker next to
+        the bots, so the segment gets connect_timeout seconds to appear (or to replace one left behind by
+        a dead broker), and a live broker ready_timeout seconds to load its model.
+        """
+        start = time.perf_counter()
+        while True:
+            elapsed = time.perf_counter() - start
+            try:
+                shm = SharedMemory(name=name)
+            except FileNotFoundError:
+                if elapsed > connect_timeout:
+                    raise
+                time.sleep(0.1)
+                continue
+            if os.name == "posix":
+                # Attaching registers the segment with this process' resource tracker, which would
+                # otherwise unlink it when the bot exits and pull it away from the other bots
+                resource_tracker.unregister(shm._name, "shared_memory")
+
+            header = np.ndarray((), dtype=_HEADER, buffer=shm.buf)
+            ready, pid = bool(header['ready']), int(header['pid'])
+            del header
+            if ready:
+                return shm
+            shm.close()
+            dead = pid != 0 and not psutil.pid_exists(pid)
+            if (dead and elapsed > connect_timeout) or elapsed > ready_timeout:
+                raise TimeoutError(f"Inference broker '{name}' did not get ready")
+            time.sleep(0.1)
+
+    def act(self, state, beta):
+        _, action, weights = self.select_action(state, beta)
+        return action, weights
+
+    def select_action(self, state, beta):
+        q, kv, m = state
+        n = kv.shape[-2]
+        i = self.index
+
+        self.slots['q'][i] = q[0]
+        self.slots['kv'][i, :n] = kv[0]
+        self.slots['m'][i, :n] = m[0]
+        self.slots['n_entities'][i] = n
+        self.slots['beta'][i] = beta
+        self.seq += 1
+        self.slots['request'][i] = self.seq
+
+        deadline = time.perf_counter() + self.timeout
+        while self.slots['response'][i] != self.seq:
+            if time.perf_counter() > deadline:
+                logger.warning(f"Inference broker did not answer within {self.timeout * 1000:.0f} ms, "
+                               f"repeating last action")
+                return self._last_action, self._lookup_table[self._last_action], None
+            time.sleep(0)
+
+        self._last_action = int(self.slots['action'][i])
+        return self._last_action, self._lookup_table[self._last_action], None
+
+    def close(self):
+        self.slots = None
+        self.shm.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Nexto shared-memory inference broker")
+    parser.add_argument("--name", type=str, default=DEFAULT_BROKER_NAME, help="Shared memory name")
+    parser.add_argument("--slots", type=int, default=DEFAULT_SLOTS, help="Number of bot slots (highest bot index + 1)")
+    parser.add_argument("--window-ms", type=float, default=DEFAULT_WINDOW_MS,
+                        help="How long to wait for other bots' requests before running a batch")
+    parser.add_argument("--backend", type=str, default=TORCHSCRIPT_BACKEND, choices=list(BACKENDS),
+                        help="Inference backend for the model")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    broker = InferenceBroker(name=args.name, n_slots=args.slots, window_ms=args.window_ms,
+                             backend=args.backend)
+    signal.signal(signal.SIGTERM, lambda *_: broker.stop_event.set())
+    try:
+        broker.serve()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
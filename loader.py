@@ -13,6 +13,7 @@ import logging
 import subprocess
 import threading
 import argparse
+import tempfile
 from pathlib import Path
 from typing import Optional, Dict, Any
 
@@ -40,6 +41,7 @@ class NextoBotLoader:
         
         self.rlbot_process = None
         self.bot_process = None
+        self.broker_process = None
         self.is_running = False
         
         self.bot_config = self._load_bot_config()
@@ -326,6 +328,65 @@ class NextoBotLoader:
         logger.info(f"Created RLBot config: {config_path}")
         return str(config_path)
     
+    def start_inference_broker(self) -> bool:
+        """Start the shared inference broker next to the bots if bot.cfg asks for it"""
+        if not self.bot_config.get('use_inference_broker', False):
+            return True
+        if self.broker_process and self.broker_process.poll() is None:
+            return True
+        
+        try:
+            broker_command = [
+                sys.executable, "-m", f"{self.bot_path.absolute().name}.inference_broker",
+                "--name", str(self.bot_config.get('inference_broker_name', 'nexto_inference')),
+                "--window-ms", str(self.bot_config.get('inference_broker_window_ms', 0.5)),
+                "--backend", str(self.bot_config.get('inference_backend', 'torchscript'))
+            ]
+            
+            # Run as a module of the bot package so its relative imports resolve
+            self.broker_process = subprocess.Popen(
+                broker_command,
+                cwd=str(self.bot_path.absolute().parent)
+            )
+            logger.info(f"Inference broker started (PID: {self.broker_process.pid})")
+            return True
+            
+        except Exception as e:
+            logger.error(f"Failed to start inference broker: {e}")
+            logger.info("Bots will fall back to running the model in their own process")
+            return False
+    
+    def tune_threads(self) -> bool:
+        """Calibrate torch thread counts for the bots' model once per machine, see thread_tuner.py"""
+        if not self.bot_config.get('auto_tune_threads', False):
+            return True
+        
+        # With the broker a single process runs the model for every bot
+        instances = 1 if self.bot_config.get('use_inference_broker', False) else self.bot_config.get('model_instances', 1)
+        try:
+            tune_command = [
+                sys.executable, "-m", f"{self.bot_path.absolute().name}.thread_tuner",
+                "--backend", str(self.bot_config.get('inference_backend', 'torchscript')),
+                "--instances", str(instances)
+            ]
+            result = subprocess.run(
+                tune_command,
+                cwd=str(self.bot_path.absolute().parent),
+                capture_output=True,
+                text=True,
+                timeout=600
+            )
+            if result.returncode != 0:
+                error = (result.stderr.strip().splitlines() or ["no output"])[-1]
+                logger.warning(f"Thread tuning failed: {error}. Bots will run the model on a single thread")
+                return False
+            logger.info(f"Thread tuning: {result.stdout.strip()}")
+            return True
+            
+        except Exception as e:
+            logger.warning(f"Thread tuning failed: {e}. Bots will run the model on a single thread")
+            return False
+    
     def inject_bot(self, online_mode: bool = False) -> bool:
         """Inject the bot into Rocket League"""
         if online_mode:
@@ -398,6 +459,7 @@ class NextoBotLoader:
             logger.info("Attempting to attach bot to online match...")
             
             config_path = self.create_rlbot_config(online_mode=True)
+            self.start_inference_broker()
             
             setup_manager = SetupManager()
             
@@ -436,6 +498,7 @@ class NextoBotLoader:
         """Inject bot for exhibition/offline play"""
         try:
             config_path = self.create_rlbot_config(online_mode=False)
+            self.start_inference_broker()
             
             from rlbot.setup_manager import SetupManager
             from rlbot.utils.logging_utils import get_logger
@@ -490,6 +553,34 @@ class NextoBotLoader:
             logger.error(f"Failed to launch RLBot GUI: {e}")
             return False
     
+    def read_bot_metrics(self, max_age: float = 30) -> Dict[int, Dict[str, Any]]:
+        """Latest metrics snapshot of every bot that published one in the last max_age seconds"""
+        # Same default as metrics.DEFAULT_METRICS_DIRECTORY
+        metrics_dir = Path(self.bot_config.get('metrics_directory') or Path(tempfile.gettempdir()) / "nexto-metrics")
+        snapshots = {}
+        for path in metrics_dir.glob("nexto-*.json"):
+            try:
+                with open(path, 'r') as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if time.time() - snapshot.get('published_at', 0) <= max_age:
+                snapshots[snapshot['index']] = snapshot
+        return snapshots
+    
+    def log_bot_metrics(self):
+        """Log a one-line health summary per bot from the published metrics"""
+        for index, m in sorted(self.read_bot_metrics().items()):
+            latency = m['latency']
+            logger.info(
+                f"Bot {index}: {m['ticks_received']} ticks ({m['ticks_dropped']} dropped), "
+                f"{m['decisions']} decisions, {m['kickoff_overrides']} kickoff overrides, "
+                f"obs p95 {latency['obs_build']['p95_us']:.0f} us, "
+                f"forward p95 {latency['forward']['p95_us']:.0f} us, "
+                f"tick p99 {latency['tick']['p99_us']:.0f} us, "
+                f"{m['missed_deadlines']} missed deadlines, tick_skip {m['tick_skip']}"
+            )
+    
     def monitor_bot(self):
         """Monitor the bot process and restart if needed"""
         while self.is_running:
@@ -497,6 +588,7 @@ class NextoBotLoader:
                 if not self.is_rocket_league_running():
                     logger.warning("Rocket League process not found. Bot may have been disconnected.")
                 
+                self.log_bot_metrics()
                 time.sleep(10)
                 
             except KeyboardInterrupt:
@@ -525,6 +617,13 @@ class NextoBotLoader:
             except:
                 self.bot_process.kill()
         
+        if self.broker_process:
+            try:
+                self.broker_process.terminate()
+                self.broker_process.wait(timeout=10)
+            except:
+                self.broker_process.kill()
+        
         logger.info("Bot loader stopped")
     
     def run(self, wait_for_rl: bool = True, use_gui: bool = False, online_mode: bool = False):
@@ -553,6 +652,8 @@ class NextoBotLoader:
         logger.info("Waiting for Rocket League to fully load...")
         time.sleep(5)
         
+        self.tune_threads()
+        
         success = False
         if use_gui:
             success = self.inject_via_rlbot_gui(online_mode=online_mode)
@@ -0,0 +1,133 @@
+"""
+Low-overhead in-process metrics for the Nexto bot.
+Counters are plain attributes and latencies go into fixed-bucket histograms, so recording costs a
+few hundred nanoseconds on the tick thread. MetricsPublisher writes a JSON snapshot every few
+seconds from a background thread, for the loader to read.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency buckets, anything slower goes in a last overflow bucket
+LATENCY_BUCKETS_US = (25, 50, 100, 200, 400, 800, 1600, 3200, 6400, 12800, 25600, 51200)
+
+METRICS_SUFFIX = ".json"
+# Where bots publish without a metrics_directory, outside the bot folder so snapshots stay out of the source tree
+DEFAULT_METRICS_DIRECTORY = os.path.join(tempfile.gettempdir(), "nexto-metrics")
+
+
+class Histogram:
+    def __init__(self, bounds_us=LATENCY_BUCKETS_US):
+        self.bounds_us = bounds_us
+        self._bounds = [b / 1e6 for b in bounds_us]
+        self.counts = [0] * (len(bounds_us) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(self._bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile_us(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th percentile, capped at the max"""
+        if self.count == 0:
+            return 0.0
+        target = q / 100 * self.count
+        seen = 0
+        for bound, n in zip(self.bounds_us, self.counts):
+            seen += n
+            if seen >= target:
+                return min(float(bound), self.max * 1e6)
+        return self.max * 1e6
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_us": self.total / self.count * 1e6 if self.count else 0.0,
+            "p50_us": self.percentile_us(50),
+            "p95_us": self.percentile_us(95),
+            "p99_us": self.percentile_us(99),
+            "max_us": self.max * 1e6,
+            "buckets_us": list(self.bounds_us),
+            "counts": list(self.counts),
+        }
+
+
+class BotMetrics:
+    """Counters and latency histograms of the tick loop"""
+
+    def __init__(self):
+        self.ticks_received = 0
+        self.ticks_dropped = 0  # Ticks that passed without a get_output call (ticks_elapsed > 1)
+        self.decisions = 0
+        self.kickoff_overrides = 0  # Ticks where the hardcoded kickoff replaced the model's action
+
+        self.tick = Histogram()  # Whole get_output call
+        self.obs_build = Histogram()
+        self.forward = Histogram()  # Model forward pass and action selection
+        self.post_processing = Histogram()  # Smoothing of the chosen action
+
+    def add_tick(self, ticks_elapsed: int):
+        self.ticks_received += 1
+        if ticks_elapsed > 1:
+            self.ticks_dropped += ticks_elapsed - 1
+
+    def snapshot(self):
+        return {
+            "ticks_received": self.ticks_received,
+            "ticks_dropped": self.ticks_dropped,
+            "decisions": self.decisions,
+            "kickoff_overrides": self.kickoff_overrides,
+            "latency": {
+                "tick": self.tick.summary(),
+                "obs_build": self.obs_build.summary(),
+                "forward": self.forward.summary(),
+                "post_processing": self.post_processing.summary(),
+            },
+        }
+
+
+class MetricsPublisher:
+    """Writes snapshot() to path every interval seconds, replacing the file atomically"""
+
+    def __init__(self, path, snapshot, interval: float = 5.0):
+        self.path = path
+        self.snapshot = snapshot
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="nexto-metrics", daemon=True)
+        self._thread.start()
+
+    def publish(self):
+        try:
+            data = self.snapshot()
+        except RuntimeError:
+            return  # Read while the tick thread was resizing something, try again next time
+        data["published_at"] = time.time()
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not publish metrics to {self.path}: {e}")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.publish()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.publish()
@@ -5,6 +5,9 @@ import numpy as np
 from rlgym_compat.common_values import BLUE_TEAM, ORANGE_TEAM
 from rlgym_compat.game_state import GameState, PlayerData
 
+from .obs_kernels import (HAVE_NUMBA, convert_to_relative_matmul, convert_to_relative_numba, quats_to_rot_mtx,
+                          quats_to_rot_mtx_numba, relative_scratch, rot_mtx_buffers)
+
 BOOST_LOCATIONS = (
     (0.0, -4240.0, 70.0),
     (-1792.0, -4184.0, 70.0),
@@ -43,6 +46,25 @@ BOOST_LOCATIONS = (
 )
 
 
+BALL_STATE_LENGTH = 18
+PLAYER_CAR_STATE_LENGTH = 13
+PLAYER_TERTIARY_INFO_LENGTH = 10
+PLAYER_INFO_LENGTH = 2 + 2 * PLAYER_CAR_STATE_LENGTH + PLAYER_TERTIARY_INFO_LENGTH
+
+# Encoded car rotation: a quaternion as in encode_gamestate, or the forward and up vectors the obs actually uses
+QUATERNION_LAYOUT = "quaternion"
+ROTATION_LAYOUT = "rotation"
+ROTATION_LENGTHS = {QUATERNION_LAYOUT: 4, ROTATION_LAYOUT: 6}
+
+# Car counts observations are padded up to with roster_buckets, the 1v1, 2v2 and 3v3 rosters
+ROSTER_BUCKETS = (2, 4, 6)
+
+
+def entity_count(n_players: int, n_boosts: int = len(BOOST_LOCATIONS)) -> int:
+    # Entities NextoObsBuilder puts in an observation of n_players car rows: the cars, the ball and the boost pads
+    return n_players + 1 + n_boosts
+
+
 def rotation_to_quaternion(m: np.ndarray) -> np.ndarray:
     trace = np.trace(m)
     q = np.zeros(4)
@@ -113,15 +135,131 @@ def encode_gamestate(state: GameState):
     return state_vals
 
 
+def _write_quaternion(out: np.ndarray, m: np.ndarray):
+    # rotation_to_quaternion on Python floats, same operations so the result is identical
+    m00, m01, m02, m10, m11, m12, m20, m21, m22 = (m.item(k) for k in range(9))
+    trace = m00 + m11 + m22
+
+    if trace > 0:
+        s = (trace + 1) ** 0.5
+        w = s * 0.5
+        s = 0.5 / s
+        x = (m21 - m12) * s
+        y = (m02 - m20) * s
+        z = (m10 - m01) * s
+    else:
+        if m00 >= m11 and m00 >= m22:
+            s = (1 + m00 - m11 - m22) ** 0.5
+            inv_s = 0.5 / s
+            x = 0.5 * s
+            y = (m10 + m01) * inv_s
+            z = (m20 + m02) * inv_s
+            w = (m21 - m12) * inv_s
+        elif m11 > m22:
+            s = (1 + m11 - m00 - m22) ** 0.5
+            inv_s = 0.5 / s
+            x = (m01 + m10) * inv_s
+            y = 0.5 * s
+            z = (m12 + m21) * inv_s
+            w = (m02 - m20) * inv_s
+        else:
+            s = (1 + m22 - m00 - m11) ** 0.5
+            inv_s = 0.5 / s
+            x = (m02 + m20) * inv_s
+            y = (m12 + m21) * inv_s
+            z = 0.5 * s
+            w = (m10 - m01) * inv_s
+
+    out[0] = -w
+    out[1] = -x
+    out[2] = -y
+    out[3] = -z
+
+
+class GameStateEncoder:
+    """
+    Encodes GameStates into reusable float32 buffers instead of building lists.
+    The quaternion layout is the same as encode_gamestate, the rotation layout stores each car's
+    forward and up vectors in place of the quaternion so they never need to be converted back.
+    """
+
+    def __init__(self, n_boosts: int = len(BOOST_LOCATIONS), layout: str = ROTATION_LAYOUT):
+        if layout not in ROTATION_LENGTHS:
+            raise ValueError(f"Unknown layout {layout!r}, expected one of {list(ROTATION_LENGTHS)}")
+        self.n_boosts = n_boosts
+        self.layout = layout
+        self.rotation_length = ROTATION_LENGTHS[layout]
+        self.car_state_length = 3 + self.rotation_length + 6
+        self.player_length = 2 + 2 * self.car_state_length + PLAYER_TERTIARY_INFO_LENGTH
+        self.ball_start = 3 + n_boosts
+        self.players_start = self.ball_start + BALL_STATE_LENGTH
+        self._buffers = {}
+
+    def state_length(self, n_players: int) -> int:
+        return self.players_start + n_players * self.player_length
+
+    def encode(self, state: GameState) -> np.ndarray:
+        # Returns a (1, state_length) buffer that is overwritten by the next call with the same roster size
+        n_players = len(state.players)
+        out = self._buffers.get(n_players)
+        if out is None:
+            out = self._buffers[n_players] = np.zeros((1, self.state_length(n_players)), dtype=np.float32)
+        self._write(out[0], state)
+        return out
+
+    def _write(self, row: np.ndarray, state: GameState):
+        row[1] = state.blue_score
+        row[2] = state.orange_score
+        row[3:self.ball_start] = state.boost_pads
+
+        i = self.ball_start
+        for bd in (state.ball, state.inverted_ball):
+            row[i:i + 3] = bd.position
+            row[i + 3:i + 6] = bd.linear_velocity
+            row[i + 6:i + 9] = bd.angular_velocity
+            i += 9
+
+        for p in state.players:
+            row[i] = p.car_id
+            row[i + 1] = p.team_num
+            i += 2
+            for cd in (p.car_data, p.inverted_car_data):
+                row[i:i + 3] = cd.position
+                j = i + 3 + self.rotation_length
+                if self.layout == ROTATION_LAYOUT:
+                    theta = cd.rotation_mtx()
+                    row[i + 3:i + 6] = theta[:, 0]
+                    row[i + 6:i + 9] = theta[:, 2]
+                else:
+                    _write_quaternion(row[i + 3:j], cd.rotation_mtx())
+                row[j:j + 3] = cd.linear_velocity
+                row[j + 3:j + 6] = cd.angular_velocity
+                i += self.car_state_length
+            # First five tertiary values are always 0
+            row[i + 5] = p.is_demoed
+            row[i + 6] = p.on_ground
+            row[i + 7] = p.ball_touched
+            row[i + 8] = p.has_flip
+            row[i + 9] = p.boost_amount
+            i += PLAYER_TERTIARY_INFO_LENGTH
+
+
 class BatchedObsBuilder:
     def __init__(self):
         super().__init__()
         self.current_state = None
         self.current_obs = None
+        self.current_encoded = None
+        self.encoder = GameStateEncoder()
 
     def batched_build_obs(self, encoded_states: np.ndarray) -> Any:
         raise NotImplementedError
 
+    def single_build_obs(self, encoded_states: np.ndarray, player_index: int) -> Any:
+        # Observation from the perspective of one player only
+        # Builders without a dedicated path build every player's and keep one
+        return self.batched_build_obs(encoded_states)[player_index]
+
     def add_actions(self, obs: Any, previous_actions: np.ndarray, player_index=None):
         # Modify current obs to include action
         # player_index=None means actions for all players should be provided
@@ -133,20 +271,26 @@ class BatchedObsBuilder:
     def reset(self, initial_state: GameState):
         self.current_state = False
         self.current_obs = None
+        self.current_encoded = None
         self._reset(initial_state)
 
     def build_obs(self, player: PlayerData, state: GameState, previous_action: np.ndarray) -> Any:
         # if state != self.current_state:
-        self.current_obs = self.batched_build_obs(
-            np.expand_dims(encode_gamestate(state), axis=0)
-        )
+        encoded_states = self.encoder.encode(state)
         self.current_state = state
+        self.current_encoded = encoded_states
 
         for i, p in enumerate(state.players):
             if p == player:
-                self.add_actions(self.current_obs, previous_action, i)
-                return self.current_obs[i]
+                self.current_obs = self.single_build_obs(encoded_states, i)
+                self.add_actions((self.current_obs,), previous_action, 0)
+                return self.current_obs
+
 
+# Observation builder implementations, see make_obs_builder
+NUMPY_OBS_BUILDER = "numpy"
+TORCH_OBS_BUILDER = "torch"
+OBS_BUILDERS = (NUMPY_OBS_BUILDER, TORCH_OBS_BUILDER)
 
 IS_SELF, IS_MATE, IS_OPP, IS_BALL, IS_BOOST = range(5)
 POS = slice(5, 8)
@@ -157,22 +301,33 @@ ANG_VEL = slice(17, 20)
 BOOST, DEMO, ON_GROUND, HAS_FLIP = range(20, 24)
 ACTIONS = range(24, 32)
 
-BALL_STATE_LENGTH = 18
-PLAYER_CAR_STATE_LENGTH = 13
-PLAYER_TERTIARY_INFO_LENGTH = 10
-PLAYER_INFO_LENGTH = 2 + 2 * PLAYER_CAR_STATE_LENGTH + PLAYER_TERTIARY_INFO_LENGTH
-
 
 class NextoObsBuilder(BatchedObsBuilder):
     _invert = np.array([1] * 5 + [-1, -1, 1] * 5 + [1] * 4)
     _norm = np.array([1.] * 5 + [2300] * 6 + [1] * 6 + [5.5] * 3 + [1] * 4)
 
-    def __init__(self, field_info=None, n_players=None, tick_skip=8):
+    def __init__(self, field_info=None, n_players=None, tick_skip=8, layout=ROTATION_LAYOUT, roster_buckets=None,
+                 dtype=np.float32, use_numba=False):
         super().__init__()
         self.n_players = n_players
+        # Observations are built in the model's float32 by default, so the agent wraps them without a copy
+        self.dtype = np.dtype(dtype)
+        self._invert = NextoObsBuilder._invert.astype(self.dtype)
+        self._norm = NextoObsBuilder._norm.astype(self.dtype)
+        # With roster_buckets, observations are padded to the smallest bucket that fits the roster,
+        # so the model only sees a few fixed shapes however many cars join or leave
+        self.roster_buckets = tuple(sorted(roster_buckets)) if roster_buckets else ()
         self.demo_timers = None
         self.boost_timers = None
         self.tick_skip = tick_skip
+        self._buffers = {}
+        self._mask_players = {}
+        self._rot_buffers = {}
+        # Compiled rotation kernels (see obs_kernels) with use_numba, the numpy ones otherwise. Opt-in, since
+        # the first tick of every roster pays for compiling them
+        if use_numba and not HAVE_NUMBA:
+            raise ImportError("use_numba needs numba (pip install numba)")
+        self.use_numba = use_numba
         if field_info is None:
             self._boost_locations = np.array(BOOST_LOCATIONS)
             self._boost_types = self._boost_locations[:, 2] > 72
@@ -180,133 +335,204 @@ class NextoObsBuilder(BatchedObsBuilder):
             self._boost_locations = np.array([[bp.location.x, bp.location.y, bp.location.z]
                                               for bp in field_info.boost_pads[:field_info.num_boosts]])
             self._boost_types = np.array([bp.is_full_boost for bp in field_info.boost_pads[:field_info.num_boosts]])
+        # Encoded states passed to batched_build_obs must use this layout,
+        # encode_gamestate output needs layout=QUATERNION_LAYOUT
+        self.encoder = GameStateEncoder(len(self._boost_locations), layout)
 
     def _reset(self, initial_state: GameState):
         self.demo_timers = np.zeros(len(initial_state.players))
         self.boost_timers = np.zeros(len(initial_state.boost_pads))
-
-    @staticmethod
-    def _quats_to_rot_mtx(quats: np.ndarray) -> np.ndarray:
-        # From rlgym.utils.math.quat_to_rot_mtx
-        w = -quats[:, 0]
-        x = -quats[:, 1]
-        y = -quats[:, 2]
-        z = -quats[:, 3]
-
-        theta = np.zeros((quats.shape[0], 3, 3))
-
-        norm = np.einsum("fq,fq->f", quats, quats)
-
-        sel = norm != 0
-
-        w = w[sel]
-        x = x[sel]
-        y = y[sel]
-        z = z[sel]
-
-        s = 1.0 / norm[sel]
-
-        # front direction
-        theta[sel, 0, 0] = 1.0 - 2.0 * s * (y * y + z * z)
-        theta[sel, 1, 0] = 2.0 * s * (x * y + z * w)
-        theta[sel, 2, 0] = 2.0 * s * (x * z - y * w)
-
-        # left direction
-        theta[sel, 0, 1] = 2.0 * s * (x * y - z * w)
-        theta[sel, 1, 1] = 1.0 - 2.0 * s * (x * x + z * z)
-        theta[sel, 2, 1] = 2.0 * s * (y * z + x * w)
-
-        # up direction
-        theta[sel, 0, 2] = 2.0 * s * (x * z + y * w)
-        theta[sel, 1, 2] = 2.0 * s * (y * z - x * w)
-        theta[sel, 2, 2] = 1.0 - 2.0 * s * (x * x + y * y)
-
-        return theta
-
-    @staticmethod
-    def convert_to_relative(q, kv):
-        # kv[..., POS.start:LIN_VEL.stop] -= q[..., POS.start:LIN_VEL.stop]
-        kv[..., POS] -= q[..., POS]
-        forward = q[..., FW]
-        theta = np.arctan2(forward[..., 0], forward[..., 1])
-        theta = np.expand_dims(theta, axis=-1)
-        ct = np.cos(theta)
-        st = np.sin(theta)
-        xs = kv[..., POS.start:ANG_VEL.stop:3]
-        ys = kv[..., POS.start + 1:ANG_VEL.stop:3]
-        # Use temp variables to prevent modifying original array
-        nx = ct * xs - st * ys
-        ny = st * xs + ct * ys
-        kv[..., POS.start:ANG_VEL.stop:3] = nx  # x-components
-        kv[..., POS.start + 1:ANG_VEL.stop:3] = ny  # y-components
-
-    def batched_build_obs(self, encoded_states: np.ndarray):
-        ball_start_index = 3 + len(self._boost_locations)
-        players_start_index = ball_start_index + BALL_STATE_LENGTH
-        player_length = PLAYER_INFO_LENGTH
-
-        n_players = (encoded_states.shape[1] - players_start_index) // player_length
-        lim_players = n_players if self.n_players is None else self.n_players
-        n_entities = lim_players + 1 + 34
+        self.prepare(len(initial_state.players))
+
+    def prepare(self, n_players: int = None):
+        # Allocates the buffers of n_players' roster bucket (every bucket if None) up front instead of on its first tick
+        for lim_players in self.roster_buckets if n_players is None else (self.lim_players(n_players),):
+            self._get_buffers(1, 1, lim_players)
+            self._get_buffers(lim_players, 1, lim_players)
+
+    def lim_players(self, n_players: int) -> int:
+        # Car rows in the observation of an n_players roster, the ones past n_players are masked padding
+        if self.n_players is not None:
+            return self.n_players
+        return next((b for b in self.roster_buckets if b >= n_players), n_players)
+
+    def bucket_entity_counts(self):
+        # Entity counts of the padded observations, one per roster bucket
+        return tuple(entity_count(b, len(self._boost_locations)) for b in self.roster_buckets)
+
+    def _quats_to_rot_mtx(self, quats: np.ndarray) -> np.ndarray:
+        # (n, 3, 3) rotation matrices of the quaternions, see obs_kernels.quats_to_rot_mtx_reference
+        # Written into buffers reused by the next call with as many quaternions
+        key = (quats.shape[0], quats.dtype)
+        buffers = self._rot_buffers.get(key)
+        if buffers is None:
+            buffers = self._rot_buffers[key] = rot_mtx_buffers(*key)
+        if self.use_numba:
+            return quats_to_rot_mtx_numba(quats, buffers[0])
+        return quats_to_rot_mtx(quats, buffers)
+
+    def _static_rows(self, lim_players: int):
+        # Ball and boost rows that stay the same all match, already inverted and normalized
+        # Returns (2, n_entities, 24), indexed by the team of the perspective
+        n_entities = lim_players + 1 + len(self._boost_locations)
+        blue = np.zeros((n_entities, 24))
+        blue[lim_players, IS_BALL] = 1
+        boosts = blue[lim_players + 1:]
+        boosts[:, IS_BOOST] = 1
+        boosts[:, POS] = self._boost_locations
+        boosts[:, BOOST] = 0.12 + 0.88 * (self._boost_locations[:, 2] > 72)
+        orange = blue * self._invert
+        blue /= self._norm
+        orange /= self._norm
+        return np.stack([blue, orange]).astype(self.dtype)
+
+    def _buffer_key(self, n_perspectives: int, n_states: int, n_players: int):
+        # Rosters in the same bucket share their buffers, batched ones (a perspective per player) sized for the bucket
+        lim_players = self.lim_players(n_players)
+        rows = 1 if n_perspectives == 1 else max(n_perspectives, lim_players)
+        return rows, n_states, lim_players
+
+    def _get_buffers(self, n_perspectives: int, n_states: int, n_players: int):
+        # Observation arrays are allocated once per roster bucket and reused every call,
+        # calls with fewer perspectives than the bucket's players get views of the first rows
+        key = self._buffer_key(n_perspectives, n_states, n_players)
+        rows, _, lim_players = key
+        buffers = self._buffers.get(key)
+        if buffers is None:
+            n_entities = lim_players + 1 + len(self._boost_locations)
+
+            q = np.zeros((rows, n_states, 1, 32), dtype=self.dtype)
+            # Keys and values are (mostly) shared
+            kv = np.zeros((rows, n_states, n_entities, 24), dtype=self.dtype)
+            m = np.zeros((rows, n_states, n_entities), dtype=self.dtype)  # Mask is shared
+
+            scratch = None if self.use_numba else relative_scratch(rows * n_states, n_entities,
+                                                                   POS.start, ANG_VEL.stop, self.dtype)
+            buffers = self._buffers[key] = (q, kv, m, self._static_rows(lim_players), scratch)
+        q, kv, m, static, scratch = buffers
+        if self._mask_players.get(key) != n_players:
+            # The model adds the mask to the attention logits, padded rows get no weight at all
+            m[..., :n_players] = 0
+            m[..., n_players:lim_players] = -np.inf
+            self._mask_players[key] = n_players
+        if n_perspectives < rows:
+            if scratch is not None:
+                scratch = tuple(s[:n_perspectives * n_states] for s in scratch)
+            return q[:n_perspectives], kv[:n_perspectives], m[:n_perspectives], static, scratch
+        return buffers
+
+    def _fill_dynamic(self, kv: np.ndarray, encoded_states: np.ndarray, n_players: int, lim_players: int):
+        # Writes everything that changes between ticks from the blue perspective, before inversion and normalization
+        # kv is (..., n_states, n_entities, 24), any leading axes get the same values
+        ball_start_index = self.encoder.ball_start
+        players_start_index = self.encoder.players_start
+        player_length = self.encoder.player_length
+        r = self.encoder.rotation_length
+        tertiary = 2 + 2 * self.encoder.car_state_length
 
         # SELECTORS
-        sel_players = slice(0, lim_players)
-        sel_ball = sel_players.stop
+        sel_ball = lim_players
         sel_boosts = slice(sel_ball + 1, None)
 
-        # MAIN ARRAYS
-        q = np.zeros((n_players, encoded_states.shape[0], 1, 32))
-        kv = np.zeros((n_players, encoded_states.shape[0], n_entities, 24))  # Keys and values are (mostly) shared
-        m = np.zeros((n_players, encoded_states.shape[0], n_entities))  # Mask is shared
-
         # BALL
-        kv[:, :, sel_ball, 3] = 1
-        kv[:, :, sel_ball, np.r_[POS, LIN_VEL, ANG_VEL]] = encoded_states[:, ball_start_index: ball_start_index + 9]
+        kv[..., sel_ball, POS] = encoded_states[:, ball_start_index: ball_start_index + 3]
+        kv[..., sel_ball, LIN_VEL] = encoded_states[:, ball_start_index + 3: ball_start_index + 6]
+        kv[..., sel_ball, ANG_VEL] = encoded_states[:, ball_start_index + 6: ball_start_index + 9]
 
         # BOOSTS
-        kv[:, :, sel_boosts, IS_BOOST] = 1
-        kv[:, :, sel_boosts, POS] = self._boost_locations
-        kv[:, :, sel_boosts, BOOST] = 0.12 + 0.88 * (self._boost_locations[:, 2] > 72)
-        kv[:, :, sel_boosts, DEMO] = encoded_states[:, 3:3 + 34]  # FIXME boost timer
+        kv[..., sel_boosts, DEMO] = encoded_states[:, 3:ball_start_index]  # FIXME boost timer
 
         # PLAYERS
-        teams = encoded_states[0, players_start_index + 1::player_length]
-        kv[:, :, :n_players, IS_MATE] = 1 - teams  # Default team is blue
-        kv[:, :, :n_players, IS_OPP] = teams
-        for i in range(n_players):
-            encoded_player = encoded_states[:,
-                             players_start_index + i * player_length: players_start_index + (i + 1) * player_length]
-
-            kv[i, :, i, IS_SELF] = 1
-            kv[:, :, i, POS] = encoded_player[:, 2: 5]  # TODO constants for these indices
-            kv[:, :, i, LIN_VEL] = encoded_player[:, 9: 12]
-            quats = encoded_player[:, 5: 9]
-            rot_mtx = self._quats_to_rot_mtx(quats)
-            kv[:, :, i, FW] = rot_mtx[:, :, 0]
-            kv[:, :, i, UP] = rot_mtx[:, :, 2]
-            kv[:, :, i, ANG_VEL] = encoded_player[:, 12: 15]
-            kv[:, :, i, BOOST] = encoded_player[:, 37]
-            kv[:, :, i, DEMO] = encoded_player[:, 33]  # FIXME demo timer
-            kv[:, :, i, ON_GROUND] = encoded_player[:, 34]
-            kv[:, :, i, HAS_FLIP] = encoded_player[:, 36]
-
-        kv[teams == 1] *= self._invert
-        kv[np.argwhere(teams == 1), ..., (IS_MATE, IS_OPP)] = kv[
-            np.argwhere(teams == 1), ..., (IS_OPP, IS_MATE)]  # Swap teams
-
-        kv /= self._norm
-
-        for i in range(n_players):
-            q[i, :, 0, :kv.shape[-1]] = kv[i, :, i, :]
-
-        self.convert_to_relative(q, kv)
+        # (n_states, n_players, player_length) view, so each field is written for every player at once
+        encoded_players = encoded_states[:, players_start_index:].reshape(
+            encoded_states.shape[0], n_players, player_length)
+        players = slice(0, n_players)
+
+        kv[..., players, POS] = encoded_players[:, :, 2: 5]  # TODO constants for these indices
+        kv[..., players, LIN_VEL] = encoded_players[:, :, 5 + r: 8 + r]
+        if self.encoder.layout == ROTATION_LAYOUT:
+            kv[..., players, FW] = encoded_players[:, :, 5: 8]
+            kv[..., players, UP] = encoded_players[:, :, 8: 11]
+        else:
+            quats = encoded_players[:, :, 5: 9].reshape(-1, 4)
+            rot_mtx = self._quats_to_rot_mtx(quats).reshape(encoded_states.shape[0], n_players, 3, 3)
+            kv[..., players, FW] = rot_mtx[..., 0]
+            kv[..., players, UP] = rot_mtx[..., 2]
+        kv[..., players, ANG_VEL] = encoded_players[:, :, 8 + r: 11 + r]
+        kv[..., players, BOOST] = encoded_players[:, :, tertiary + 9]
+        kv[..., players, DEMO] = encoded_players[:, :, tertiary + 5]  # FIXME demo timer
+        kv[..., players, ON_GROUND] = encoded_players[:, :, tertiary + 6]
+        kv[..., players, HAS_FLIP] = encoded_players[:, :, tertiary + 8]
+
+    def _n_players(self, encoded_states: np.ndarray):
+        n_players = (encoded_states.shape[1] - self.encoder.players_start) // self.encoder.player_length
+        return n_players, self.lim_players(n_players)
+
+    def _build(self, encoded_states: np.ndarray, perspectives):
+        # Builds the observations of the players in perspectives into the reused buffers
+        n_players, lim_players = self._n_players(encoded_states)
+        q, kv, m, static, scratch = self._get_buffers(len(perspectives), encoded_states.shape[0], n_players)
+        teams = encoded_states[0, self.encoder.players_start + 1::self.encoder.player_length]
+        dynamic = slice(0, lim_players + 1)  # Players and ball, boosts only change in the DEMO column
+
+        for j, i in enumerate(perspectives):
+            np.copyto(kv[j], static[int(teams[i] == 1)])
+        self._fill_dynamic(kv, encoded_states, n_players, lim_players)
+
+        for j, i in enumerate(perspectives):
+            kv[j, :, i, IS_SELF] = 1
+            np.equal(teams, teams[i], out=kv[j, :, :n_players, IS_MATE])
+            np.not_equal(teams, teams[i], out=kv[j, :, :n_players, IS_OPP])
+            if teams[i] == 1:
+                kv[j, :, dynamic] *= self._invert
+
+        kv[..., dynamic, :] /= self._norm
+
+        for j, i in enumerate(perspectives):
+            q[j, :, 0, :kv.shape[-1]] = kv[j, :, i, :]
+        q[..., kv.shape[-1]:] = 0
+
+        self._convert_to_relative(q, kv, scratch)
         # kv[:, :, :, 5:11] -= q[:, :, :, 5:11]
 
-        # MASK
-        m[:, :, n_players: lim_players] = 1
+        return q, kv, m
+
+    def _convert_to_relative(self, q: np.ndarray, kv: np.ndarray, scratch):
+        # Entities relative to each perspective's car, in place, see obs_kernels.convert_to_relative_reference
+        if self.use_numba:
+            convert_to_relative_numba(q, kv, POS.start, FW.start, ANG_VEL.stop)
+        else:
+            convert_to_relative_matmul(q, kv, POS.start, FW.start, ANG_VEL.stop, scratch)
 
+    def batched_build_obs(self, encoded_states: np.ndarray):
+        # The returned arrays are reused by the next call with a roster in the same bucket
+        n_players, _ = self._n_players(encoded_states)
+        q, kv, m = self._build(encoded_states, range(n_players))
         return [(q[i], kv[i], m[i]) for i in range(n_players)]
 
+    def build_stacked(self, encoded_states: np.ndarray, keep_buffers: bool = True):
+        # Every player's observation of every state as (q, kv, m) arrays shaped (n_players, n_states, ...),
+        # for bulk conversion. Teams are read from the first state, so the states must all share one team layout
+        # The arrays are reused by the next call with the same shape, unless keep_buffers is False, which
+        # hands them over instead (for one-off numbers of states)
+        n_players, _ = self._n_players(encoded_states)
+        key = self._buffer_key(n_players, encoded_states.shape[0], n_players)
+        kept = key in self._buffers
+        q, kv, m = self._build(encoded_states, range(n_players))
+        if not (keep_buffers or kept):
+            self._release_buffers(key)
+        return q, kv, m
+
+    def _release_buffers(self, key):
+        self._buffers.pop(key, None)
+        self._mask_players.pop(key, None)
+
+    def single_build_obs(self, encoded_states: np.ndarray, player_index: int):
+        # Same as batched_build_obs(encoded_states)[player_index], without building the other perspectives
+        # The returned arrays are reused by the next call with a roster in the same bucket
+        q, kv, m = self._build(encoded_states, (player_index,))
+        return q[0], kv[0], m[0]
+
     def add_actions(self, obs: Any, previous_actions: np.ndarray, player_index=None):
         if player_index is None:
             for (q, kv, m), act in zip(obs, previous_actions):
@@ -314,3 +540,22 @@ class NextoObsBuilder(BatchedObsBuilder):
         else:
             q, kv, m = obs[player_index]
             q[:, 0, ACTIONS] = previous_actions
+
+
+def make_obs_builder(name: str = NUMPY_OBS_BUILDER, logger=None, use_numba: bool = False,
+                     **kwargs) -> NextoObsBuilder:
+    """
+    NextoObsBuilder (on the numba kernels with use_numba, falling back to the numpy ones without numba),
+    or with name=TORCH_OBS_BUILDER the TorchObsBuilder, which returns tensors and does its rotation math in torch
+    """
+    if name == NUMPY_OBS_BUILDER:
+        if use_numba and not HAVE_NUMBA:
+            if logger is not None:
+                logger.warning("use_numba needs numba (pip install numba), using the numpy kernels")
+            use_numba = False
+        return NextoObsBuilder(use_numba=use_numba, **kwargs)
+    if name == TORCH_OBS_BUILDER:
+        from .torch_obs import TorchObsBuilder
+
+        return TorchObsBuilder(**kwargs)
+    raise ValueError(f"Unknown observation builder '{name}', expected one of {', '.join(OBS_BUILDERS)}")
@@ -0,0 +1,229 @@
+"""
+Streaming conversion of tick recordings (see tick_recorder.py) into an observation dataset.
+Recordings are read a chunk of ticks at a time, and every player's observation of every tick in the
+chunk is built in one NextoObsBuilder.build_stacked call. Observations go into fixed-size shards of
+.npy files that np.load(..., mmap_mode='r') maps without reading them in. Each worker only holds
+one chunk and one shard at a time, so memory stays the same whatever the size of the dataset.
+Recordings are spread over a process pool.
+
+Every shard is four files with one row per observation:
+  <name>.q.npy (n, 1, 32), <name>.kv.npy (n, entities, 24), <name>.m.npy (n, entities)
+  <name>.meta.npy: the recording, record number, game time, player, beta and action of each row
+Rows are ordered by tick, then player in the recording's order: the recording bot, its teammates, then
+its opponents. Player 0 is the recording bot, the only one whose previous action (in q) and chosen
+action are known. The other players' observations have zero previous actions and action -1. Version 1
+recordings only kept that order on action ticks, so only their action ticks are converted.
+manifest.json lists the shards.
+
+Run with: python -m <bot package>.obs_dataset recordings/ --output dataset/ --workers 4
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .nexto_obs import ACTIONS, NextoObsBuilder
+from .synthetic_packets import make_field_info
+from .tick_recorder import RECORDING_SUFFIX, read_recording
+
+MANIFEST_FILE = "manifest.json"
+
+META_DTYPE = np.dtype([
+    ("recording", np.int32),  # Index into the manifest's recordings
+    ("record", np.int64),  # Record number in the recording
+    ("time", np.float32),
+    ("player", np.int16),
+    ("beta", np.float32),  # NaN on ticks without an action
+    ("action", np.int16),  # -1 where unknown
+])
+
+
+class ShardWriter:
+    """Collects observation rows into a shard_size buffer and writes it out as one shard when full"""
+
+    def __init__(self, output_dir: str, prefix: str, shard_size: int):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.shards = []  # Manifest entries of the shards written so far
+        self._n_entities = None
+        self._buffers = None
+        self._rows = 0
+
+    def _allocate(self, n_entities: int):
+        self._n_entities = n_entities
+        self._buffers = {
+            "q": np.empty((self.shard_size, 1, 32), dtype=np.float32),
+            "kv": np.empty((self.shard_size, n_entities, 24), dtype=np.float32),
+            "m": np.empty((self.shard_size, n_entities), dtype=np.float32),
+            "meta": np.empty(self.shard_size, dtype=META_DTYPE),
+        }
+
+    def add(self, q: np.ndarray, kv: np.ndarray, m: np.ndarray, meta: np.ndarray):
+        """Appends (n_players, n_states, ...) arrays from build_stacked and (n_states, n_players) meta rows"""
+        n_entities = kv.shape[-2]
+        if n_entities != self._n_entities:
+            # A shard holds one observation shape, a different roster size starts a new one
+            self.flush()
+            self._allocate(n_entities)
+        n_states, n_players = meta.shape
+        if n_players > self.shard_size:
+            raise ValueError(f"Shards of {self.shard_size} rows cannot hold the {n_players} players of a tick")
+        # Tick-major, so each tick's players are next to each other
+        arrays = {"q": q.swapaxes(0, 1), "kv": kv.swapaxes(0, 1), "m": m.swapaxes(0, 1), "meta": meta}
+        start = 0
+        while start < n_states:
+            take = min(n_states - start, (self.shard_size - self._rows) // n_players)
+            if take == 0:
+                self.flush()
+                continue
+            end = self._rows + take * n_players
+            for name, array in arrays.items():
+                rows = self._buffers[name][self._rows:end]
+                rows.reshape((take, n_players) + rows.shape[1:])[...] = array[start:start + take]
+            self._rows = end
+            start += take
+
+    def flush(self):
+        if not self._rows:
+            return
+        name = f"{self.prefix}-{len(self.shards):05d}"
+        for array_name, buffer in self._buffers.items():
+            path = os.path.join(self.output_dir, f"{name}.{array_name}.npy")
+            shard = np.lib.format.open_memmap(path, mode="w+", dtype=buffer.dtype,
+                                              shape=(self._rows,) + buffer.shape[1:])
+            shard[...] = buffer[:self._rows]
+            shard.flush()
+            del shard
+        self.shards.append({"name": name, "rows": self._rows, "entities": self._n_entities})
+        self._rows = 0
+
+
+def _runs(records, encoder, chunk_size: int, action_ticks: bool):
+    """
+    Yields (states, records) runs of at most chunk_size records whose encoded states share a length and
+    team layout, as build_stacked needs. In the recording bot's player order the layout only changes when
+    cars join or leave. The states array is reused by the next run.
+    """
+    teams = slice(encoder.players_start + 1, None, encoder.player_length)
+    states = None
+    run = []
+    for number, record in enumerate(records):
+        if action_ticks and record["action"] is None:
+            continue
+        record["number"] = number
+        state = record["state"][0]
+        if run and (len(run) == chunk_size or len(state) != states.shape[1]
+                    or not np.array_equal(state[teams], states[0, teams])):
+            yield states[:len(run)], run
+            run = []
+        if states is None or len(state) != states.shape[1]:
+            states = np.empty((chunk_size, len(state)), dtype=np.float32)
+        states[len(run)] = state
+        run.append(record)
+    if run:
+        yield states[:len(run)], run
+
+
+def convert_recording(path: str, output_dir: str, recording_index: int, chunk_size: int = 1024,
+                      shard_size: int = 8192, action_ticks: bool = False):
+    """Writes the observations of one recording into shards, returns its manifest entries"""
+    header, records = read_recording(path)
+    if header["version"] < 2:
+        action_ticks = True  # The other ticks are in packet order, player 0 is not the bot
+    builder = NextoObsBuilder(field_info=make_field_info(header["boost_locations"]), layout=header["layout"],
+                              roster_buckets=header.get("roster_buckets"))
+    prefix = f"{recording_index:04d}-{os.path.splitext(os.path.basename(path))[0]}"
+    writer = ShardWriter(output_dir, prefix, shard_size)
+
+    n_records = 0
+    for states, run in _runs(records, builder.encoder, chunk_size, action_ticks):
+        n_states = len(run)
+        q, kv, m = builder.build_stacked(states, keep_buffers=n_states == chunk_size)
+        n_players = q.shape[0]
+
+        meta = np.empty((n_states, n_players), dtype=META_DTYPE)
+        meta["recording"] = recording_index
+        meta["player"] = np.arange(n_players)
+        meta["action"] = -1
+        for s, record in enumerate(run):
+            meta["record"][s] = record["number"]
+            meta["time"][s] = record["time"]
+            meta["beta"][s] = np.nan if record["beta"] is None else record["beta"]
+            if record["action"] is not None:
+                meta["action"][s, 0] = record["action"]
+            if record["prev_action"] is not None:
+                q[0, s, 0, ACTIONS.start:ACTIONS.stop] = record["prev_action"]
+
+        writer.add(q, kv, m, meta)
+        n_records += n_states
+    writer.flush()
+    return {"path": os.path.abspath(path), "records": n_records, "action_ticks": action_ticks,
+            "shards": writer.shards}
+
+
+def find_recordings(paths):
+    """Recording files among paths, directories are searched for RECORDING_SUFFIX files"""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(sorted(glob.glob(os.path.join(path, f"*{RECORDING_SUFFIX}"))))
+        else:
+            found.append(path)
+    return found
+
+
+def convert(paths, output_dir: str, workers: int = None, chunk_size: int = 1024, shard_size: int = 8192,
+            action_ticks: bool = False):
+    """Converts the recordings on a pool of worker processes, one recording per task, and writes the manifest"""
+    os.makedirs(output_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(convert_recording, path, output_dir, i, chunk_size, shard_size, action_ticks)
+                   for i, path in enumerate(paths)]
+        recordings = [future.result() for future in futures]
+
+    manifest = {
+        "created_at": time.time(),
+        "action_ticks": action_ticks,
+        "recordings": recordings,
+        "rows": sum(shard["rows"] for recording in recordings for shard in recording["shards"]),
+    }
+    with open(os.path.join(output_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def load_shard(output_dir: str, name: str):
+    """(q, kv, m, meta) of a shard, memory-mapped read-only"""
+    return tuple(np.load(os.path.join(output_dir, f"{name}.{array}.npy"), mmap_mode='r')
+                 for array in ("q", "kv", "m", "meta"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert tick recordings into a sharded observation dataset")
+    parser.add_argument("paths", nargs="+", help=f"Recordings, or directories of {RECORDING_SUFFIX} files")
+    parser.add_argument("--output", type=str, required=True, help="Directory to write the shards and manifest to")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes, one per CPU by default")
+    parser.add_argument("--chunk-size", type=int, default=1024, help="Ticks built per build_stacked call")
+    parser.add_argument("--shard-size", type=int, default=8192, help="Observations per shard")
+    parser.add_argument("--action-ticks", action="store_true", help="Only convert the ticks Nexto picked an action on")
+    args = parser.parse_args()
+
+    paths = find_recordings(args.paths)
+    if not paths:
+        parser.error("no recordings found")
+    start = time.perf_counter()
+    manifest = convert(paths, args.output, args.workers, args.chunk_size, args.shard_size, args.action_ticks)
+    seconds = time.perf_counter() - start
+    n_shards = sum(len(recording["shards"]) for recording in manifest["recordings"])
+    print(f"{len(paths)} recordings, {manifest['rows']} observations in {n_shards} shards "
+          f"in {seconds:.1f} s ({manifest['rows'] / seconds:.0f} observations/s)")
+
+
+if __name__ == "__main__":
+    main()
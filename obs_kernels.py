@@ -0,0 +1,230 @@
+"""
+Kernels for the rotation math of the observation builder.
+Both numpy kernels turn a pile of small strided ufunc calls into one batched matrix product over
+contiguous out= buffers: quats_to_rot_mtx maps the quaternion's pairwise products to the matrix,
+convert_to_relative_matmul applies translation and rotation as one affine transform per observation.
+With use_numba (needs numba), the builder uses a compiled loop for each instead, doing all the work in one pass.
+
+Compare them with: python -m <bot package>.bench_kernels
+"""
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+HAVE_NUMBA = numba is not None
+
+
+def quats_to_rot_mtx_reference(quats: np.ndarray) -> np.ndarray:
+    # From rlgym.utils.math.quat_to_rot_mtx, the original for parity checks and benchmarks
+    w = -quats[:, 0]
+    x = -quats[:, 1]
+    y = -quats[:, 2]
+    z = -quats[:, 3]
+
+    theta = np.zeros((quats.shape[0], 3, 3), dtype=quats.dtype)
+
+    norm = np.einsum("fq,fq->f", quats, quats)
+
+    sel = norm != 0
+
+    w = w[sel]
+    x = x[sel]
+    y = y[sel]
+    z = z[sel]
+
+    s = 1.0 / norm[sel]
+
+    # front direction
+    theta[sel, 0, 0] = 1.0 - 2.0 * s * (y * y + z * z)
+    theta[sel, 1, 0] = 2.0 * s * (x * y + z * w)
+    theta[sel, 2, 0] = 2.0 * s * (x * z - y * w)
+
+    # left direction
+    theta[sel, 0, 1] = 2.0 * s * (x * y - z * w)
+    theta[sel, 1, 1] = 1.0 - 2.0 * s * (x * x + z * z)
+    theta[sel, 2, 1] = 2.0 * s * (y * z + x * w)
+
+    # up direction
+    theta[sel, 0, 2] = 2.0 * s * (x * z + y * w)
+    theta[sel, 1, 2] = 2.0 * s * (y * z - x * w)
+    theta[sel, 2, 2] = 1.0 - 2.0 * s * (x * x + y * y)
+
+    return theta
+
+
+def convert_to_relative_reference(q: np.ndarray, kv: np.ndarray, pos: int, fw: int, stop: int):
+    # The builder's original ufunc version, for parity checks and benchmarks, converts kv in place
+    kv[..., pos:pos + 3] -= q[..., pos:pos + 3]
+    theta = np.arctan2(q[..., fw], q[..., fw + 1])
+    theta = np.expand_dims(theta, axis=-1)
+    ct = np.cos(theta)
+    st = np.sin(theta)
+    xs = kv[..., pos:stop:3]
+    ys = kv[..., pos + 1:stop:3]
+    # Use temp variables to prevent modifying original array
+    nx = ct * xs - st * ys
+    ny = st * xs + ct * ys
+    kv[..., pos:stop:3] = nx  # x-components
+    kv[..., pos + 1:stop:3] = ny  # y-components
+
+
+def _products_to_rot_mtx():
+    # Every entry of the rotation matrix is 2 / norm times a sum of products of two quaternion components
+    # (signs of the negated components cancel), plus 1 on the diagonal. (16, 9) map from the flattened
+    # outer product of (w, x, y, z) with itself to the flattened matrix
+    w, x, y, z = range(4)
+    terms = {
+        (0, 0): [(-1, y, y), (-1, z, z)], (0, 1): [(1, x, y), (-1, z, w)], (0, 2): [(1, x, z), (1, y, w)],
+        (1, 0): [(1, x, y), (1, z, w)], (1, 1): [(-1, x, x), (-1, z, z)], (1, 2): [(1, y, z), (-1, x, w)],
+        (2, 0): [(1, x, z), (-1, y, w)], (2, 1): [(1, y, z), (1, x, w)], (2, 2): [(-1, x, x), (-1, y, y)],
+    }
+    a = np.zeros((4, 4, 3, 3))
+    for (row, col), products in terms.items():
+        for sign, i, j in products:
+            a[i, j, row, col] += 2 * sign
+    return a.reshape(16, 9)
+
+
+_PRODUCTS_TO_ROT_MTX = _products_to_rot_mtx()
+_IDENTITY = np.eye(3).ravel()
+# (products to matrix map, flattened identity) per dtype, so calls do not cast them every time
+_ROT_MTX_CONSTANTS = {}
+
+
+def _rot_mtx_constants(dtype):
+    constants = _ROT_MTX_CONSTANTS.get(dtype)
+    if constants is None:
+        constants = _ROT_MTX_CONSTANTS[dtype] = (_PRODUCTS_TO_ROT_MTX.astype(dtype), _IDENTITY.astype(dtype))
+    return constants
+
+
+def rot_mtx_buffers(n: int, dtype=np.float32):
+    """(out, products, scale) buffers for quats_to_rot_mtx on n quaternions"""
+    return np.empty((n, 3, 3), dtype=dtype), np.empty((n, 4, 4), dtype=dtype), np.empty(n, dtype=dtype)
+
+
+def quats_to_rot_mtx(quats: np.ndarray, buffers=None) -> np.ndarray:
+    """
+    Same as quats_to_rot_mtx_reference, into buffers from rot_mtx_buffers (allocated if None), which
+    hold the result: out[i] is the rotation matrix of quats[i], all zeros for a zero quaternion.
+    """
+    n = quats.shape[0]
+    out, products, scale = buffers if buffers is not None else rot_mtx_buffers(n, quats.dtype)
+    products_to_rot_mtx, identity = _rot_mtx_constants(quats.dtype)
+    np.multiply(quats[:, :, None], quats[:, None, :], out=products)
+    np.einsum("fqq->f", products, out=scale)  # Squared norm, the diagonal of the products
+    zero = scale == 0
+    scale[zero] = 1  # Rows of zero quaternions are cleared below
+    np.divide(1, scale, out=scale)
+    products *= scale[:, None, None]
+    flat = out.reshape(n, 9)
+    np.matmul(products.reshape(n, 16), products_to_rot_mtx, out=flat)
+    flat += identity
+    if zero.any():
+        out[zero] = 0
+    return out
+
+
+def relative_scratch(n: int, n_entities: int, pos: int, stop: int, dtype=np.float32):
+    """(rows, transform, result, angle, cos, sin) buffers for convert_to_relative_matmul on n observations"""
+    width = stop - pos
+    rows = np.empty((n, n_entities, width + 1), dtype=dtype)
+    rows[..., width] = 1  # Homogeneous coordinate, picks up the translation in the last row of the transform
+    transform = np.zeros((n, width + 1, width), dtype=dtype)
+    # Block diagonal, one 3x3 rotation per vector, entry (k, k + d) of the flattened blocks is at k * (width + 1) + d
+    transform.reshape(n, -1)[:, 2 * (width + 1):width * width:3 * (width + 1)] = 1  # z components stay
+    result = np.empty((n, n_entities, width), dtype=dtype)
+    angle, cos, sin = (np.empty((n, 1), dtype=dtype) for _ in range(3))
+    return rows, transform, result, angle, cos, sin
+
+
+def convert_to_relative_matmul(q: np.ndarray, kv: np.ndarray, pos: int, fw: int, stop: int, scratch=None):
+    """
+    convert_to_relative_reference as one matrix product per observation, for C-contiguous
+    q (..., 1, 32) and kv (..., n_entities, 24), with buffers from relative_scratch (allocated if None).
+    Positions (from column pos) are made relative to q's, then the x/y pairs of every vector from pos
+    to stop are rotated by the heading of q's forward vector (column fw). Rotating before subtracting
+    (R p - R q) rounds a little differently from the original, within float32 precision.
+    """
+    width = stop - pos
+    q = q.reshape(-1, q.shape[-1])
+    n = q.shape[0]
+    if scratch is None:
+        scratch = relative_scratch(n, kv.shape[-2], pos, stop, kv.dtype)
+    rows, transform, result, angle, cos, sin = scratch
+    block = kv.reshape(n, kv.shape[-2], kv.shape[-1])[..., pos:stop]
+
+    np.arctan2(q[:, fw:fw + 1], q[:, fw + 1:fw + 2], out=angle)
+    np.cos(angle, out=cos)
+    np.sin(angle, out=sin)
+    # Row vectors times the transform: x' = x cos - y sin, y' = x sin + y cos
+    blocks = transform.reshape(n, -1)[:, :width * width]
+    step = 3 * (width + 1)
+    blocks[:, ::step] = cos
+    blocks[:, 1::step] = sin
+    np.negative(sin, out=blocks[:, width::step])
+    blocks[:, width + 1::step] = cos
+    # Translation row, minus q's rotated position
+    translation = transform[:, width:, :3]
+    np.matmul(q[:, None, pos:pos + 3], transform[:, :3, :3], out=translation)
+    np.negative(translation, out=translation)
+
+    np.copyto(rows[..., :width], block)
+    np.matmul(rows, transform, out=result)
+    np.copyto(block, result)
+
+
+if HAVE_NUMBA:
+    @numba.njit(cache=True)
+    def _rot_mtx_kernel(quats, out):
+        for i in range(quats.shape[0]):
+            w = quats[i, 0]
+            x = quats[i, 1]
+            y = quats[i, 2]
+            z = quats[i, 3]
+            norm = w * w + x * x + y * y + z * z
+            if norm == 0:
+                out[i] = 0
+                continue
+            s = 2 / norm
+            out[i, 0, 0] = 1 - s * (y * y + z * z)
+            out[i, 1, 0] = s * (x * y + z * w)
+            out[i, 2, 0] = s * (x * z - y * w)
+            out[i, 0, 1] = s * (x * y - z * w)
+            out[i, 1, 1] = 1 - s * (x * x + z * z)
+            out[i, 2, 1] = s * (y * z + x * w)
+            out[i, 0, 2] = s * (x * z + y * w)
+            out[i, 1, 2] = s * (y * z - x * w)
+            out[i, 2, 2] = 1 - s * (x * x + y * y)
+
+    @numba.njit(cache=True)
+    def _relative_kernel(q, kv, pos, fw, stop):
+        for n in range(kv.shape[0]):
+            theta = np.arctan2(q[n, 0, fw], q[n, 0, fw + 1])
+            ct = np.cos(theta)
+            st = np.sin(theta)
+            for e in range(kv.shape[1]):
+                for k in range(3):
+                    kv[n, e, pos + k] -= q[n, 0, pos + k]
+                for k in range(pos, stop, 3):
+                    x = kv[n, e, k]
+                    y = kv[n, e, k + 1]
+                    kv[n, e, k] = ct * x - st * y
+                    kv[n, e, k + 1] = st * x + ct * y
+
+
+def quats_to_rot_mtx_numba(quats: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """quats_to_rot_mtx as one compiled loop, needs numba"""
+    if out is None:
+        out = np.empty((quats.shape[0], 3, 3), dtype=quats.dtype)
+    _rot_mtx_kernel(quats, out)
+    return out
+
+
+def convert_to_relative_numba(q: np.ndarray, kv: np.ndarray, pos: int, fw: int, stop: int):
+    """convert_to_relative_matmul as one compiled loop, needs numba"""
+    _relative_kernel(q.reshape(-1, 1, q.shape[-1]), kv.reshape(-1, kv.shape[-2], kv.shape[-1]), pos, fw, stop)
@@ -0,0 +1,227 @@
+"""
+Parity checks for the observation pipeline.
+Builds observations for every player of synthetic states with the current pipeline and with the
+frozen baseline one (tests/obs_reference.py), and compares the arrays and the actions the model picks
+from them, for both encoder layouts and for observations padded to the roster buckets.
+Also checks bit for bit that the encoder writes the baseline's values and that the builder in float64
+with the baseline's rotation kernels reproduces the baseline, the float32 observations against ones
+built in float64, and that the agent wraps them without copying.
+
+Run with: python -m <bot package>.obs_parity
+"""
+
+import argparse
+import sys
+
+import numpy as np
+
+import torch
+
+from .agent import Agent, as_tensor
+from .nexto_obs import (ANG_VEL, FW, POS, QUATERNION_LAYOUT, ROSTER_BUCKETS, ROTATION_LAYOUT, GameStateEncoder,
+                        NextoObsBuilder)
+from .obs_kernels import convert_to_relative_reference, quats_to_rot_mtx_reference
+from .synthetic_packets import ROSTERS, make_states
+from .tests.obs_reference import ReferenceObsBuilder, encode_gamestate
+
+# Largest difference from the baseline accepted per layout. Building in float32 from float32 encoded
+# states rounds differently from the float64 baseline (up to about 1.5e-6 here), and the quaternion
+# layout also rounds its quaternions to float32, which the heading angle amplifies when a car points
+# almost straight up (up to about 1e-4 in the relative positions of the synthetic 3v3 states)
+TOLERANCES = {QUATERNION_LAYOUT: 2e-4, ROTATION_LAYOUT: 1e-5}
+
+
+class ReferenceKernelsBuilder(NextoObsBuilder):
+    """NextoObsBuilder with the baseline's rotation math, in float64 it must reproduce the baseline exactly"""
+
+    def __init__(self, layout: str):
+        super().__init__(layout=layout, dtype=np.float64, use_numba=False)
+
+    def _quats_to_rot_mtx(self, quats: np.ndarray) -> np.ndarray:
+        return quats_to_rot_mtx_reference(quats)
+
+    def _convert_to_relative(self, q: np.ndarray, kv: np.ndarray, scratch):
+        convert_to_relative_reference(q, kv, POS.start, FW.start, ANG_VEL.stop)
+
+
+def _copy(obs):
+    # Builders reuse their output arrays, keep our own copy
+    return tuple(a.copy() for a in obs)
+
+
+def reference_encoded(states):
+    # Baseline encoded states, float64 with quaternions
+    return [np.expand_dims(encode_gamestate(state), axis=0) for state in states]
+
+
+def build_reference(states):
+    # Observations as the baseline build_obs produced them, float64 with the quaternion round trip
+    builder = ReferenceObsBuilder()
+    return [[_copy(obs) for obs in builder.batched_build_obs(encoded)] for encoded in reference_encoded(states)]
+
+
+def build_with(builder: NextoObsBuilder, states):
+    # Per-player path as used by build_obs, through the builder's own encoder
+    return [[_copy(builder.single_build_obs(builder.encoder.encode(state), i)) for i in range(len(state.players))]
+            for state in states]
+
+
+def to_rotation_layout(encoded: np.ndarray) -> np.ndarray:
+    """
+    Baseline encoded states in the rotation layout, with the forward and up vectors the baseline
+    builder derives from their quaternions, so the rotation layout can be checked bit for bit
+    """
+    quat, rot = GameStateEncoder(layout=QUATERNION_LAYOUT), GameStateEncoder(layout=ROTATION_LAYOUT)
+    n_states = encoded.shape[0]
+    n_players = (encoded.shape[1] - quat.players_start) // quat.player_length
+    out = np.zeros((n_states, rot.state_length(n_players)), dtype=encoded.dtype)
+    out[:, :quat.players_start] = encoded[:, :quat.players_start]
+    quat_players = encoded[:, quat.players_start:].reshape(n_states, n_players, quat.player_length)
+    rot_players = out[:, rot.players_start:].reshape(n_states, n_players, rot.player_length)
+    rot_players[..., :2] = quat_players[..., :2]
+    for k in range(2):  # Car data, then inverted car data
+        q_start = 2 + k * quat.car_state_length
+        r_start = 2 + k * rot.car_state_length
+        rot_players[..., r_start:r_start + 3] = quat_players[..., q_start:q_start + 3]
+        rot_mtx = quats_to_rot_mtx_reference(quat_players[..., q_start + 3:q_start + 7].reshape(-1, 4))
+        rot_mtx = rot_mtx.reshape(n_states, n_players, 3, 3)
+        rot_players[..., r_start + 3:r_start + 6] = rot_mtx[..., 0]
+        rot_players[..., r_start + 6:r_start + 9] = rot_mtx[..., 2]
+        rot_players[..., r_start + 9:r_start + 15] = quat_players[..., q_start + 7:q_start + 13]
+    rot_players[..., 2 + 2 * rot.car_state_length:] = quat_players[..., 2 + 2 * quat.car_state_length:]
+    return out
+
+
+def _unpadded(obs, n_players: int, lim_players: int):
+    # Without the masked rows of padding cars, in the shapes the baseline builds
+    q, kv, m = obs
+    keep = np.r_[0:n_players, lim_players:kv.shape[-2]]
+    return q, kv[..., keep, :], m[..., keep]
+
+
+def compare(agent: Agent, expected, actual, unpad=None):
+    """
+    Differences between the observations and agreement of the actions picked from them. With unpad,
+    the arrays are compared after unpad(obs, n_players) and the actions picked from the padded ones.
+    """
+    max_diff = 0.0
+    bit_exact = True
+    n_obs = n_agree = 0
+    for exp_state, act_state in zip(expected, actual):
+        for exp, act in zip(exp_state, act_state):
+            values = act if unpad is None else unpad(act, len(exp_state))
+            for e, a in zip(exp, values):
+                bit_exact &= e.shape == a.shape and e.dtype == a.dtype and np.array_equal(e, a)
+                max_diff = max(max_diff, float(np.abs(e - a).max()))
+            exp_action, _ = agent.select_actions(exp, 1)
+            act_action, _ = agent.select_actions(act, 1)
+            n_agree += int(np.array_equal(exp_action, act_action))
+            n_obs += 1
+    return {"bit_exact": bool(bit_exact), "max_abs_diff": max_diff, "action_agreement": n_agree / n_obs}
+
+
+def check_layouts(agent: Agent, states, reference=None):
+    """Both encoder layouts against the baseline pipeline"""
+    reference = reference or build_reference(states)
+    return {
+        QUATERNION_LAYOUT: compare(agent, reference, build_with(NextoObsBuilder(layout=QUATERNION_LAYOUT), states)),
+        ROTATION_LAYOUT: compare(agent, reference, build_with(NextoObsBuilder(layout=ROTATION_LAYOUT), states)),
+    }
+
+
+def check_padding(agent: Agent, states, reference=None):
+    """Observations padded to the roster buckets, as the bot builds them, against the baseline pipeline"""
+    reference = reference or build_reference(states)
+    builder = NextoObsBuilder(roster_buckets=ROSTER_BUCKETS)
+    return compare(agent, reference, build_with(builder, states),
+                   unpad=lambda obs, n_players: _unpadded(obs, n_players, builder.lim_players(n_players)))
+
+
+def check_encoder(states):
+    """Whether the quaternion layout encoder writes exactly the baseline's values rounded to float32"""
+    encoder = GameStateEncoder(layout=QUATERNION_LAYOUT)
+    return all(np.array_equal(encoder.encode(state), encoded.astype(np.float32))
+               for state, encoded in zip(states, reference_encoded(states)))
+
+
+def check_exact(agent: Agent, states, reference=None):
+    """
+    Both layouts built in float64 with the baseline's rotation kernels from the baseline's encoded states,
+    which must match the baseline bit for bit: everything but the kernels and the float32 rounding
+    """
+    reference = reference or build_reference(states)
+    encoded = reference_encoded(states)
+    results = {}
+    for layout, convert in ((QUATERNION_LAYOUT, lambda e: e), (ROTATION_LAYOUT, to_rotation_layout)):
+        builder = ReferenceKernelsBuilder(layout)
+        actual = [[_copy(obs) for obs in builder.batched_build_obs(convert(e))] for e in encoded]
+        results[layout] = compare(agent, reference, actual)
+    return results
+
+
+def check_precision(agent: Agent, states):
+    """The float32 pipeline the bot runs against the same builder working in float64"""
+    return compare(agent, build_with(NextoObsBuilder(dtype=np.float64), states),
+                   build_with(NextoObsBuilder(dtype=np.float32), states))
+
+
+def check_zero_copy(states):
+    """Whether every observation array is float32 and C-contiguous, and the agent's tensors share its memory"""
+    builder = NextoObsBuilder()
+    for state in states:
+        for i in range(len(state.players)):
+            for array in builder.single_build_obs(builder.encoder.encode(state), i):
+                tensor = as_tensor(array)
+                if not (array.dtype == np.float32 and array.flags.c_contiguous
+                        and tensor.dtype == torch.float32 and tensor.data_ptr() == array.ctypes.data):
+                    return False
+    return True
+
+
+def _report(roster: str, name: str, result, passed: bool):
+    print(f"{roster} {name:<16} bit_exact={result['bit_exact']!s:<5} max_abs_diff={result['max_abs_diff']:.3g} "
+          f"action_agreement={result['action_agreement']:.2%} {'OK' if passed else 'FAIL'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Observation pipeline parity checks")
+    parser.add_argument("--states", type=int, default=200, help="Number of synthetic states per roster")
+    args = parser.parse_args()
+
+    agent = Agent()
+    ok = True
+    for roster, n_cars in ROSTERS.items():
+        states = make_states(args.states, n_cars, seed=n_cars)
+        reference = build_reference(states)
+
+        passed = check_encoder(states)
+        ok &= passed
+        print(f"{roster} {'encoder':<16} {'OK' if passed else 'FAIL'}")
+        for layout, result in check_exact(agent, states, reference).items():
+            passed = result["bit_exact"]
+            ok &= passed
+            _report(roster, f"{layout}-float64", result, passed)
+
+        results = check_layouts(agent, states, reference)
+        results["padded"] = check_padding(agent, states, reference)
+        for name, result in results.items():
+            # Padded observations are built in the default rotation layout
+            tolerance = TOLERANCES.get(name, TOLERANCES[ROTATION_LAYOUT])
+            passed = result["max_abs_diff"] <= tolerance and result["action_agreement"] == 1
+            ok &= passed
+            _report(roster, name, result, passed)
+
+        # float32 rounding only
+        result = check_precision(agent, states)
+        passed = result["max_abs_diff"] <= TOLERANCES[ROTATION_LAYOUT] and result["action_agreement"] == 1
+        ok &= passed
+        _report(roster, "float32", result, passed)
+        passed = check_zero_copy(states[:10])
+        ok &= passed
+        print(f"{roster} {'zero-copy':<16} {'OK' if passed else 'FAIL'}")
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
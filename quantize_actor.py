@@ -0,0 +1,103 @@
+"""
+Dynamic INT8 quantization of the Nexto actor.
+Quantizes the Linear layers of the TorchScript model to INT8 (activations stay float and are
+quantized on the fly), then only writes the result for the int8 inference backend if it picks the
+same action as the fp32 model on enough of the observation corpus.
+
+Run with: python -m <bot package>.quantize_actor --min-agreement 0.95
+"""
+
+import argparse
+import gc
+import io
+import os
+import sys
+import timeit
+
+import numpy as np
+import psutil
+import torch
+from torch.ao.quantization import quantize_dynamic_jit, per_channel_dynamic_qconfig
+
+from .agent import Agent
+from .backend_parity import build_observations, load_observations
+from .inference_backends import MODEL_DIR, INT8_MODEL_FILE, load_torchscript
+
+
+def quantize(actor, keep_fp32=()):
+    """Dynamically quantized copy of a TorchScript actor, submodules in keep_fp32 are left as they are"""
+    qconfig_dict = {"": per_channel_dynamic_qconfig}
+    qconfig_dict.update({name: None for name in keep_fp32})
+    return quantize_dynamic_jit(actor.eval(), qconfig_dict)
+
+
+def _reload(module):
+    # Serialized size and resident memory taken by loading it, also checks the module survives a save
+    buffer = io.BytesIO()
+    torch.jit.save(module, buffer)
+    buffer.seek(0)
+    gc.collect()
+    rss = psutil.Process().memory_info().rss
+    loaded = torch.jit.load(buffer)
+    gc.collect()
+    return loaded, len(buffer.getvalue()), psutil.Process().memory_info().rss - rss
+
+
+def action_agreement(reference, candidate, obs, lookup_table):
+    """Share of observations where both actors' argmax is the same row of the lookup table"""
+    state = tuple(torch.from_numpy(o) for o in obs)
+    with torch.no_grad():
+        expected = reference(state)[0].argmax(dim=-1).numpy()
+        actual = candidate(state)[0].argmax(dim=-1).numpy()
+    return float(np.mean(np.all(lookup_table[expected] == lookup_table[actual], axis=-1)))
+
+
+def latency_us(actor, obs, number):
+    state = tuple(torch.from_numpy(o[:1]) for o in obs)
+    with torch.no_grad():
+        return min(timeit.repeat(lambda: actor(state), number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dynamic INT8 quantization of the Nexto actor")
+    parser.add_argument("--min-agreement", type=float, default=0.95,
+                        help="Share of the corpus where the quantized model must pick the fp32 action")
+    parser.add_argument("--keep-fp32", nargs="*", default=[],
+                        help="Submodules to leave unquantized, e.g. net.output net.earl.key_value_preprocess")
+    parser.add_argument("--states", type=int, default=200, help="Number of synthetic states per roster")
+    parser.add_argument("--obs-file", type=str, default=None,
+                        help="Observation corpus (.npz, see backend_parity.py --save-obs) instead of synthetic states")
+    parser.add_argument("--number", type=int, default=200, help="Forward passes per timing")
+    parser.add_argument("--output", type=str, default=os.path.join(MODEL_DIR, INT8_MODEL_FILE))
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)  # Same as Agent
+    observations = load_observations(args.obs_file) if args.obs_file else build_observations(args.states)
+    lookup_table = Agent.make_lookup_table()
+
+    fp32, fp32_bytes, fp32_rss = _reload(load_torchscript())
+    int8, int8_bytes, int8_rss = _reload(quantize(fp32, args.keep_fp32))
+
+    n_agree = n_obs = 0
+    for roster, obs in observations.items():
+        agreement = action_agreement(fp32, int8, obs, lookup_table)
+        n_agree += agreement * len(obs[0])
+        n_obs += len(obs[0])
+        t_fp32 = latency_us(fp32, obs, args.number)
+        t_int8 = latency_us(int8, obs, args.number)
+        print(f"{roster} action_agreement={agreement:.2%} fp32={t_fp32:.0f} us int8={t_int8:.0f} us "
+              f"({t_fp32 / t_int8:.2f}x)")
+
+    print(f"model size: fp32={fp32_bytes / 2 ** 20:.2f} MiB int8={int8_bytes / 2 ** 20:.2f} MiB, "
+          f"RSS on load: fp32={fp32_rss / 2 ** 20:.2f} MiB int8={int8_rss / 2 ** 20:.2f} MiB")
+
+    agreement = n_agree / n_obs
+    if agreement < args.min_agreement:
+        print(f"Rejected: action agreement {agreement:.2%} is below {args.min_agreement:.2%}, nothing written")
+        sys.exit(1)
+    torch.jit.save(int8, args.output)
+    print(f"Accepted: action agreement {agreement:.2%}, wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Deterministic replay of tick recordings (see tick_recorder.py).
+Drives NextoObsBuilder and Agent from the recorded encoded states exactly like Nexto.get_output does
+on its action ticks and checks that the same actions come out.
+
+Run with: python -m <bot package>.replay path/to/recording.ticks
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from .agent import Agent
+from .nexto_obs import NUMPY_OBS_BUILDER, OBS_BUILDERS, make_obs_builder
+from .synthetic_packets import make_field_info
+from .tick_recorder import read_recording
+
+
+class ReplayEngine:
+    def __init__(self, path, backend: str = None, obs_builder: str = None):
+        self.path = path
+        self.header, self.records = read_recording(path)
+        # Stochastic actions only repeat with the seed and backend the bot ran with
+        self.agent = Agent(backend or self.header["backend"], seed=self.header["seed"], attention_weights=False)
+        # Recordings from before roster buckets have none, and unpadded observations
+        self.obs_builder = make_obs_builder(obs_builder or self.header.get("obs_builder", NUMPY_OBS_BUILDER),
+                                            field_info=make_field_info(self.header["boost_locations"]),
+                                            layout=self.header["layout"],
+                                            roster_buckets=self.header.get("roster_buckets"))
+
+    def run(self):
+        """Yields (record, replayed action index, seconds spent) for every action tick"""
+        for record in self.records:
+            if record["action"] is None:
+                continue
+            start = time.perf_counter()
+            obs = self.obs_builder.single_build_obs(record["state"], 0)
+            self.obs_builder.add_actions((obs,), record["prev_action"], 0)
+            action, _, _ = self.agent.select_action(obs, record["beta"])
+            yield record, action, time.perf_counter() - start
+
+    def run_batched(self, chunk_size: int = 256):
+        """
+        Yields (record, replayed action index) for every action tick, building all observations first
+        and picking the actions with Agent.act_batch. Gives the same actions as run, much faster.
+        """
+        records, observations = [], []
+        for record in self.records:
+            if record["action"] is None:
+                continue
+            obs = self.obs_builder.single_build_obs(record["state"], 0)
+            self.obs_builder.add_actions((obs,), record["prev_action"], 0)
+            records.append(record)
+            observations.append(tuple(np.array(o) for o in obs))  # The builder reuses its buffers
+
+        # act_batch needs one entity count per stack, which only changes when cars join or leave
+        start = 0
+        while start < len(records):
+            end = start + 1
+            while end < len(records) and observations[end][1].shape == observations[start][1].shape:
+                end += 1
+            state = tuple(np.concatenate([obs[k] for obs in observations[start:end]]) for k in range(3))
+            betas = [record["beta"] for record in records[start:end]]
+            actions, _, _ = self.agent.act_batch(state, betas, chunk_size=chunk_size)
+            yield from zip(records[start:end], actions.tolist())
+            start = end
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a Nexto tick recording")
+    parser.add_argument("path", help="Recording written by a bot with record_directory set")
+    parser.add_argument("--backend", type=str, default=None, help="Override the recorded inference backend")
+    parser.add_argument("--obs-builder", type=str, default=None, choices=OBS_BUILDERS,
+                        help="Override the recorded observation builder")
+    parser.add_argument("--batch", action="store_true",
+                        help="Build every observation first and pick the actions in batches")
+    parser.add_argument("--chunk-size", type=int, default=256, help="Observations per forward pass with --batch")
+    args = parser.parse_args()
+
+    engine = ReplayEngine(args.path, args.backend, args.obs_builder)
+    if args.batch:
+        start = time.perf_counter()
+        results = list(engine.run_batched(args.chunk_size))
+        speed = f"{len(results) / (time.perf_counter() - start):.0f} action ticks/s"
+    else:
+        results, seconds = [], []
+        for record, action, elapsed in engine.run():
+            results.append((record, action))
+            seconds.append(elapsed)
+        us = np.array(seconds) * 1e6
+        speed = f"build_obs+act p50={np.percentile(us, 50):.0f} us p99={np.percentile(us, 99):.0f} us" if seconds else ""
+
+    if not results:
+        print(f"{args.path} has no action ticks")
+        sys.exit(1)
+    mismatches = [(record["time"], record["action"], action) for record, action in results if action != record["action"]]
+    print(f"{len(results)} action ticks, {len(mismatches)} mismatched actions, {speed}")
+    for t, expected, actual in mismatches[:10]:
+        print(f"  t={t:.3f}s recorded action {expected}, replayed {actual}")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Synthetic GameTickPackets for running the Nexto pipeline without Rocket League.
+Cars and ball are placed uniformly at random on the field, which is enough for
+benchmarking and parity checks but is not realistic gameplay. recorded_packet rebuilds
+the packet of a tick recording record instead (see tick_recorder.py).
+"""
+
+import numpy as np
+from rlbot.utils.structures.game_data_struct import GameTickPacket, FieldInfoPacket
+from rlgym_compat import GameState
+
+from .nexto_obs import BOOST_LOCATIONS, ROTATION_LAYOUT, GameStateEncoder
+from .obs_kernels import quats_to_rot_mtx_reference
+
+ROSTERS = {"1v1": 2, "2v2": 4, "3v3": 6}
+
+
+def make_field_info(boost_locations=BOOST_LOCATIONS) -> FieldInfoPacket:
+    field_info = FieldInfoPacket()
+    field_info.num_boosts = len(boost_locations)
+    for bp, (x, y, z) in zip(field_info.boost_pads, boost_locations):
+        bp.location.x, bp.location.y, bp.location.z = x, y, z
+        bp.is_full_boost = z > 72
+    return field_info
+
+
+def _set_vector(vector, values):
+    vector.x, vector.y, vector.z = values
+
+
+def make_packet(rng: np.random.Generator, n_cars: int, seconds_elapsed: float = 0.0) -> GameTickPacket:
+    packet = GameTickPacket()
+    packet.num_cars = n_cars
+    packet.num_boost = len(BOOST_LOCATIONS)
+    packet.game_info.seconds_elapsed = seconds_elapsed
+    packet.game_info.is_round_active = True
+
+    for i in range(packet.num_boost):
+        packet.game_boosts[i].is_active = bool(rng.random() < 0.7)
+
+    ball = packet.game_ball.physics
+    _set_vector(ball.location, rng.uniform([-4000, -5000, 93], [4000, 5000, 1900]))
+    _set_vector(ball.velocity, rng.uniform(-2000, 2000, 3))
+    _set_vector(ball.angular_velocity, rng.uniform(-5.5, 5.5, 3))
+
+    for i in range(n_cars):
+        car = packet.game_cars[i]
+        car.team = i % 2
+        car.is_bot = True
+        physics = car.physics
+        _set_vector(physics.location, rng.uniform([-4000, -5000, 17], [4000, 5000, 1900]))
+        _set_vector(physics.velocity, rng.uniform(-2300, 2300, 3))
+        _set_vector(physics.angular_velocity, rng.uniform(-5.5, 5.5, 3))
+        physics.rotation.pitch, physics.rotation.yaw, physics.rotation.roll = rng.uniform(-np.pi, np.pi, 3)
+        car.boost = int(rng.integers(0, 101))
+        car.has_wheel_contact = bool(rng.random() < 0.5)
+        car.double_jumped = bool(rng.random() < 0.5)
+        car.is_demolished = bool(rng.random() < 0.05)
+
+    return packet
+
+
+def _set_rotator(rotator, forward, up):
+    # Inverse of rlgym_compat's euler angles to rotation matrix
+    left = np.cross(up, forward)
+    rotator.pitch = np.arcsin(np.clip(forward[2], -1, 1))
+    rotator.yaw = np.arctan2(forward[1], forward[0])
+    rotator.roll = np.arctan2(-left[2], up[2])
+
+
+def recorded_packet(record: dict, header: dict) -> GameTickPacket:
+    """
+    The packet a recorded tick was decoded from, as far as the encoded state keeps it.
+    Cars go back to their packet index (car_id). The rest of the packet is approximated:
+    on_ground becomes wheel contact, has_flip becomes not double jumped.
+    """
+    encoder = GameStateEncoder(len(header["boost_locations"]), header["layout"])
+    row = record["state"][0]
+    n_players = (len(row) - encoder.players_start) // encoder.player_length
+
+    packet = GameTickPacket()
+    packet.num_cars = n_players
+    packet.num_boost = encoder.n_boosts
+    packet.game_info.seconds_elapsed = record["time"]
+    packet.game_info.is_kickoff_pause = record["kickoff_pause"]
+    packet.game_info.is_match_ended = record["match_ended"]
+    packet.game_info.is_round_active = record["round_active"]
+    packet.game_info.is_overtime = record["overtime"]
+    packet.teams[0].score, packet.teams[1].score = int(row[1]), int(row[2])
+
+    for i in range(packet.num_boost):
+        packet.game_boosts[i].is_active = bool(row[3 + i])
+
+    ball = packet.game_ball.physics
+    i = encoder.ball_start
+    _set_vector(ball.location, row[i:i + 3])
+    _set_vector(ball.velocity, row[i + 3:i + 6])
+    _set_vector(ball.angular_velocity, row[i + 6:i + 9])
+
+    for i in range(encoder.players_start, len(row), encoder.player_length):
+        car = packet.game_cars[int(row[i])]
+        car.team = int(row[i + 1])
+        car.is_bot = True
+        physics = car.physics
+        i += 2
+        j = i + 3 + encoder.rotation_length
+        _set_vector(physics.location, row[i:i + 3])
+        if encoder.layout == ROTATION_LAYOUT:
+            _set_rotator(physics.rotation, row[i + 3:i + 6], row[i + 6:i + 9])
+        else:
+            theta = quats_to_rot_mtx_reference(row[None, i + 3:j].astype(np.float64))[0]
+            _set_rotator(physics.rotation, theta[:, 0], theta[:, 2])
+        _set_vector(physics.velocity, row[j:j + 3])
+        _set_vector(physics.angular_velocity, row[j + 3:j + 6])
+        i += 2 * encoder.car_state_length  # Skip the inverted car data
+        car.is_demolished = bool(row[i + 5])
+        car.has_wheel_contact = bool(row[i + 6])
+        car.double_jumped = not row[i + 8]
+        car.boost = int(round(row[i + 9] * 100))
+
+    return packet
+
+
+def make_states(n_states: int, n_cars: int, seed: int = 0):
+    """Decoded GameStates, one per synthetic packet"""
+    rng = np.random.default_rng(seed)
+    field_info = make_field_info()
+    states = []
+    for t in range(n_states):
+        state = GameState(field_info)
+        state.decode(make_packet(rng, n_cars, t / 120), 1)
+        states.append(state)
+    return states
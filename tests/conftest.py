@@ -0,0 +1,40 @@
+import contextlib
+import glob
+import io
+import os
+
+import numpy as np
+import pytest
+
+from ..bot import Nexto
+from ..synthetic_packets import make_field_info, make_packet
+
+
+def simulate_bot(record_directory: str, n_ticks: int = 1200, n_cars: int = 4, index: int = 1, seed: int = 0):
+    """
+    Runs a recording Nexto (orange, so its cars are reordered) over synthetic packets.
+    Returns the recording's path and the bot's car position on every tick.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        bot = Nexto("Nexto", index % 2, index)
+    bot.record_directory = record_directory
+    bot.metrics_interval = 0
+    bot.initialize_agent(make_field_info())
+    rng = np.random.default_rng(seed)
+    positions = []
+    try:
+        for i in range(n_ticks):
+            packet = make_packet(rng, n_cars, (i + 1) / 120)
+            packet.game_info.is_kickoff_pause = (i // 300) % 2 == 0
+            location = packet.game_cars[index].physics.location
+            positions.append((location.x, location.y, location.z))
+            bot.get_output(packet)
+    finally:
+        bot.retire()
+    path, = glob.glob(os.path.join(record_directory, "*.ticks"))
+    return path, np.array(positions, dtype=np.float32)
+
+
+@pytest.fixture(scope="session")
+def bot_recording(tmp_path_factory):
+    return simulate_bot(str(tmp_path_factory.mktemp("recordings")))
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+import torch
+
+from ..nexto_obs import QUATERNION_LAYOUT, ROSTER_BUCKETS, ROTATION_LAYOUT, NextoObsBuilder
+from ..synthetic_packets import make_states
+from ..torch_obs import TorchObsBuilder
+
+
+def _copy(obs):
+    # Builders reuse their output arrays (or tensors), keep our own copy
+    return tuple(a.clone().numpy() if isinstance(a, torch.Tensor) else a.copy() for a in obs)
+
+
+def _observations(builder, state):
+    encoded = builder.encoder.encode(state)
+    batched = [_copy(obs) for obs in builder.batched_build_obs(encoded)]
+    single = [_copy(builder.single_build_obs(encoded, i)) for i in range(len(state.players))]
+    return batched, single
+
+
+def test_prepare_allocates_every_bucket():
+    builder = NextoObsBuilder(roster_buckets=ROSTER_BUCKETS)
+    builder.prepare()
+    allocated = dict(builder._buffers)
+    for n_cars in range(1, ROSTER_BUCKETS[-1] + 1):
+        state = make_states(1, n_cars, seed=n_cars)[0]
+        _observations(builder, state)
+    assert builder._buffers.keys() == allocated.keys()
+    assert all(builder._buffers[key] is buffers for key, buffers in allocated.items())
+
+
+def test_rosters_sharing_a_bucket_build_their_own_observations():
+    for cls in (NextoObsBuilder, TorchObsBuilder):
+        builder = cls(roster_buckets=ROSTER_BUCKETS)
+        # 3 and 4 cars share the 4 bucket, switching back and forth must reset the mask every time
+        for n_cars in (3, 4, 3, 1, 4):
+            state = make_states(1, n_cars, seed=n_cars)[0]
+            expected = _observations(cls(roster_buckets=ROSTER_BUCKETS), state)
+            actual = _observations(builder, state)
+            for exp, act in zip(expected, actual):
+                for e, a in zip(exp, act):
+                    for e_array, a_array in zip(e, a):
+                        np.testing.assert_array_equal(e_array, a_array)
+
+
+@pytest.mark.parametrize("layout", [QUATERNION_LAYOUT, ROTATION_LAYOUT])
+def test_torch_builder_matches_the_numpy_builder(layout):
+    numpy_builder = NextoObsBuilder(layout=layout, roster_buckets=ROSTER_BUCKETS)
+    torch_builder = TorchObsBuilder(layout=layout, roster_buckets=ROSTER_BUCKETS)
+    for n_cars in (2, 3, 6):
+        for state in make_states(5, n_cars, seed=n_cars):
+            for expected, actual in zip(_observations(numpy_builder, state), _observations(torch_builder, state)):
+                for e, a in zip(expected, actual):
+                    for e_array, a_array in zip(e, a):
+                        np.testing.assert_allclose(a_array, e_array, atol=1e-5)
@@ -0,0 +1,65 @@
+import numpy as np
+from rlgym_compat import GameState
+
+from ..nexto_obs import ACTIONS, GameStateEncoder
+from ..obs_dataset import _runs, convert_recording, load_shard
+from ..synthetic_packets import make_field_info, recorded_packet
+from ..tick_recorder import read_recording
+
+
+def test_recording_lists_the_bot_first_on_every_tick(bot_recording):
+    path, positions = bot_recording
+    header, records = read_recording(path)
+    encoder = GameStateEncoder(len(header["boost_locations"]), header["layout"])
+    states = np.concatenate([record["state"] for record in records])
+    bot = states[:, encoder.players_start:encoder.players_start + encoder.player_length]
+    np.testing.assert_array_equal(bot[:, 2:5], positions)
+    teams = states[:, encoder.players_start + 1::encoder.player_length]
+    assert (teams == teams[0]).all()
+
+
+def test_recorded_packets_decode_to_the_recorded_states(bot_recording):
+    path, _ = bot_recording
+    header, records = read_recording(path)
+    encoder = GameStateEncoder(len(header["boost_locations"]), header["layout"])
+    # on_ground also counts the ticks since wheel contact, which the recording does not keep
+    on_ground = encoder.players_start + 2 + 2 * encoder.car_state_length + 6
+    state = GameState(make_field_info(header["boost_locations"]))
+    for record in records:
+        state.decode(recorded_packet(record, header), record["ticks_elapsed"])
+        car_ids = record["state"][0, encoder.players_start::encoder.player_length].astype(int)
+        state.players = [state.players[car_id] for car_id in car_ids]  # In the recorded order
+        expected, actual = record["state"].copy(), encoder.encode(state).copy()
+        expected[:, on_ground::encoder.player_length] = actual[:, on_ground::encoder.player_length] = 0
+        np.testing.assert_allclose(actual, expected, atol=1e-3)
+
+
+def test_runs_are_full_chunks(bot_recording):
+    path, _ = bot_recording
+    header, records = read_recording(path)
+    encoder = GameStateEncoder(len(header["boost_locations"]), header["layout"])
+    sizes = [len(run) for _, run in _runs(records, encoder, 64, False)]
+    assert sizes[:-1] == [64] * (len(sizes) - 1)
+
+
+def test_converted_rows_match_the_recording(tmp_path, bot_recording):
+    path, _ = bot_recording
+    entry = convert_recording(path, str(tmp_path), 0, chunk_size=64, shard_size=1000)
+    _, records = read_recording(path)
+    records = list(records)
+    assert entry["records"] == len(records)
+
+    q = np.concatenate([load_shard(str(tmp_path), shard["name"])[0] for shard in entry["shards"]])
+    meta = np.concatenate([load_shard(str(tmp_path), shard["name"])[3] for shard in entry["shards"]])
+    bot_rows = meta["player"] == 0
+    q, meta = q[bot_rows], meta[bot_rows]
+    np.testing.assert_array_equal(meta["record"], np.arange(len(records)))
+    n_actions = 0
+    for row, record in enumerate(records):
+        if record["action"] is None:
+            assert meta["action"][row] == -1
+            continue
+        n_actions += 1
+        assert meta["action"][row] == record["action"]
+        np.testing.assert_array_equal(q[row, 0, ACTIONS.start:ACTIONS.stop], record["prev_action"].astype(np.float32))
+    assert n_actions > 0
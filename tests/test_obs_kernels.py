@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from ..agent import Agent
+from ..nexto_obs import ANG_VEL, FW, POS, NextoObsBuilder
+from ..obs_kernels import (HAVE_NUMBA, convert_to_relative_matmul, convert_to_relative_numba,
+                           convert_to_relative_reference, quats_to_rot_mtx, quats_to_rot_mtx_numba,
+                           quats_to_rot_mtx_reference)
+from ..obs_parity import TOLERANCES, build_reference, build_with, compare
+from ..synthetic_packets import make_states
+
+needs_numba = pytest.mark.skipif(not HAVE_NUMBA, reason="numba not installed")
+
+
+def _quats(n=257):
+    quats = np.random.default_rng(0).standard_normal((n, 4)).astype(np.float32)
+    quats[::17] = 0  # Demolished cars have zero quaternions
+    return quats
+
+
+def _obs(n=64, n_entities=41):
+    rng = np.random.default_rng(1)
+    return (rng.standard_normal((n, 1, 32)).astype(np.float32),
+            rng.standard_normal((n, n_entities, 24)).astype(np.float32))
+
+
+def _relative_expected(q, kv):
+    expected = kv.astype(np.float64)
+    convert_to_relative_reference(q.astype(np.float64), expected, POS.start, FW.start, ANG_VEL.stop)
+    return expected
+
+
+@pytest.mark.parametrize("kernel", [quats_to_rot_mtx, pytest.param(quats_to_rot_mtx_numba, marks=needs_numba)])
+def test_rot_mtx_kernels_match_the_reference(kernel):
+    quats = _quats()
+    np.testing.assert_allclose(kernel(quats), quats_to_rot_mtx_reference(quats.astype(np.float64)), atol=1e-5)
+
+
+@pytest.mark.parametrize("kernel", [convert_to_relative_matmul,
+                                    pytest.param(convert_to_relative_numba, marks=needs_numba)])
+def test_relative_kernels_match_the_reference(kernel):
+    q, kv = _obs()
+    expected = _relative_expected(q, kv)
+    kernel(q, kv, POS.start, FW.start, ANG_VEL.stop)
+    np.testing.assert_allclose(kv, expected, atol=1e-5)
+
+
+@needs_numba
+@pytest.mark.parametrize("layout", ["quaternion", "rotation"])
+def test_numba_builder_matches_the_baseline(layout):
+    states = make_states(20, 4, seed=4)
+    builder = NextoObsBuilder(layout=layout, use_numba=True)
+    result = compare(Agent(), build_reference(states), build_with(builder, states))
+    assert result["max_abs_diff"] <= TOLERANCES[layout]
+    assert result["action_agreement"] == 1
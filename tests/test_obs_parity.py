@@ -0,0 +1,56 @@
+import pytest
+
+from ..agent import Agent
+from ..nexto_obs import QUATERNION_LAYOUT, ROTATION_LAYOUT
+from ..obs_parity import (TOLERANCES, build_reference, check_encoder, check_exact, check_layouts, check_padding,
+                          check_precision, check_zero_copy)
+from ..synthetic_packets import ROSTERS, make_states
+
+
+@pytest.fixture(scope="module")
+def agent():
+    return Agent()
+
+
+@pytest.fixture(scope="module", params=sorted(ROSTERS.items()), ids=lambda roster: roster[0])
+def states(request):
+    _, n_cars = request.param
+    states = make_states(20, n_cars, seed=n_cars)
+    return states, build_reference(states)
+
+
+def _assert_matches(result, tolerance):
+    assert result["max_abs_diff"] <= tolerance
+    assert result["action_agreement"] == 1
+
+
+def test_encoder_writes_the_baseline_values(states):
+    states, _ = states
+    assert check_encoder(states)
+
+
+@pytest.mark.parametrize("layout", [QUATERNION_LAYOUT, ROTATION_LAYOUT])
+def test_float64_builder_reproduces_the_baseline_exactly(agent, states, layout):
+    states, reference = states
+    assert check_exact(agent, states, reference)[layout]["bit_exact"]
+
+
+@pytest.mark.parametrize("layout", [QUATERNION_LAYOUT, ROTATION_LAYOUT])
+def test_layouts_match_the_baseline(agent, states, layout):
+    states, reference = states
+    _assert_matches(check_layouts(agent, states, reference)[layout], TOLERANCES[layout])
+
+
+def test_padded_observations_match_the_baseline(agent, states):
+    states, reference = states
+    _assert_matches(check_padding(agent, states, reference), TOLERANCES[ROTATION_LAYOUT])
+
+
+def test_float32_matches_float64(agent, states):
+    states, _ = states
+    _assert_matches(check_precision(agent, states), TOLERANCES[ROTATION_LAYOUT])
+
+
+def test_agent_wraps_observations_without_copying(states):
+    states, _ = states
+    assert check_zero_copy(states[:5])
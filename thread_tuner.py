@@ -0,0 +1,226 @@
+"""
+Startup calibration of torch's intra-op and inter-op thread counts for Agent.
+Every candidate configuration is timed on the agent the bot runs (make_agent without attention
+weights, specialized per roster bucket) on padded observations, with as many worker processes
+running side by side as there will be Nexto instances running the model, so the result accounts for
+the instances competing for cores. The best configuration is cached per machine, model and instance count, and
+later launches only read the cache.
+
+Run with: python -m <bot package>.thread_tuner --instances 2
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from .inference_backends import BACKENDS, MODEL_DIR, TORCHSCRIPT_BACKEND
+
+logger = logging.getLogger(__name__)
+
+# Outside the bot folder like the metrics, the cache is per machine and never belongs in the source tree
+THREAD_CACHE_FILE = os.path.join(tempfile.gettempdir(), "nexto-thread-tuning.json")
+
+# A configuration is only preferred over one with fewer threads if it is faster by more than this
+MIN_IMPROVEMENT = 0.05
+
+
+def machine_id():
+    """Identifies the hardware and torch build, a cached configuration is only valid on the same one"""
+    return "|".join((platform.node(), platform.machine(), platform.processor() or "unknown",
+                     f"{os.cpu_count()} cpus", f"torch {torch.__version__}"))
+
+
+def model_hash(backend: str = TORCHSCRIPT_BACKEND, model_dir: str = MODEL_DIR):
+    h = hashlib.sha256(backend.encode())
+    with open(os.path.join(model_dir, BACKENDS[backend].model_file), 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+def cache_key(backend: str, instances: int, model_dir: str = MODEL_DIR):
+    return f"{machine_id()}|{model_hash(backend, model_dir)}|{instances} instances"
+
+
+def load_cache(path: str = THREAD_CACHE_FILE):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache: dict, path: str = THREAD_CACHE_FILE):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def cached_threads(backend: str = TORCHSCRIPT_BACKEND, instances: int = 1, path: str = THREAD_CACHE_FILE):
+    """(intra_op, inter_op) thread counts calibrated for this machine, or None if not calibrated yet"""
+    try:
+        entry = load_cache(path).get(cache_key(backend, instances))
+    except (OSError, KeyError):
+        return None  # Model file missing, make_agent will report it
+    if entry is None:
+        return None
+    return entry["intra_op"], entry["inter_op"]
+
+
+def apply_threads(intra_op: int, inter_op: int = None):
+    torch.set_num_threads(intra_op)
+    if inter_op is not None and inter_op != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError:
+            # Can only be set once per process, before any inter-op work has started
+            logger.warning(f"Could not set {inter_op} inter-op threads, keeping {torch.get_num_interop_threads()}")
+
+
+def candidate_configs(instances: int = 1, cpu_count: int = None):
+    """(intra_op, inter_op) pairs that do not oversubscribe the cores when every instance uses them"""
+    cores = max(1, (cpu_count or os.cpu_count() or 1) // max(1, instances))
+    intra = sorted({1, cores} | {n for n in (2, 4, 8, 16) if n < cores})
+    inter = (1, 2) if cores > 1 else (1,)
+    return [(i, j) for i in intra for j in inter]
+
+
+def _measure_observations():
+    """Single-car observations of every roster, padded to the roster buckets like the bot's"""
+    from .nexto_obs import ROSTER_BUCKETS, NextoObsBuilder
+    from .synthetic_packets import ROSTERS, make_states
+
+    observations = []
+    for n_cars in ROSTERS.values():
+        builder = NextoObsBuilder(roster_buckets=ROSTER_BUCKETS)
+        for state in make_states(8, n_cars, seed=n_cars):
+            obs = builder.single_build_obs(builder.encoder.encode(state), 0)
+            observations.append(tuple(o.copy() for o in obs))
+    return observations
+
+
+def _measure(backend: str, intra_op: int, inter_op: int, iterations: int, warmup: int):
+    """Worker side: times select_action once the parent says go, prints the latencies as JSON"""
+    from .agent import WARMUP_ENTITY_COUNTS, make_agent
+
+    # The agent the bot runs: logits only, one specialized model per roster bucket
+    agent = make_agent(backend, threads=(intra_op, inter_op), attention_weights=False,
+                       entity_counts=WARMUP_ENTITY_COUNTS)
+    observations = _measure_observations()
+    for i in range(warmup):
+        agent.select_action(observations[i % len(observations)], 1)
+
+    print("ready", flush=True)
+    sys.stdin.readline()  # Released together with the other instances
+
+    seconds = np.empty(iterations)
+    for i in range(iterations):
+        obs = observations[i % len(observations)]
+        start = time.perf_counter()
+        agent.select_action(obs, 1)
+        seconds[i] = time.perf_counter() - start
+    us = seconds * 1e6
+    print(json.dumps({"p50_us": float(np.percentile(us, 50)), "p95_us": float(np.percentile(us, 95))}), flush=True)
+
+
+def time_config(backend: str, intra_op: int, inter_op: int, instances: int, iterations: int = 500,
+                warmup: int = 50):
+    """p50/p95 select_action latency per instance with instances workers running the configuration at once"""
+    command = [sys.executable, "-m", f"{__package__}.thread_tuner", "--backend", backend,
+               "--measure", str(intra_op), str(inter_op), "--iterations", str(iterations), "--warmup", str(warmup)]
+    cwd = os.path.dirname(MODEL_DIR)  # Parent of the bot package, so the relative imports resolve
+    workers = [subprocess.Popen(command, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+               for _ in range(instances)]
+    try:
+        for worker in workers:
+            if worker.stdout.readline().strip() != "ready":
+                raise RuntimeError(f"Thread tuning worker failed (exit code {worker.wait()})")
+        for worker in workers:
+            worker.stdin.write("go\n")
+            worker.stdin.flush()
+        results = [json.loads(worker.stdout.readline()) for worker in workers]
+    except BaseException:
+        for worker in workers:
+            worker.kill()
+        raise
+    finally:
+        for worker in workers:
+            worker.stdin.close()
+            worker.stdout.close()
+            worker.wait()
+    return {
+        "p50_us": float(np.mean([r["p50_us"] for r in results])),
+        "p95_us": float(np.mean([r["p95_us"] for r in results])),
+    }
+
+
+def calibrate(backend: str = TORCHSCRIPT_BACKEND, instances: int = 1, iterations: int = 500):
+    """Times every candidate configuration and returns the cache entry of the best one"""
+    timings = []
+    for intra_op, inter_op in candidate_configs(instances):
+        stats = time_config(backend, intra_op, inter_op, instances, iterations)
+        logger.info(f"{intra_op} intra-op / {inter_op} inter-op threads x {instances} instances: "
+                    f"p50 {stats['p50_us']:.0f} us, p95 {stats['p95_us']:.0f} us")
+        timings.append({"intra_op": intra_op, "inter_op": inter_op, **stats})
+
+    # Deadlines are missed on the tail, so rank by p95, and keep the cheaper configuration unless
+    # more threads are clearly faster
+    best = min(timings, key=lambda t: t["p95_us"])
+    for t in sorted(timings, key=lambda t: (t["intra_op"] * t["inter_op"], t["intra_op"])):
+        if t["p95_us"] <= best["p95_us"] * (1 + MIN_IMPROVEMENT):
+            best = t
+            break
+    return {
+        "intra_op": best["intra_op"],
+        "inter_op": best["inter_op"],
+        "p95_us": best["p95_us"],
+        "calibrated_at": time.time(),
+        "timings": timings,
+    }
+
+
+def tune(backend: str = TORCHSCRIPT_BACKEND, instances: int = 1, force: bool = False,
+         path: str = THREAD_CACHE_FILE, iterations: int = 500):
+    """Cached thread configuration for this machine, calibrating first if there is none"""
+    cache = load_cache(path)
+    key = cache_key(backend, instances)
+    if force or key not in cache:
+        logger.info(f"Calibrating {backend} threads for {instances} instance(s), this only happens once")
+        cache[key] = calibrate(backend, instances, iterations)
+        save_cache(cache, path)
+    return cache[key]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate torch thread counts for Nexto")
+    parser.add_argument("--backend", type=str, default=TORCHSCRIPT_BACKEND, choices=list(BACKENDS))
+    parser.add_argument("--instances", type=int, default=1, help="Nexto instances running the model at once")
+    parser.add_argument("--force", action="store_true", help="Calibrate again even if a result is cached")
+    parser.add_argument("--iterations", type=int, default=500, help="Timed select_action calls per instance and configuration")
+    parser.add_argument("--warmup", type=int, default=50, help=argparse.SUPPRESS)
+    parser.add_argument("--measure", type=int, nargs=2, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        _measure(args.backend, *args.measure, args.iterations, args.warmup)
+        return
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    entry = tune(args.backend, max(1, args.instances), args.force, iterations=args.iterations)
+    print(f"{args.backend} x {args.instances} instance(s): {entry['intra_op']} intra-op, "
+          f"{entry['inter_op']} inter-op threads (p95 {entry['p95_us']:.0f} us)")
+
+
+if __name__ == "__main__":
+    main()
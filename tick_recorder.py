@@ -0,0 +1,104 @@
+"""
+Compact tick recordings for replaying Nexto's inputs without a game running.
+A recording is a msgpack stream: a header, then one record per get_output call with the game info
+flags, ticks_elapsed and the encoded GameState, plus beta, previous action and chosen action on the
+ticks where Nexto picked a new action. See replay.py for the replay engine.
+Encoded states list the recording bot first, then its teammates, then its opponents. Version 1
+recordings only used that order on action ticks, the other ticks are in packet order.
+"""
+
+import queue
+import threading
+import time
+
+import msgpack
+import numpy as np
+
+RECORDING_FORMAT = "nexto-ticks"
+RECORDING_VERSION = 2
+READABLE_VERSIONS = (1, 2)
+RECORDING_SUFFIX = ".ticks"
+
+
+class TickRecorder:
+    """
+    Appends tick records to a file from a background thread.
+    The tick thread only copies the encoded state and queues the record, packing and writing
+    happen on the writer thread, which flushes to disk every flush_interval seconds.
+    """
+
+    def __init__(self, path, header: dict, flush_interval: float = 1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._file = open(path, 'wb')
+        self._packer = msgpack.Packer()
+        self._file.write(self._packer.pack({"format": RECORDING_FORMAT, "version": RECORDING_VERSION, **header}))
+
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write_loop, name="nexto-tick-recorder", daemon=True)
+        self._thread.start()
+
+    def record(self, game_info, ticks_elapsed: int, encoded_state: np.ndarray,
+               beta=None, prev_action: np.ndarray = None, action: int = None):
+        self.write(self.make_record(game_info, ticks_elapsed, encoded_state, beta, prev_action, action))
+
+    @staticmethod
+    def make_record(game_info, ticks_elapsed: int, encoded_state: np.ndarray,
+                    beta=None, prev_action: np.ndarray = None, action: int = None):
+        # Copies everything out of the packet and buffers, so the record can be completed and written later
+        return {
+            "time": game_info.seconds_elapsed,
+            "ticks_elapsed": ticks_elapsed,
+            "kickoff_pause": game_info.is_kickoff_pause,
+            "match_ended": game_info.is_match_ended,
+            "round_active": game_info.is_round_active,
+            "overtime": game_info.is_overtime,
+            "state": encoded_state.tobytes(),
+            "beta": beta,
+            "prev_action": None if prev_action is None else prev_action.tolist(),
+            "action": action,
+        }
+
+    def write(self, record: dict):
+        self._queue.put(record)
+
+    def _write_loop(self):
+        last_flush = time.perf_counter()
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            self._file.write(self._packer.pack(record))
+            if time.perf_counter() - last_flush > self.flush_interval:
+                self._file.flush()
+                last_flush = time.perf_counter()
+        self._file.close()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+def read_recording(path):
+    """(header, records) of a recording, records is a generator and keeps the file open until exhausted"""
+    f = open(path, 'rb')
+    unpacker = msgpack.Unpacker(f, raw=False)
+    try:
+        header = next(unpacker)
+    except StopIteration:
+        f.close()
+        raise ValueError(f"{path} is empty")
+    if header.get("format") != RECORDING_FORMAT or header.get("version") not in READABLE_VERSIONS:
+        f.close()
+        raise ValueError(f"{path} is not a version {' or '.join(map(str, READABLE_VERSIONS))} "
+                         f"{RECORDING_FORMAT} recording")
+
+    def records():
+        with f:
+            for record in unpacker:
+                record["state"] = np.frombuffer(record["state"], dtype=np.float32).reshape(1, -1)
+                if record["prev_action"] is not None:
+                    record["prev_action"] = np.array(record["prev_action"])
+                yield record
+
+    return header, records()
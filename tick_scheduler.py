@@ -0,0 +1,78 @@
+"""
+Deadline-aware scheduling of Nexto's decisions.
+Decides on which ticks to pick a new action and apply it, like the fixed tick_skip did, but adjusts
+tick_skip within bounds from the measured decision latency, and records every tick that overran
+its frame.
+"""
+
+import math
+from collections import deque
+
+import numpy as np
+
+FRAME_TIME = 1 / 120
+
+
+class TickScheduler:
+    """
+    A decision is made on the first tick of every window of tick_skip ticks and applied from tick
+    tick_skip - 1 on. At the end of each window tick_skip is set so that, at the p95 of the recent
+    decision latencies, deciding takes at most max_load of the frame time on average, moving by
+    at most one tick per window.
+    """
+
+    def __init__(self, tick_skip: int = 6, min_tick_skip: int = None, max_tick_skip: int = None,
+                 max_load: float = 0.5, frame_time: float = FRAME_TIME, window: int = 32,
+                 max_missed_deadlines: int = 10000):
+        self.min_tick_skip = max(1, int(tick_skip if min_tick_skip is None else min_tick_skip))
+        self.max_tick_skip = max(self.min_tick_skip, int(tick_skip if max_tick_skip is None else max_tick_skip))
+        self.tick_skip = min(max(int(tick_skip), self.min_tick_skip), self.max_tick_skip)
+        self.max_load = max_load
+        self.frame_time = frame_time
+
+        self.ticks = self.tick_skip
+        self.update_action = True
+        self.latencies = deque(maxlen=window)
+
+        # Every tick that took longer than frame_time, the most recent max_missed_deadlines are kept
+        self.n_missed_deadlines = 0
+        self.missed_deadlines = deque(maxlen=max_missed_deadlines)
+
+    def reset(self):
+        self.ticks = self.tick_skip  # So we take an action the first tick
+        self.update_action = True
+
+    def advance(self, ticks_elapsed: int):
+        self.ticks += ticks_elapsed
+
+    def should_update_controls(self) -> bool:
+        return self.ticks >= self.tick_skip - 1
+
+    def record_latency(self, seconds: float):
+        """Time it took to pick an action"""
+        self.latencies.append(seconds)
+
+    def end_tick(self, seconds: float, tick: int, game_time: float):
+        """Called at the end of every tick with how long the tick took"""
+        if seconds > self.frame_time:
+            self.n_missed_deadlines += 1
+            self.missed_deadlines.append({
+                "tick": tick,
+                "game_time": game_time,
+                "ms": seconds * 1000,
+                "tick_skip": self.tick_skip,
+            })
+
+        if self.ticks >= self.tick_skip:
+            self.ticks = 0
+            self.update_action = True
+            self._adapt()
+
+    def _adapt(self):
+        if self.min_tick_skip == self.max_tick_skip or len(self.latencies) < self.latencies.maxlen // 2:
+            return
+        latency = np.percentile(self.latencies, 95)
+        wanted = math.ceil(latency / (self.max_load * self.frame_time))
+        wanted = min(max(wanted, self.min_tick_skip), self.max_tick_skip)
+        if wanted != self.tick_skip:
+            self.tick_skip += 1 if wanted > self.tick_skip else -1
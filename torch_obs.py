@@ -0,0 +1,159 @@
+"""
+Torch-native observation builder for Nexto.
+Same observations as NextoObsBuilder, but the per-decision work happens in torch on persistent
+float32 tensors, which are what the builder returns. The agent passes them to the actor as they are.
+
+Compare it with the numpy builder with: python -m <bot package>.bench_obs
+"""
+
+from typing import Any
+
+import numpy as np
+import torch
+
+from .nexto_obs import (ACTIONS, ANG_VEL, FW, IS_MATE, IS_OPP, IS_SELF, POS, ROTATION_LAYOUT,
+                        NextoObsBuilder)
+
+
+def _relative_scratch(lead_shape, n_entities: int):
+    # Temporaries of TorchObsBuilder._convert_to_relative, so repeated calls allocate nothing
+    n_components = len(range(POS.start, ANG_VEL.stop, 3))
+    theta, ct, st = (torch.zeros(lead_shape + (1, 1)) for _ in range(3))
+    a, b, c = (torch.zeros(lead_shape + (n_entities, n_components)) for _ in range(3))
+    return theta, ct, st, a, b, c
+
+
+class TorchObsBuilder(NextoObsBuilder):
+    """
+    NextoObsBuilder doing its quaternion math, team inversion, normalization, relative conversion and
+    masking with torch ops. Buffers are allocated once per roster bucket like the numpy builder's, as
+    tensors sharing their memory, and build_obs/batched_build_obs return views of them.
+    """
+
+    def __init__(self, field_info=None, n_players=None, tick_skip=8, layout=ROTATION_LAYOUT, roster_buckets=None):
+        super().__init__(field_info, n_players, tick_skip, layout, roster_buckets, dtype=np.float32)
+        # Factors of the blue and orange perspectives, indexed by team
+        self._invert_t = torch.from_numpy(np.stack([np.ones_like(self._invert), self._invert]))
+        self._norm_t = torch.from_numpy(self._norm)
+        self._actions = slice(ACTIONS.start, ACTIONS.stop)
+        self._tensors = {}
+        self._perspectives = {}
+
+    def _get_buffers(self, n_perspectives: int, n_states: int, n_players: int):
+        # The numpy builder's buffers (float32, the mask set for the roster), as tensors on the same memory
+        # Rosters in a bucket share the arrays, but not the tensors, since the gather index depends on the roster
+        q, kv, m, static, _ = super()._get_buffers(n_perspectives, n_states, n_players)
+        key = (n_perspectives, n_states, n_players)
+        tensors = self._tensors.get(key)
+        if tensors is None:
+            scratch = _relative_scratch((n_perspectives, n_states), kv.shape[-2])
+            tensors = self._tensors[key] = (torch.from_numpy(q), torch.from_numpy(kv), torch.from_numpy(m),
+                                            torch.from_numpy(static), scratch,
+                                            self._gather_index(n_players, kv.shape[-2]))
+        return tensors
+
+    def _release_buffers(self, key):
+        super()._release_buffers(key)
+        self._tensors = {k: t for k, t in self._tensors.items() if self._buffer_key(*k) != key}
+
+    def _gather_index(self, n_players: int, n_entities: int):
+        """
+        (kv positions, encoded columns) of everything _fill_dynamic copies, so it takes a single
+        index_copy_ instead of a dozen indexed writes. Found by running the numpy _fill_dynamic on a
+        state whose values are their own column numbers. None for the quaternion layout, whose
+        rotations are computed rather than copied.
+        """
+        if self.encoder.layout != ROTATION_LAYOUT:
+            return None
+        probe = np.arange(1, self.encoder.state_length(n_players) + 1, dtype=np.float32)[None]
+        kv = np.zeros((n_entities, 24), dtype=np.float32)
+        NextoObsBuilder._fill_dynamic(self, kv, probe, n_players, self.lim_players(n_players))
+        positions = np.flatnonzero(kv)
+        return torch.from_numpy(positions), torch.from_numpy(kv.ravel()[positions].astype(np.int64) - 1)
+
+    def _fill_dynamic(self, kv: torch.Tensor, encoded: torch.Tensor, n_players: int, lim_players: int,
+                      gather_index=None):
+        if gather_index is None:
+            super()._fill_dynamic(kv, encoded, n_players, lim_players)
+            return
+        positions, columns = gather_index
+        values = encoded.index_select(1, columns)
+        flat = kv.view(kv.shape[:-2] + (-1,))
+        flat.index_copy_(-1, positions, values.expand(flat.shape[:-1] + values.shape[-1:]))
+
+    def _quats_to_rot_mtx(self, quats: torch.Tensor) -> torch.Tensor:
+        # NextoObsBuilder._quats_to_rot_mtx in torch, zero quaternions give a zero matrix
+        w, x, y, z = (-quats).unbind(-1)
+        norm = (quats * quats).sum(-1)
+        s = torch.where(norm != 0, 1.0 / norm, torch.zeros_like(norm))
+        rows = (
+            1.0 - 2.0 * s * (y * y + z * z), 2.0 * s * (x * y - z * w), 2.0 * s * (x * z + y * w),
+            2.0 * s * (x * y + z * w), 1.0 - 2.0 * s * (x * x + z * z), 2.0 * s * (y * z - x * w),
+            2.0 * s * (x * z - y * w), 2.0 * s * (y * z + x * w), 1.0 - 2.0 * s * (x * x + y * y),
+        )
+        theta = torch.stack(rows, dim=-1).reshape(-1, 3, 3)
+        return theta.masked_fill_((norm == 0)[:, None, None], 0)
+
+    def _convert_to_relative(self, q: torch.Tensor, kv: torch.Tensor, scratch):
+        # obs_kernels.convert_to_relative_reference with torch ops writing into the scratch tensors
+        theta, ct, st, a, b, c = scratch
+
+        kv_pos = kv[..., POS]
+        kv_pos.sub_(q[..., POS])
+        torch.atan2(q[..., FW.start], q[..., FW.start + 1], out=theta[..., 0])
+        torch.cos(theta, out=ct)
+        torch.sin(theta, out=st)
+        xs = kv[..., POS.start:ANG_VEL.stop:3]
+        ys = kv[..., POS.start + 1:ANG_VEL.stop:3]
+        # nx = ct * xs - st * ys, computed before writing since ny still needs the original xs
+        torch.mul(ct, xs, out=a)
+        torch.mul(st, ys, out=b)
+        a.sub_(b)
+        # ny = st * xs + ct * ys
+        torch.mul(st, xs, out=b)
+        torch.mul(ct, ys, out=c)
+        torch.add(b, c, out=ys)
+        xs.copy_(a)
+
+    def _build(self, encoded_states: np.ndarray, perspectives):
+        n_players, lim_players = self._n_players(encoded_states)
+        q, kv, m, static, scratch, gather_index = self._get_buffers(len(perspectives), encoded_states.shape[0],
+                                                                    n_players)
+        if not encoded_states.flags.writeable:
+            encoded_states = encoded_states.copy()  # Recorded states are read-only, torch wants writable memory
+        encoded = torch.from_numpy(encoded_states)
+        teams = encoded[0, self.encoder.players_start + 1::self.encoder.player_length]
+        dynamic = slice(0, lim_players + 1)
+
+        # Every perspective at once, indexed by the perspective's row j and player i
+        key = tuple(perspectives)
+        indices = self._perspectives.get(key)
+        if indices is None:
+            indices = self._perspectives[key] = torch.arange(len(key)), torch.as_tensor(key)
+        j, i = indices
+        own_teams = teams[i]
+        orange = (own_teams == 1).long()
+
+        kv.copy_(static[orange][:, None])
+        self._fill_dynamic(kv, encoded, n_players, lim_players, gather_index)
+
+        kv[j, :, i, IS_SELF] = 1
+        same_team = own_teams[:, None] == teams[None, :]
+        kv[:, :, :n_players, IS_MATE] = same_team[:, None]
+        kv[:, :, :n_players, IS_OPP] = ~same_team[:, None]
+        kv[:, :, dynamic].mul_(self._invert_t[orange][:, None, None])
+        kv[..., dynamic, :].div_(self._norm_t)
+
+        q[..., 0, :kv.shape[-1]] = kv[j, :, i]
+        q[..., kv.shape[-1]:] = 0
+
+        self._convert_to_relative(q, kv, scratch)
+        return q, kv, m
+
+    def add_actions(self, obs: Any, previous_actions: np.ndarray, player_index=None):
+        if player_index is None:
+            for (q, kv, m), act in zip(obs, previous_actions):
+                q[:, 0, self._actions] = torch.as_tensor(act)
+        else:
+            q, kv, m = obs[player_index]
+            q[:, 0, self._actions] = torch.as_tensor(previous_actions)